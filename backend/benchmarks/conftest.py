@@ -0,0 +1,37 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""Fixtures of the micro-benchmarks.
+
+The benchmarks use `pytest-benchmark`_ and are run apart from the tests,
+against the baseline stored in ``benchmarks/baselines``::
+
+    $ make bench-baseline  # on the reference commit
+    $ make bench           # fails if a benchmark got slower
+
+.. _pytest-benchmark: https://pytest-benchmark.readthedocs.io
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The fixtures of the tests are shared with the benchmarks.
+from tests.conftest import app, client, project_root  # noqa: E402, F401, I100
+from tests.seeder import generate_chats  # noqa: E402
+
+# The scripts are not collected, and their dependencies may be missing.
+collect_ignore = ['loadtest.py', 'semantic_cache.py', 'sqlite_writes.py']
+
+
+@pytest.fixture()
+def chats(app):  # noqa: F811
+    """Generate chats with their entries, and get their IDs."""
+    return generate_chats
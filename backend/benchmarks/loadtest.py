@@ -0,0 +1,374 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""Load test a Promptly server end to end.
+
+Concurrent virtual users send a weighted mix of requests to the server for a
+given duration:
+
+- ``conversation``: ``POST /conversation``, in a new chat or a known one;
+- ``history``: ``GET /history``;
+- ``chat``: ``GET /<chat_id>``, for a known chat.
+
+The latency percentiles, the throughput and the error rate of every kind of
+request are written as JSON, which can be compared with the results of
+another commit.
+
+By default, the server is started locally with a fake OpenAI API, see
+``tests/fake_openai.py``, and a scratch SQLite database, so that no API call
+is paid for. Use ``--url`` to load test a server started otherwise, e.g.
+behind gunicorn and pointed to the fake API with ``OPENAI_API_BASE``.
+
+Usage::
+
+    $ python benchmarks/loadtest.py --duration 60 --output after.json \\
+        --latency lognormal:0.8,0.5 --error-rate 0.01
+    $ python benchmarks/loadtest.py --compare before.json after.json
+
+The comparison exits with a non-zero status when the p95 latency or the
+throughput of a kind of request regressed by more than ``--threshold``, or
+its error rate increased by more than one point.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+
+import aiohttp
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MIX = 'conversation=1,history=2,chat=2'
+
+MESSAGES = (
+    'What is the capital of France?',
+    'Write a haiku about load testing.',
+    'Explain the difference between p95 and p99 latency.',
+    'Summarize the plot of Hamlet in two sentences.',
+)
+
+
+def percentile(sorted_samples, q):
+    """Get a percentile of sorted samples, by the nearest rank method."""
+    if not sorted_samples:
+        return None
+    rank = max(1, round(q / 100 * len(sorted_samples)))
+    return sorted_samples[min(rank, len(sorted_samples)) - 1]
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('conversation', 'history', 'chat'):
+            raise argparse.ArgumentTypeError(f'Unknown request: {name}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+class LoadTest:
+    """Virtual users sending requests, and the outcomes of the requests."""
+
+    def __init__(self, url, mix, concurrency, duration, seed=None):
+        self.url = url.rstrip('/')
+        self.mix = mix
+        self.concurrency = concurrency
+        self.duration = duration
+        self.rng = random.Random(seed)
+        self.chat_ids = []
+        self.sent = 0
+        # Per kind of request: the latencies of the successful ones, and the
+        # number of failed ones.
+        self.latencies = {name: [] for name in mix}
+        self.errors = {name: 0 for name in mix}
+
+    async def run(self):
+        timeout = aiohttp.ClientTimeout(total=120)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector,
+                                         timeout=timeout) as session:
+            await self._discover_chats(session)
+            deadline = time.monotonic() + self.duration
+            started = time.monotonic()
+            await asyncio.gather(*(
+                self._user(session, deadline)
+                for _ in range(self.concurrency)
+            ))
+            return time.monotonic() - started
+
+    async def _discover_chats(self, session):
+        async with session.get(f'{self.url}/history.json') as response:
+            if response.status == 200:
+                data = await response.json()
+                self.chat_ids.extend(chat['id'] for chat in data['chats'])
+
+    async def _user(self, session, deadline):
+        names, weights = zip(*self.mix.items())
+        while time.monotonic() < deadline:
+            name = self.rng.choices(names, weights)[0]
+            if name == 'chat' and not self.chat_ids:
+                name = 'conversation'
+            await self._request(session, name)
+
+    async def _request(self, session, name):
+        if name == 'conversation':
+            chat_id = None
+            if self.chat_ids and self.rng.random() < 0.5:
+                chat_id = self.rng.choice(self.chat_ids)
+            # Unique messages, which the response cache cannot answer.
+            self.sent += 1
+            request = session.post(f'{self.url}/conversation', json={
+                'message': f'{self.rng.choice(MESSAGES)} #{self.sent}',
+                'chat_id': chat_id,
+            })
+        elif name == 'history':
+            request = session.get(f'{self.url}/history')
+        else:
+            request = session.get(
+                f'{self.url}/{self.rng.choice(self.chat_ids)}')
+
+        started = time.perf_counter()
+        try:
+            async with request as response:
+                body = await response.read()
+                failed = response.status >= 400
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            failed = True
+
+        latency = time.perf_counter() - started
+        if failed:
+            self.errors[name] += 1
+            return
+
+        self.latencies[name].append(latency)
+        if name == 'conversation':
+            chat_id = json.loads(body).get('chat_id')
+            if chat_id is not None and chat_id not in self.chat_ids:
+                self.chat_ids.append(chat_id)
+
+    def report(self, elapsed):
+        def stats(latencies, errors):
+            latencies = sorted(latencies)
+            count = len(latencies) + errors
+            return {
+                'requests': count,
+                'errors': errors,
+                'error_rate': errors / count if count else 0.0,
+                'throughput': count / elapsed,
+                'latency_ms': {
+                    'p50': _ms(percentile(latencies, 50)),
+                    'p95': _ms(percentile(latencies, 95)),
+                    'p99': _ms(percentile(latencies, 99)),
+                    'mean': _ms(sum(latencies) / len(latencies)
+                                if latencies else None),
+                    'max': _ms(latencies[-1] if latencies else None),
+                },
+            }
+
+        requests = {
+            name: stats(self.latencies[name], self.errors[name])
+            for name in self.mix
+        }
+        requests['total'] = stats(
+            [latency for name in self.mix for latency in self.latencies[name]],
+            sum(self.errors.values()),
+        )
+        return requests
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(address, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'The server exited with {process.returncode}')
+        try:
+            with socket.create_connection(address, timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'The server did not start within {timeout}s')
+
+
+@contextmanager
+def local_server(args):
+    """Run a Promptly server and a fake OpenAI API, for the duration."""
+    env = dict(os.environ)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        api_port, app_port = free_port(), free_port()
+        env.update({
+            'PYTHONPATH': BACKEND_DIR,
+            'DEV_DATABASE_URL':
+                f'sqlite:///{os.path.join(tmp_dir, "loadtest.sqlite3")}',
+            'OPENAI_API_BASE': f'http://127.0.0.1:{api_port}/v1',
+            'OPENAI_API_KEY': 'sk-fake',
+            'PROMPTLY_CONFIG': 'development',
+        })
+
+        def flask(*command):
+            return [sys.executable, '-m', 'flask', '--app', 'runner:app',
+                    *command]
+
+        for command in (('db', 'upgrade'), ('seed',)):
+            subprocess.run(flask(*command), env=env, cwd=BACKEND_DIR,
+                           check=True, capture_output=True)
+
+        fake_api = [
+            sys.executable, '-m', 'tests.fake_openai',
+            '--port', str(api_port),
+            '--latency', args.latency,
+            '--error-rate', str(args.error_rate),
+            '--completion-tokens', str(args.completion_tokens),
+            '--seed', str(args.seed),
+        ]
+        if args.tokens_per_second:
+            fake_api += ['--tokens-per-second', str(args.tokens_per_second)]
+        app = flask('run', '--port', str(app_port), '--with-threads')
+
+        processes = []
+        try:
+            for command, port in ((fake_api, api_port), (app, app_port)):
+                process = subprocess.Popen(
+                    command, env=env, cwd=BACKEND_DIR,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                processes.append(process)
+                wait_for(('127.0.0.1', port), process)
+            yield f'http://127.0.0.1:{app_port}'
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait(10)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR,
+            check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before, after, threshold):
+    """Print the changes between two results, and tell if any regressed."""
+    regressed = False
+    print(f'{"request":<14}{"metric":<12}{"before":>12}{"after":>12}'
+          f'{"change":>10}')
+    for name, stats in after['requests'].items():
+        previous = before['requests'].get(name)
+        if previous is None:
+            continue
+
+        rows = [
+            (f'{q} ms', previous['latency_ms'][q], stats['latency_ms'][q])
+            for q in ('p50', 'p95', 'p99')
+        ] + [
+            ('req/s', previous['throughput'], stats['throughput']),
+            ('errors %', previous['error_rate'] * 100,
+             stats['error_rate'] * 100),
+        ]
+        for metric, old, new in rows:
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else 0.0
+            flag = ''
+            if (metric == 'p95 ms' and change > threshold
+                    or metric == 'req/s' and change < -threshold
+                    or metric == 'errors %' and new - old > 1):
+                flag, regressed = ' !', True
+            print(f'{name:<14}{metric:<12}{old:>12.2f}{new:>12.2f}'
+                  f'{change:>+9.1%}{flag}')
+
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='the URL of a running server; a local '
+                                      'one is started if not given')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help=f'the weights of the requests '
+                             f'(default: {DEFAULT_MIX})')
+    parser.add_argument('--output', help='the JSON file of the results '
+                                         '(default: stdout)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--latency', default='lognormal:0.5,0.5',
+                        help='the latency distribution of the fake API')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='the error rate of the fake API')
+    parser.add_argument('--tokens-per-second', type=float,
+                        help='the generation speed of the fake API')
+    parser.add_argument('--completion-tokens', type=int, default=60,
+                        help='the completion length of the fake API')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two results instead of running')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='the relative regression tolerated by '
+                             '--compare (default: 0.1)')
+    args = parser.parse_args()
+
+    if args.compare:
+        results = []
+        for path in args.compare:
+            with open(path, encoding='utf-8') as results_file:
+                results.append(json.load(results_file))
+        sys.exit(1 if compare(*results, args.threshold) else 0)
+
+    started_at = datetime.now(timezone.utc).isoformat()
+    server = nullcontext(args.url) if args.url else local_server(args)
+
+    with server as url:
+        load_test = LoadTest(url, args.mix, args.concurrency, args.duration,
+                             seed=args.seed)
+        elapsed = asyncio.run(load_test.run())
+
+    results = {
+        'commit': git_commit(),
+        'started_at': started_at,
+        'url': args.url,
+        'duration': elapsed,
+        'concurrency': args.concurrency,
+        'mix': args.mix,
+        'fake_api': None if args.url else {
+            'latency': args.latency,
+            'error_rate': args.error_rate,
+            'tokens_per_second': args.tokens_per_second,
+            'completion_tokens': args.completion_tokens,
+        },
+        'requests': load_test.report(elapsed),
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
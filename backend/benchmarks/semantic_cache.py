@@ -0,0 +1,108 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""Benchmark the vector index of the semantic cache.
+
+Measures, for an index of ``--size`` random unit vectors:
+
+- the time to build the index in batches, as on a rebuild;
+- the time to add single vectors, as on each new answer;
+- the memory allocated by the index;
+- the latency percentiles of nearest neighbor lookups.
+
+Usage::
+
+    $ python benchmarks/semantic_cache.py --size 1000000
+    $ python benchmarks/semantic_cache.py --size 1000000 --ann
+
+The results are printed as JSON.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The services are imported through the API package, which depends on them.
+import promptly.api  # noqa: E402, F401, I100
+from promptly.services.semantic_cache import (  # noqa: E402
+    create_index,
+    HashingVectorizer,
+)
+
+
+def random_unit_vectors(rng, count, dim):
+    vectors = rng.standard_normal((count, dim), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def percentile(samples, q):
+    return float(np.percentile(samples, q) * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=1_000_000)
+    parser.add_argument('--dim', type=int, default=HashingVectorizer().dim)
+    parser.add_argument('--batch-size', type=int, default=10_000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--single-adds', type=int, default=1000)
+    parser.add_argument('--ann', action='store_true',
+                        help='use the approximate index (requires hnswlib)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    index = create_index(args.dim, ann=args.ann)
+
+    started = time.perf_counter()
+    for start in range(0, args.size, args.batch_size):
+        count = min(args.batch_size, args.size - start)
+        index.add(np.arange(start, start + count),
+                  random_unit_vectors(rng, count, args.dim))
+    build_seconds = time.perf_counter() - started
+
+    single = random_unit_vectors(rng, args.single_adds, args.dim)
+    started = time.perf_counter()
+    for i, vector in enumerate(single):
+        index.add(np.array([args.size + i]), vector[np.newaxis])
+    single_add_seconds = (time.perf_counter() - started) / args.single_adds
+
+    latencies = []
+    for query in random_unit_vectors(rng, args.queries, args.dim):
+        started = time.perf_counter()
+        index.search(query)
+        latencies.append(time.perf_counter() - started)
+
+    vectorizer = HashingVectorizer(args.dim)
+    started = time.perf_counter()
+    for _ in range(args.queries):
+        vectorizer.transform('What is the capital of France, and why?')
+    embed_seconds = (time.perf_counter() - started) / args.queries
+
+    print(json.dumps({
+        'index': type(index).__name__,
+        'size': len(index),
+        'dim': args.dim,
+        'build_seconds': round(build_seconds, 3),
+        'single_add_ms': round(single_add_seconds * 1000, 4),
+        'memory_mb': round(getattr(index, 'nbytes', 0) / 2 ** 20, 1),
+        'embed_ms': round(embed_seconds * 1000, 4),
+        'lookup_ms': {
+            'p50': round(percentile(latencies, 50), 3),
+            'p95': round(percentile(latencies, 95), 3),
+            'p99': round(percentile(latencies, 99), 3),
+        },
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
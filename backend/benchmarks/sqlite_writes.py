@@ -0,0 +1,187 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""Benchmark concurrent writes to a SQLite database.
+
+Parallel writers, one process each like the workers of gunicorn, send
+``POST /conversation`` requests for a given duration to their own instance
+of Promptly, all of them sharing a scratch SQLite database and a fake OpenAI
+API answering at once. Each writer starts a chat, then goes on in it, which
+writes two transactions per request.
+
+The throughput, the error rate and the latency percentiles are measured for
+every number of writers, once with the SQLite pragmas of the configuration
+(``tuned``) and once with the defaults of SQLite (``default``), each on a
+fresh database.
+
+Usage::
+
+    $ python benchmarks/sqlite_writes.py --writers 1,4,8 --duration 10
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = ('default', 'tuned')
+
+
+def percentile(sorted_samples, q):
+    """Get a percentile of sorted samples, by the nearest rank method."""
+    if not sorted_samples:
+        return None
+    rank = max(1, round(q / 100 * len(sorted_samples)))
+    return sorted_samples[min(rank, len(sorted_samples)) - 1]
+
+
+def create_app(database_uri, mode):
+    from promptly.app import create_app
+    from promptly.config import DevelopmentConfig
+
+    class BenchmarkConfig(DevelopmentConfig):
+        DEBUG = False
+        SQLALCHEMY_DATABASE_URI = database_uri
+        SQLALCHEMY_RECORD_QUERIES = False
+        if mode == 'default':
+            SQLITE_PRAGMAS = {}
+
+    return create_app(BenchmarkConfig)
+
+
+def writer(number, database_uri, mode, barrier, duration, results):
+    """Send requests for a duration, and put the outcomes in results."""
+    app = create_app(database_uri, mode)
+    client = app.test_client()
+    latencies, errors, chat_id = [], 0, None
+
+    # The clock starts once all the writers are ready.
+    barrier.wait()
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        message = f'Writer {number}, message {len(latencies) + errors}'
+        started = time.perf_counter()
+        try:
+            response = client.post('/conversation', json={
+                'message': message,
+                'chat_id': chat_id,
+            })
+            failed = response.status_code >= 400
+        except Exception:  # noqa: B902 - e.g. "database is locked"
+            failed = True
+
+        if failed:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+        chat_id = response.json['chat_id']
+
+    results.put((latencies, errors))
+
+
+def run(writers, duration, mode, tmp_dir):
+    """Run the writers against a fresh database, and get their stats."""
+    path = os.path.join(tmp_dir, f'{mode}-{writers}.sqlite3')
+    database_uri = f'sqlite:///{path}'
+
+    from flask_migrate import upgrade
+    app = create_app(database_uri, mode)
+    with app.app_context():
+        upgrade(os.path.join(BACKEND_DIR, 'migrations'))
+
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(writers + 1)
+    results = context.Queue()
+    processes = [
+        context.Process(target=writer, args=(
+            number, database_uri, mode, barrier, duration, results))
+        for number in range(writers)
+    ]
+    for process in processes:
+        process.start()
+    barrier.wait()
+
+    latencies, errors = [], 0
+    for _ in processes:
+        writer_latencies, writer_errors = results.get()
+        latencies += writer_latencies
+        errors += writer_errors
+    for process in processes:
+        process.join()
+
+    latencies.sort()
+    count = len(latencies) + errors
+    return {
+        'writers': writers,
+        'mode': mode,
+        'requests': count,
+        'errors': errors,
+        'error_rate': errors / count if count else 0.0,
+        'throughput': len(latencies) / duration,
+        'latency_ms': {
+            q: round(percentile(latencies, int(q[1:])) * 1000, 3)
+            if latencies else None
+            for q in ('p50', 'p95', 'p99')
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--writers', default='1,4,8',
+                        help='the numbers of parallel writers, '
+                             'comma-separated (default: 1,4,8)')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--mode', choices=MODES, action='append',
+                        help='the pragmas to run with (default: both)')
+    parser.add_argument('--output', help='the JSON file of the results')
+    args = parser.parse_args()
+
+    sys.path.insert(0, BACKEND_DIR)
+    from tests.fake_openai import FakeOpenAI
+
+    fake_api = FakeOpenAI(completion_tokens=20)
+    fake_api.start()
+    # The writers inherit the environment, and only call the fake API.
+    os.environ.update({
+        'OPENAI_API_BASE': fake_api.url,
+        'OPENAI_API_KEY': 'sk-fake',
+        'PROMPTLY_OPENAI_RPM': '0',
+        'PROMPTLY_OPENAI_TPM': '0',
+    })
+
+    results = []
+    print(f'{"writers":>8}{"mode":>9}{"req/s":>10}{"errors %":>10}'
+          f'{"p50 ms":>10}{"p95 ms":>10}')
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for writers in map(int, args.writers.split(',')):
+                for mode in args.mode or MODES:
+                    stats = run(writers, args.duration, mode, tmp_dir)
+                    results.append(stats)
+                    latency = stats['latency_ms']
+                    print(f'{writers:>8}{mode:>9}'
+                          f'{stats["throughput"]:>10.1f}'
+                          f'{stats["error_rate"] * 100:>10.2f}'
+                          f'{latency["p50"] or 0:>10.1f}'
+                          f'{latency["p95"] or 0:>10.1f}', flush=True)
+    finally:
+        fake_api.stop()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({'duration': args.duration, 'results': results}, file,
+                      indent=2)
+
+
+if __name__ == '__main__':
+    main()
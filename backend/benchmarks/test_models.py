@@ -0,0 +1,61 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+import itertools
+from datetime import datetime, timedelta
+
+from promptly.chat.template_filters import human_readable_date
+from promptly.models import Chat
+
+
+def test_human_readable_date(benchmark):
+    now = datetime.now()
+    dates = [now - timedelta(days=days) for days in range(0, 730, 7)]
+
+    def render():
+        return [human_readable_date(date) for date in dates]
+
+    labels = benchmark(render)
+
+    assert labels[0] == 'Today'
+    assert labels[-1] == 'Older'
+
+
+def test_chat_teaser(benchmark, chats):
+    chat = Chat.get(chats(1, entries_per_chat=50)[0])
+
+    teaser = benchmark(chat.teaser)
+
+    assert 0 < len(teaser) <= 150
+
+
+def test_chat_exists(benchmark, chats):
+    chat_ids = chats(1000)
+
+    assert benchmark(Chat.exists, chat_ids[500])
+    assert not Chat.exists(chat_ids[-1] + 1)
+
+
+def test_create(benchmark, app):
+    titles = (f'Chat {i}' for i in itertools.count())
+
+    chat = benchmark(lambda: Chat.create(title=next(titles)))
+
+    assert Chat.exists(chat.id)
+
+
+def test_save(benchmark, chats):
+    chat = Chat.get(chats(1)[0])
+    titles = (f'Chat {i}' for i in itertools.count())
+
+    def rename():
+        chat.title = next(titles)
+        chat.save()
+
+    benchmark(rename)
+
+    assert Chat.get(chat.id).title.startswith('Chat ')
@@ -0,0 +1,33 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+from promptly.models import db
+from tests.seeder import seed
+
+
+def test_history(benchmark, client, chats):
+    chats(10000, entries_per_chat=1)
+
+    response = benchmark(client.get, '/history')
+
+    assert response.status_code == 200
+
+
+def test_chat(benchmark, client, chats):
+    chat_id = chats(1, entries_per_chat=5000)[0]
+
+    response = benchmark(client.get, f'/{chat_id}')
+
+    assert response.status_code == 200
+
+
+def test_seed(benchmark, app):
+    def run():
+        seed(chats_count=100, entries_per_chat=10)
+        db.session.remove()
+
+    benchmark.pedantic(run, rounds=3)
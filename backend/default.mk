@@ -23,6 +23,12 @@ INSTANCE_DIR = ./instance
 PYLINT_FLAGS ?=
 FLAKE8_FLAGS ?= --show-source --statistics
 PYTHON_FLAGS ?= -W always
+# The baselines depend on the machine they are saved on, hence not committed.
+BENCH_STORAGE ?= benchmarks/baselines
+BENCH_FLAGS ?= --benchmark-storage=$(BENCH_STORAGE) --benchmark-sort=name
+
+# The slowdown of the median of a benchmark failing "make bench".
+BENCH_THRESHOLD ?= 10%
 
 export SQLALCHEMY_WARN_20 ?= 1
 
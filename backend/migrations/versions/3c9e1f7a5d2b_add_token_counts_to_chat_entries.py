@@ -0,0 +1,47 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""Add token counts to chat entries
+
+Revision ID: 3c9e1f7a5d2b
+Revises: e744793acb1c
+Create Date: 2023-11-06 10:12:38.271904
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9e1f7a5d2b'
+down_revision = 'e744793acb1c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('chat_entries', schema=None) as batch_op:
+        batch_op.add_column(
+            sa.Column('token_count', sa.Integer(), nullable=True))
+        batch_op.add_column(
+            sa.Column('token_encoding', sa.String(length=32), nullable=True))
+        batch_op.add_column(
+            sa.Column('model', sa.String(length=64), nullable=True))
+        batch_op.add_column(
+            sa.Column('prompt_tokens', sa.Integer(), nullable=True))
+        batch_op.add_column(
+            sa.Column('completion_tokens', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('chat_entries', schema=None) as batch_op:
+        batch_op.drop_column('completion_tokens')
+        batch_op.drop_column('prompt_tokens')
+        batch_op.drop_column('model')
+        batch_op.drop_column('token_encoding')
+        batch_op.drop_column('token_count')
@@ -0,0 +1,133 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""Add chat entries full-text index
+
+Revision ID: 8d4b2e6f0a17
+Revises: 3c9e1f7a5d2b
+Create Date: 2023-11-08 14:27:05.118342
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8d4b2e6f0a17'
+down_revision = '3c9e1f7a5d2b'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def populate(statement):
+    """Run a statement over the IDs of chat entries, batch by batch."""
+    conn = op.get_bind()
+    last_id = 0
+    while True:
+        upper = conn.execute(
+            sa.text(
+                'SELECT MAX(id) FROM (SELECT id FROM chat_entries '
+                'WHERE id > :last_id ORDER BY id LIMIT :limit) AS batch'
+            ),
+            {'last_id': last_id, 'limit': BATCH_SIZE},
+        ).scalar()
+        if upper is None:
+            return
+
+        conn.execute(sa.text(statement), {'lower': last_id, 'upper': upper})
+        last_id = upper
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'sqlite':
+        op.execute(
+            'CREATE VIRTUAL TABLE chat_entries_fts USING fts5('
+            'content, '
+            "content='chat_entries', "
+            "content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+        op.execute(
+            'CREATE TRIGGER chat_entries_fts_ai AFTER INSERT ON chat_entries '
+            'BEGIN '
+            'INSERT INTO chat_entries_fts(rowid, content) '
+            'VALUES (new.id, new.content); '
+            'END'
+        )
+        op.execute(
+            'CREATE TRIGGER chat_entries_fts_ad AFTER DELETE ON chat_entries '
+            'BEGIN '
+            'INSERT INTO chat_entries_fts(chat_entries_fts, rowid, content) '
+            "VALUES ('delete', old.id, old.content); "
+            'END'
+        )
+        op.execute(
+            'CREATE TRIGGER chat_entries_fts_au '
+            'AFTER UPDATE OF content ON chat_entries '
+            'BEGIN '
+            'INSERT INTO chat_entries_fts(chat_entries_fts, rowid, content) '
+            "VALUES ('delete', old.id, old.content); "
+            'INSERT INTO chat_entries_fts(rowid, content) '
+            'VALUES (new.id, new.content); '
+            'END'
+        )
+        populate(
+            'INSERT INTO chat_entries_fts(rowid, content) '
+            'SELECT id, content FROM chat_entries '
+            'WHERE id > :lower AND id <= :upper'
+        )
+
+    elif dialect == 'postgresql':
+        op.add_column(
+            'chat_entries',
+            sa.Column(
+                'search_vector',
+                sa.dialects.postgresql.TSVECTOR(),
+                nullable=True,
+            ),
+        )
+        op.execute(
+            'CREATE TRIGGER chat_entries_search_vector_update '
+            'BEFORE INSERT OR UPDATE OF content ON chat_entries '
+            'FOR EACH ROW EXECUTE FUNCTION '
+            "tsvector_update_trigger(search_vector, 'pg_catalog.english', "
+            'content)'
+        )
+        populate(
+            'UPDATE chat_entries '
+            "SET search_vector = to_tsvector('english', content) "
+            'WHERE id > :lower AND id <= :upper'
+        )
+        op.create_index(
+            'ix_chat_entries_search_vector',
+            'chat_entries',
+            ['search_vector'],
+            postgresql_using='gin',
+        )
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'sqlite':
+        op.execute('DROP TRIGGER IF EXISTS chat_entries_fts_au')
+        op.execute('DROP TRIGGER IF EXISTS chat_entries_fts_ad')
+        op.execute('DROP TRIGGER IF EXISTS chat_entries_fts_ai')
+        op.execute('DROP TABLE IF EXISTS chat_entries_fts')
+
+    elif dialect == 'postgresql':
+        op.drop_index('ix_chat_entries_search_vector', 'chat_entries')
+        op.execute(
+            'DROP TRIGGER IF EXISTS chat_entries_search_vector_update '
+            'ON chat_entries'
+        )
+        op.drop_column('chat_entries', 'search_vector')
@@ -0,0 +1,80 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""Add foreign key indexes
+
+Revision ID: e744793acb1c
+Revises: 26415bbe32da
+Create Date: 2023-11-02 09:41:12.503112
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e744793acb1c'
+down_revision = '26415bbe32da'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('chat_entries', schema=None) as batch_op:
+        batch_op.create_index(
+            'ix_chat_entries_chat_id_created_at',
+            ['chat_id', 'created_at', 'id'],
+            unique=False
+        )
+
+    with op.batch_alter_table('prompt_rules', schema=None) as batch_op:
+        batch_op.create_index(
+            batch_op.f('ix_prompt_rules_prompt_id'),
+            ['prompt_id'],
+            unique=False
+        )
+
+    with op.batch_alter_table('prompt_references', schema=None) as batch_op:
+        batch_op.create_index(
+            batch_op.f('ix_prompt_references_prompt_id'),
+            ['prompt_id'],
+            unique=False
+        )
+
+    with op.batch_alter_table('prompt_criteria', schema=None) as batch_op:
+        batch_op.create_index(
+            batch_op.f('ix_prompt_criteria_prompt_id'),
+            ['prompt_id'],
+            unique=False
+        )
+
+    with op.batch_alter_table(
+            'prompt_reference_key_insights', schema=None) as batch_op:
+        batch_op.create_index(
+            batch_op.f('ix_prompt_reference_key_insights_reference_id'),
+            ['reference_id'],
+            unique=False
+        )
+
+
+def downgrade():
+    with op.batch_alter_table(
+            'prompt_reference_key_insights', schema=None) as batch_op:
+        batch_op.drop_index(
+            batch_op.f('ix_prompt_reference_key_insights_reference_id'))
+
+    with op.batch_alter_table('prompt_criteria', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_prompt_criteria_prompt_id'))
+
+    with op.batch_alter_table('prompt_references', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_prompt_references_prompt_id'))
+
+    with op.batch_alter_table('prompt_rules', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_prompt_rules_prompt_id'))
+
+    with op.batch_alter_table('chat_entries', schema=None) as batch_op:
+        batch_op.drop_index('ix_chat_entries_chat_id_created_at')
@@ -0,0 +1,304 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""
+Batch completions.
+------------------
+
+This module runs many completion requests read from a JSONL source, with a
+bounded number of them in flight at a time, and yields their results as they
+complete. It backs both the ``POST /batch`` endpoint and the
+``flask batch-eval`` command.
+
+Each line of the source is a JSON object describing one item:
+
+.. code-block:: json
+
+    {"id": "q1", "message": "What is 2+2?", "prompt_id": 3}
+    {"id": "q2", "messages": [{"role": "user", "content": "Hi"}]}
+
+- ``id``: the ID of the item, which defaults to its line number;
+- ``message`` or ``messages``: the user's message, or the whole list of
+  messages sent to the model;
+- ``prompt_id``: the ID of a :class:`~promptly.models.Prompt`, whose prompt is
+  sent as the system message;
+- ``model``, ``temperature``, ``max_tokens``: overrides of the defaults.
+
+Each result is a JSON object with the ``id`` of the item and its ``status``:
+``ok`` along with the ``content`` and ``usage`` of the response, ``error``
+along with the ``error`` message, or ``skipped`` if the item was completed
+by a previous run. The ``usage`` of a response served from the response
+cache is ``null``, since it was not billed.
+
+Runs are resumable: the IDs of the completed items are appended to a
+:class:`.Checkpoint` file, and skipped when the same source is run again.
+
+"""
+
+import json
+import logging
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, \
+    wait
+from os import environ as env
+from typing import Any, Dict, Iterable, Iterator, Optional, Set, Tuple
+
+import openai
+
+from promptly.api.limiter import OverloadedError
+from promptly.api.openai_eval import completion
+from promptly.models import db, Prompt
+from promptly.tokenizer import default_model
+
+logger = logging.getLogger(__name__)
+
+PROMPTLY_BATCH_CONCURRENCY: int = int(
+    env.get('PROMPTLY_BATCH_CONCURRENCY', 4))
+"""The default number of batch items in flight at a time.
+
+This constant uses the value of the ``PROMPTLY_BATCH_CONCURRENCY``
+environment variable, if set, or defaults to 4 items.
+"""
+
+PROMPTLY_BATCH_MAX_CONCURRENCY: int = int(
+    env.get('PROMPTLY_BATCH_MAX_CONCURRENCY', 32))
+"""The maximum number of batch items in flight at a time a request may ask.
+
+This constant uses the value of the ``PROMPTLY_BATCH_MAX_CONCURRENCY``
+environment variable, if set, or defaults to 32 items.
+"""
+
+PROMPTLY_BATCH_DIR: str = env.get('PROMPTLY_BATCH_DIR', '')
+"""The directory of the checkpoint files of the batch endpoint.
+
+This constant uses the value of the ``PROMPTLY_BATCH_DIR`` environment
+variable, if set. Otherwise, the ``batch`` directory of the instance folder
+is used.
+"""
+
+OVERRIDABLE_PARAMS = ('model', 'temperature', 'max_tokens')
+"""The request parameters a batch item may override."""
+
+
+class BatchItemError(ValueError):
+    """Raised when a batch item is invalid."""
+
+    def __init__(self, message: str, item_id: Optional[str] = None):
+        """Initialize the error.
+
+        :param str message: The error message.
+        :param item_id: The ID of the item, if it could be read.
+        :type item_id: str, optional
+        """
+        super().__init__(message)
+        self.item_id = item_id
+
+
+class Checkpoint:
+    """The set of the IDs of the completed items of a batch.
+
+    IDs are appended to a file, one per line, as soon as the items are
+    completed, so that the set survives a crash of the process.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """Load the checkpoint.
+
+        :param path: The path of the checkpoint file. The checkpoint is only
+            kept in memory if not given.
+        :type path: str, optional
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._completed: Set[str] = set()
+
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as checkpoint_file:
+                self._completed.update(
+                    line.rstrip('\n') for line in checkpoint_file if line)
+
+    def __contains__(self, item_id: str) -> bool:
+        """Tell whether an item has been completed."""
+        return item_id in self._completed
+
+    def __len__(self) -> int:
+        """Get the number of completed items."""
+        return len(self._completed)
+
+    def add(self, item_id: str):
+        """Record an item as completed.
+
+        :param str item_id: The ID of the item.
+        """
+        with self._lock:
+            self._completed.add(item_id)
+            if self.path:
+                with open(self.path, 'a', encoding='utf-8') as checkpoint_file:
+                    checkpoint_file.write(f'{item_id}\n')
+
+
+def parse_item(line: str, line_number: int) -> Dict[str, Any]:
+    """Parse a line of a batch source.
+
+    :param str line: The JSON object describing the item.
+    :param int line_number: The 1-based number of the line.
+    :return: The item, with its ``id`` as a string.
+    :rtype: dict
+    :raises BatchItemError: If the line does not describe a valid item.
+    """
+    try:
+        item = json.loads(line)
+    except ValueError as exc:
+        raise BatchItemError(f'Invalid JSON: {exc}') from exc
+
+    if not isinstance(item, dict):
+        raise BatchItemError('An item must be a JSON object')
+
+    item['id'] = str(item.get('id', line_number))
+    if 'messages' not in item and 'message' not in item:
+        raise BatchItemError('An item requires a message or messages',
+                             item_id=item['id'])
+
+    return item
+
+
+def build_params(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the completion request parameters of a batch item.
+
+    :param dict item: The item.
+    :return: The parameters of :func:`.completion`.
+    :rtype: dict
+    :raises BatchItemError: If the prompt of the item does not exist.
+    """
+    messages = item.get('messages') or [
+        {'role': 'user', 'content': str(item['message'])},
+    ]
+
+    prompt_id = item.get('prompt_id')
+    if prompt_id is not None:
+        prompt = db.session.get(Prompt, prompt_id)
+        if prompt is None:
+            raise BatchItemError(f'Prompt {prompt_id} does not exist',
+                                 item_id=item.get('id'))
+        messages = [{'role': 'system', 'content': prompt.prompt}, *messages]
+
+    params = {
+        'model': default_model(),
+        'temperature': 0,
+        'messages': messages,
+    }
+    params.update(
+        (name, item[name]) for name in OVERRIDABLE_PARAMS if name in item)
+    return params
+
+
+def run_item(item_id: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    """Complete a batch item.
+
+    :param str item_id: The ID of the item.
+    :param dict params: The parameters of :func:`.completion`.
+    :return: The result of the item.
+    :rtype: dict
+    """
+    try:
+        response = completion(**params)
+    except (openai.error.OpenAIError, OverloadedError) as exc:
+        logger.warning('Batch item %s failed: %s', item_id, exc)
+        return {'id': item_id, 'status': 'error', 'error': str(exc)}
+
+    return {
+        'id': item_id,
+        'status': 'ok',
+        'content': response['choices'][0]['message']['content'],
+        'usage': response.get('usage'),
+    }
+
+
+def run_batch(lines: Iterable[str], checkpoint: Checkpoint,
+              concurrency: int = PROMPTLY_BATCH_CONCURRENCY
+              ) -> Iterator[Dict[str, Any]]:
+    """Complete the items of a batch source, yielding results as they come.
+
+    The source is read lazily: at most ``concurrency`` items are in flight,
+    and as many wait to be picked up, so that the memory used does not
+    depend on the size of the source. Items are parsed, and their prompts
+    loaded, in the calling thread; only the OpenAI calls run in the pool.
+
+    Successful items are recorded in the checkpoint. Failed items are not,
+    so that they are retried by the next run.
+
+    :param lines: The lines of the batch source.
+    :param Checkpoint checkpoint: The checkpoint of the batch.
+    :param int concurrency: The number of items in flight at a time.
+    :return: An iterator over the results, in completion order.
+    :rtype: Iterator[dict]
+    """
+    pending: Set[Future] = set()
+
+    def drain(block: bool) -> Iterator[Dict[str, Any]]:
+        done, _ = wait(
+            pending,
+            timeout=None if block else 0,
+            return_when=FIRST_COMPLETED,
+        )
+        for future in done:
+            pending.discard(future)
+            result = future.result()
+            if result['status'] == 'ok':
+                checkpoint.add(result['id'])
+            yield result
+
+    with ThreadPoolExecutor(max_workers=concurrency,
+                            thread_name_prefix='promptly-batch') as executor:
+        try:
+            for item_id, params, error in _read_items(lines, checkpoint):
+                if error is not None:
+                    yield error
+                    continue
+
+                pending.add(executor.submit(run_item, item_id, params))
+                yield from drain(block=len(pending) >= 2 * concurrency)
+
+            while pending:
+                yield from drain(block=True)
+        finally:
+            # The consumer went away: do not start the queued items.
+            for future in pending:
+                future.cancel()
+
+
+def _read_items(lines: Iterable[str], checkpoint: Checkpoint
+                ) -> Iterator[Tuple[str, Optional[Dict[str, Any]],
+                                    Optional[Dict[str, Any]]]]:
+    """Parse the items of a batch source.
+
+    :return: An iterator over ``(id, params, error)`` tuples, where
+        ``params`` is ``None`` if the item is not to be run, and ``error``
+        is then the result to report for it.
+    """
+    for line_number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+
+        item_id = str(line_number)
+        try:
+            item = parse_item(line, line_number)
+            item_id = item['id']
+            if item_id in checkpoint:
+                yield item_id, None, {'id': item_id, 'status': 'skipped'}
+                continue
+            yield item_id, build_params(item), None
+        except BatchItemError as exc:
+            item_id = exc.item_id or item_id
+            yield item_id, None, {
+                'id': item_id,
+                'status': 'error',
+                'error': str(exc),
+            }
@@ -0,0 +1,280 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""
+Circuit breaking for upstream calls.
+------------------------------------
+
+This module provides the :class:`.CircuitBreaker` class, which stops calling
+an upstream that is failing, so that callers fail fast instead of waiting
+through timeouts and retries:
+
+- while **closed**, calls go through, and their outcomes are recorded over a
+  sliding time window. Once enough calls were made, and the ratio of failed
+  or slow ones reaches a threshold, the circuit opens;
+- while **open**, calls are rejected at once with a
+  :class:`.CircuitOpenError`. After a cool-down period the circuit becomes
+  half-open;
+- while **half-open**, a single probe call goes through: the circuit closes
+  if it succeeds, and opens again otherwise.
+
+State changes are logged, and exposed as metrics.
+
+"""
+
+import logging
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from os import environ as env
+from typing import Callable, Tuple, Type
+
+from promptly.api.limiter import OverloadedError
+from promptly.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+PROMPTLY_CIRCUIT_FAILURE_RATE: float = float(
+    env.get('PROMPTLY_CIRCUIT_FAILURE_RATE', 0.5))
+"""The ratio of failed or slow OpenAI API calls opening the circuit.
+
+This constant uses the value of the ``PROMPTLY_CIRCUIT_FAILURE_RATE``
+environment variable, if set, or defaults to 0.5.
+"""
+
+PROMPTLY_CIRCUIT_SLOW_CALL: float = float(
+    env.get('PROMPTLY_CIRCUIT_SLOW_CALL', 20))
+"""The duration, in seconds, beyond which an OpenAI API call is slow.
+
+This constant uses the value of the ``PROMPTLY_CIRCUIT_SLOW_CALL``
+environment variable, if set, or defaults to 20 seconds.
+"""
+
+PROMPTLY_CIRCUIT_OPEN_SECONDS: float = float(
+    env.get('PROMPTLY_CIRCUIT_OPEN_SECONDS', 30))
+"""The time, in seconds, the circuit stays open before a probe call.
+
+This constant uses the value of the ``PROMPTLY_CIRCUIT_OPEN_SECONDS``
+environment variable, if set, or defaults to 30 seconds.
+"""
+
+CLOSED = 'closed'
+"""The state of a circuit letting the calls through."""
+
+HALF_OPEN = 'half_open'
+"""The state of a circuit letting a probe call through."""
+
+OPEN = 'open'
+"""The state of a circuit rejecting the calls."""
+
+STATES = (CLOSED, HALF_OPEN, OPEN)
+"""The states, in the order of the values of the state gauge."""
+
+
+class CircuitOpenError(OverloadedError):
+    """Raised when a call is rejected because the circuit is open."""
+
+
+def requires_upstream(view: Callable) -> Callable:
+    """Mark a view as unable to answer without calling the upstream.
+
+    Such views are rejected at once while the circuit of the upstream is
+    open, see :func:`promptly.main.views.maintained`, rather than after
+    having done part of their work. Views which may answer from a cache
+    should not be marked.
+
+    :param view: The view function.
+    :return: The same view function.
+    """
+    view.requires_upstream = True
+    return view
+
+
+class CircuitBreaker:
+    """A circuit breaker driven by the failure rate over a sliding window.
+
+    The breaker is thread-safe and shared by all the threads of the process.
+    Its state is exposed as the ``{name}_circuit_state`` gauge (0 closed,
+    1 half-open, 2 open), and its transitions are counted in the
+    ``{name}_circuit_transitions_total`` metric.
+
+    Usage::
+
+        breaker = CircuitBreaker('upstream', failures=(ConnectionError,))
+        with breaker.guard():
+            call_upstream()
+
+    """
+
+    def __init__(self, name: str,
+                 failures: Tuple[Type[BaseException], ...],
+                 failure_rate: float = PROMPTLY_CIRCUIT_FAILURE_RATE,
+                 slow_call: float = PROMPTLY_CIRCUIT_SLOW_CALL,
+                 open_seconds: float = PROMPTLY_CIRCUIT_OPEN_SECONDS,
+                 window: float = 60, min_calls: int = 10,
+                 clock: Callable[[], float] = time.monotonic):
+        """Initialize a closed circuit.
+
+        :param str name: The name of the circuit, and the prefix of its
+            metrics.
+        :param tuple failures: The errors counted as failures. Other errors
+            are the caller's, not the upstream's.
+        :param float failure_rate: The ratio of failed or slow calls opening
+            the circuit.
+        :param float slow_call: The duration, in seconds, beyond which a
+            call is slow.
+        :param float open_seconds: The time, in seconds, the circuit stays
+            open.
+        :param float window: The duration, in seconds, of the sliding window.
+        :param int min_calls: The number of calls of the window below which
+            the circuit does not open.
+        :param clock: The function returning the current time, in seconds.
+        """
+        self.name = name
+        self.failures = failures
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.open_seconds = open_seconds
+        self.window = window
+        self.min_calls = min_calls
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        # The time and the outcome, good or bad, of the recent calls.
+        self._calls: deque = deque()
+        self._bad_calls = 0
+
+        self._state_gauge = registry.gauge(
+            f'{name}_circuit_state',
+            'State of the circuit: 0 closed, 1 half-open, 2 open.',
+        )
+        self._transitions_counter = registry.counter(
+            f'{name}_circuit_transitions_total',
+            'Number of transitions of the circuit by new state.',
+            labelnames=('state',),
+        )
+        self._rejected_counter = registry.counter(
+            f'{name}_circuit_rejected_total',
+            'Number of calls rejected by the open circuit.',
+        )
+        self._state_gauge.set(0)
+
+    @property
+    def state(self) -> str:
+        """The current state of the circuit."""
+        with self._lock:
+            return self._current_state()
+
+    @property
+    def retry_after(self) -> int:
+        """The number of seconds until the next probe call."""
+        remaining = self._opened_at + self.open_seconds - self.clock()
+        return max(1, math.ceil(remaining))
+
+    def raise_if_open(self):
+        """Fail fast if the circuit is open.
+
+        Unlike :meth:`guard`, this does not make a probe call when the
+        circuit is half-open.
+
+        :raises CircuitOpenError: If the circuit is open.
+        """
+        if self.state == OPEN:
+            self._reject()
+
+    @contextmanager
+    def guard(self):
+        """Run a call through the circuit, recording its outcome.
+
+        :raises CircuitOpenError: If the circuit is open, or if it is
+            half-open and a probe call is already in flight.
+        """
+        with self._lock:
+            state = self._current_state()
+            probe = state == HALF_OPEN and not self._probing
+            rejected = state == OPEN or (state == HALF_OPEN and not probe)
+            if probe:
+                self._probing = True
+
+        if rejected:
+            self._reject()
+
+        start = self.clock()
+        try:
+            yield
+        except self.failures:
+            self._record(probe, bad=True)
+            raise
+        except BaseException:  # noqa: B902 - re-raised below
+            # E.g. cancelled, or rejected by the upstream: only a sign of its
+            # health if it took too long, but the probe slot must be released.
+            if self.clock() - start > self.slow_call:
+                self._record(probe, bad=True)
+            elif probe:
+                with self._lock:
+                    self._probing = False
+            raise
+        else:
+            self._record(probe, bad=self.clock() - start > self.slow_call)
+
+    def _reject(self):
+        self._rejected_counter.inc()
+        raise CircuitOpenError(
+            f'The {self.name} circuit is open',
+            retry_after=self.retry_after,
+        )
+
+    def _current_state(self) -> str:
+        """Get the state, moving from open to half-open once cooled down."""
+        if (self._state == OPEN
+                and self.clock() >= self._opened_at + self.open_seconds):
+            self._transition(HALF_OPEN)
+        return self._state
+
+    def _record(self, probe: bool, bad: bool):
+        """Record the outcome of a call."""
+        with self._lock:
+            if probe:
+                self._probing = False
+                self._transition(OPEN if bad else CLOSED)
+                return
+
+            now = self.clock()
+            self._calls.append((now, bad))
+            self._bad_calls += bad
+            while self._calls and self._calls[0][0] <= now - self.window:
+                _, expired_bad = self._calls.popleft()
+                self._bad_calls -= expired_bad
+
+            if (self._state == CLOSED
+                    and len(self._calls) >= self.min_calls
+                    and self._bad_calls >= self.failure_rate
+                    * len(self._calls)):
+                self._transition(OPEN)
+
+    def _transition(self, state: str):
+        """Change the state of the circuit. The lock must be held."""
+        if state == self._state:
+            return
+
+        logger.warning('The %s circuit changed from %s to %s',
+                       self.name, self._state, state)
+        self._state = state
+        if state == OPEN:
+            self._opened_at = self.clock()
+        if state != HALF_OPEN:
+            # A new period starts from a clean window.
+            self._calls.clear()
+            self._bad_calls = 0
+
+        self._state_gauge.set(STATES.index(state))
+        self._transitions_counter.inc(state=state)
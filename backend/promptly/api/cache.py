@@ -0,0 +1,410 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""
+Response caching for deterministic completions.
+-----------------------------------------------
+
+This module provides exact-match caches for OpenAI responses. A completion
+requested with ``temperature=0`` is deterministic enough to be served again
+to anyone sending the very same request, which saves both the latency and the
+cost of the call.
+
+Requests are identified by :func:`.cache_key`, a hash of their canonical JSON
+representation. Two backends are available:
+
+- :class:`.MemoryCache`, local to the process;
+- :class:`.SQLiteCache`, stored in a SQLite database file which is shared by
+  all the processes of the host (e.g. the gunicorn workers).
+
+Both evict the least recently used responses once the size of the cache
+exceeds its byte cap, and expire responses after a time-to-live. Hits and
+misses are counted in the ``promptly_response_cache_requests_total`` metric.
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from os import environ as env
+from typing import Any, Dict, Optional
+
+from promptly.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+PROMPTLY_CACHE_BACKEND: str = env.get('PROMPTLY_CACHE_BACKEND', 'memory')
+"""The backend of the response cache: ``memory``, ``sqlite`` or ``none``.
+
+This constant uses the value of the ``PROMPTLY_CACHE_BACKEND`` environment
+variable, if set, or defaults to ``memory``.
+"""
+
+PROMPTLY_CACHE_PATH: str = env.get('PROMPTLY_CACHE_PATH', '')
+"""The path of the SQLite database file of the ``sqlite`` backend.
+
+This constant uses the value of the ``PROMPTLY_CACHE_PATH`` environment
+variable, if set. Otherwise, the ``promptly-cache.sqlite3`` file of the
+temporary directory is used.
+"""
+
+PROMPTLY_CACHE_TTL: float = float(env.get('PROMPTLY_CACHE_TTL', 86400))
+"""The time, in seconds, a response is kept in the cache.
+
+This constant uses the value of the ``PROMPTLY_CACHE_TTL`` environment
+variable, if set, or defaults to one day.
+"""
+
+PROMPTLY_CACHE_MAX_BYTES: int = int(
+    env.get('PROMPTLY_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+"""The maximum total size, in bytes, of the cached responses.
+
+This constant uses the value of the ``PROMPTLY_CACHE_MAX_BYTES`` environment
+variable, if set, or defaults to 64 MiB.
+"""
+
+EVICTION_BATCH_SIZE = 32
+"""The number of responses the SQLite cache reads per eviction query."""
+
+_requests_total = registry.counter(
+    'promptly_response_cache_requests_total',
+    'Number of response cache lookups.',
+    labelnames=('backend', 'result'),
+)
+_evictions_total = registry.counter(
+    'promptly_response_cache_evictions_total',
+    'Number of responses evicted from the response cache.',
+    labelnames=('backend',),
+)
+
+
+def cache_key(params: Dict[str, Any]) -> str:
+    """Compute the cache key of a completion request.
+
+    The key is the SHA-256 digest of the request parameters serialized as
+    canonical JSON, so that it does not depend on the order of the keys.
+
+    :param dict params: The parameters of the completion request.
+    :return: The hexadecimal digest.
+    :rtype: str
+    """
+    canonical = json.dumps(
+        params,
+        sort_keys=True,
+        separators=(',', ':'),
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def is_cacheable(params: Dict[str, Any]) -> bool:
+    """Tell whether the response to a completion request may be cached.
+
+    Only single, non-streamed completions sampled with a zero temperature
+    are deterministic enough to be reused.
+
+    :param dict params: The parameters of the completion request.
+    :rtype: bool
+    """
+    return (
+        params.get('temperature') == 0
+        and not params.get('stream')
+        and params.get('n', 1) == 1
+    )
+
+
+class ResponseCache:
+    """Base class of the response caches.
+
+    Subclasses implement :meth:`_get` and :meth:`_set` on serialized
+    responses; this class takes care of the serialization and the metrics.
+    """
+
+    backend = 'none'
+
+    def __init__(self, max_bytes: int = PROMPTLY_CACHE_MAX_BYTES,
+                 ttl: float = PROMPTLY_CACHE_TTL):
+        """Initialize the cache.
+
+        :param int max_bytes: The maximum total size of the responses.
+        :param float ttl: The time, in seconds, a response is kept.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Get a cached response.
+
+        :param str key: The key of the request.
+        :return: The response, or ``None`` if it is not cached.
+        :rtype: dict or None
+        """
+        data = self._get(key)
+        _requests_total.inc(
+            backend=self.backend,
+            result='miss' if data is None else 'hit',
+        )
+        return None if data is None else json.loads(data)
+
+    def set(self, key: str, response: Dict[str, Any]):
+        """Cache a response.
+
+        Responses larger than the cache itself are not stored.
+
+        :param str key: The key of the request.
+        :param dict response: The response.
+        """
+        data = json.dumps(response, separators=(',', ':')).encode('utf-8')
+        if len(data) <= self.max_bytes:
+            self._set(key, data)
+
+    def _get(self, key: str) -> Optional[bytes]:
+        return None
+
+    def _set(self, key: str, data: bytes):
+        pass
+
+    def _evicted(self, count: int):
+        if count:
+            _evictions_total.inc(count, backend=self.backend)
+
+
+class MemoryCache(ResponseCache):
+    """A thread-safe LRU response cache local to the process."""
+
+    backend = 'memory'
+
+    def __init__(self, max_bytes: int = PROMPTLY_CACHE_MAX_BYTES,
+                 ttl: float = PROMPTLY_CACHE_TTL):
+        """Initialize an empty cache."""
+        super().__init__(max_bytes, ttl)
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._size = 0
+
+    @property
+    def size(self) -> int:
+        """The total size, in bytes, of the cached responses."""
+        return self._size
+
+    def _get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires, data = entry
+            if expires <= time.monotonic():
+                self._remove(key)
+                return None
+
+            self._entries.move_to_end(key)
+            return data
+
+    def _set(self, key: str, data: bytes):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (time.monotonic() + self.ttl, data)
+            self._size += len(data)
+
+            evicted = 0
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                evicted += 1
+
+        self._evicted(evicted)
+
+    def _remove(self, key: str):
+        _, data = self._entries.pop(key)
+        self._size -= len(data)
+
+
+class SQLiteCache(ResponseCache):
+    """An LRU response cache stored in a SQLite database file.
+
+    The database can be shared by several processes: SQLite serializes the
+    writes, and the write-ahead log lets readers proceed concurrently.
+    Each thread uses its own connection.
+    """
+
+    backend = 'sqlite'
+
+    def __init__(self, path: str, max_bytes: int = PROMPTLY_CACHE_MAX_BYTES,
+                 ttl: float = PROMPTLY_CACHE_TTL):
+        """Initialize the cache, creating its database if needed.
+
+        :param str path: The path of the SQLite database file.
+        """
+        super().__init__(max_bytes, ttl)
+        self.path = path
+        self._local = threading.local()
+
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS response_cache ('
+                'key TEXT PRIMARY KEY, '
+                'value BLOB NOT NULL, '
+                'size INTEGER NOT NULL, '
+                'expires_at REAL NOT NULL, '
+                'accessed_at REAL NOT NULL)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS ix_response_cache_accessed_at '
+                'ON response_cache (accessed_at)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS ix_response_cache_expires_at '
+                'ON response_cache (expires_at)'
+            )
+            # The total size of the responses is kept up to date by
+            # triggers, so that it is known without scanning the table.
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS response_cache_size ('
+                'id INTEGER PRIMARY KEY CHECK (id = 1), '
+                'total INTEGER NOT NULL)'
+            )
+            conn.execute(
+                'INSERT OR IGNORE INTO response_cache_size (id, total) '
+                'SELECT 1, COALESCE(SUM(size), 0) FROM response_cache'
+            )
+            for name, event, delta in (
+                ('insert', 'INSERT', 'NEW.size'),
+                ('delete', 'DELETE', '-OLD.size'),
+                ('update', 'UPDATE OF size', 'NEW.size - OLD.size'),
+            ):
+                conn.execute(
+                    f'CREATE TRIGGER IF NOT EXISTS response_cache_{name} '
+                    f'AFTER {event} ON response_cache BEGIN '
+                    f'UPDATE response_cache_size SET total = total + {delta}; '
+                    'END'
+                )
+
+    @property
+    def size(self) -> int:
+        """The total size, in bytes, of the cached responses."""
+        with self._connect() as conn:
+            return conn.execute(
+                'SELECT total FROM response_cache_size').fetchone()[0]
+
+    def _connect(self) -> sqlite3.Connection:
+        # Connections cannot be shared across forks, nor across threads.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    'SELECT value FROM response_cache '
+                    'WHERE key = ? AND expires_at > ?',
+                    (key, now),
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        'UPDATE response_cache SET accessed_at = ? '
+                        'WHERE key = ?',
+                        (now, key),
+                    )
+        except sqlite3.Error as exc:
+            logger.warning('Failed to read the response cache: %s', exc)
+            return None
+
+        return None if row is None else bytes(row[0])
+
+    def _set(self, key: str, data: bytes):
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                # An upsert rather than INSERT OR REPLACE, whose implicit
+                # deletion would not fire the triggers of the total size.
+                conn.execute(
+                    'INSERT INTO response_cache '
+                    '(key, value, size, expires_at, accessed_at) '
+                    'VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT (key) DO UPDATE SET '
+                    'value = excluded.value, size = excluded.size, '
+                    'expires_at = excluded.expires_at, '
+                    'accessed_at = excluded.accessed_at',
+                    (key, data, len(data), now + self.ttl, now),
+                )
+                expired = conn.execute(
+                    'DELETE FROM response_cache WHERE expires_at <= ?',
+                    (now,),
+                ).rowcount
+                evicted = self._evict(conn)
+        except sqlite3.Error as exc:
+            logger.warning('Failed to write the response cache: %s', exc)
+            return
+
+        self._evicted(expired + evicted)
+
+    def _evict(self, conn: sqlite3.Connection) -> int:
+        """Remove the least recently used responses beyond the byte cap."""
+        total = conn.execute(
+            'SELECT total FROM response_cache_size').fetchone()[0]
+
+        evicted = 0
+        while total > self.max_bytes:
+            # The least recently used responses are read through the index
+            # of their access time, a batch at a time.
+            rows = conn.execute(
+                'SELECT key, size FROM response_cache '
+                'ORDER BY accessed_at LIMIT ?',
+                (EVICTION_BATCH_SIZE,),
+            ).fetchall()
+            if not rows:
+                break
+
+            keys = []
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                keys.append((key,))
+                total -= size
+
+            conn.executemany('DELETE FROM response_cache WHERE key = ?', keys)
+            evicted += len(keys)
+
+        return evicted
+
+
+def create_cache(backend: str = PROMPTLY_CACHE_BACKEND) -> ResponseCache:
+    """Create the response cache configured for the application.
+
+    :param str backend: The name of the backend.
+    :return: The response cache.
+    :rtype: ResponseCache
+    :raises ValueError: If the backend is unknown.
+    """
+    if backend == 'memory':
+        return MemoryCache()
+
+    if backend == 'sqlite':
+        path = PROMPTLY_CACHE_PATH or os.path.join(
+            tempfile.gettempdir(), 'promptly-cache.sqlite3')
+        return SQLiteCache(path)
+
+    if backend == 'none':
+        return ResponseCache()
+
+    raise ValueError(f'Unknown response cache backend: {backend}')
@@ -0,0 +1,170 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""
+Concurrency limiting for upstream calls.
+----------------------------------------
+
+This module provides the :class:`.ConcurrencyLimiter` class, a bounded
+admission queue in front of a scarce resource. At most ``max_in_flight``
+callers hold the resource at a time; up to ``max_queue`` more wait for a slot
+for at most ``queue_timeout`` seconds. Anyone else is rejected immediately
+with an :class:`.OverloadedError`, so that load is shed instead of piling up.
+
+"""
+
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from promptly.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+class OverloadedError(Exception):
+    """Raised when a request cannot be admitted because of overload.
+
+    Attributes:
+        retry_after (int): The number of seconds after which the client may
+            retry the request.
+    """
+
+    def __init__(self, message: str, retry_after: int = 1):
+        """Initialize the error with a message and a retry hint."""
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimiter:
+    """A concurrency limiter with a bounded waiting queue.
+
+    The limiter is thread-safe and shared by all the threads of the process.
+    The number of in-flight and queued callers, the time spent in the queue
+    and the number of rejections are exposed as metrics prefixed with
+    ``name``.
+
+    Usage::
+
+        limiter = ConcurrencyLimiter('upstream', max_in_flight=8,
+                                     max_queue=16, queue_timeout=5)
+        with limiter.slot():
+            call_upstream()
+
+    """
+
+    def __init__(self, name: str, max_in_flight: int, max_queue: int,
+                 queue_timeout: float):
+        """Initialize the limiter.
+
+        :param str name: The prefix of the metrics of this limiter.
+        :param int max_in_flight: The maximum number of concurrent holders.
+        :param int max_queue: The maximum number of waiting callers.
+        :param float queue_timeout: The maximum time, in seconds, a caller
+            waits in the queue.
+        """
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._queued = 0
+
+        self._in_flight_gauge = registry.gauge(
+            f'{name}_in_flight',
+            'Number of requests currently holding a slot.',
+        )
+        self._queued_gauge = registry.gauge(
+            f'{name}_queue_depth',
+            'Number of requests waiting for a slot.',
+        )
+        self._wait_histogram = registry.histogram(
+            f'{name}_queue_wait_seconds',
+            'Time spent waiting for a slot.',
+        )
+        self._rejected_counter = registry.counter(
+            f'{name}_rejected_total',
+            'Number of requests rejected because of overload.',
+            labelnames=('reason',),
+        )
+
+    @property
+    def retry_after(self) -> int:
+        """The number of seconds a rejected client should wait."""
+        return max(1, math.ceil(self.queue_timeout))
+
+    @property
+    def in_flight(self) -> int:
+        """The number of callers currently holding a slot."""
+        return self._in_flight
+
+    @property
+    def queued(self) -> int:
+        """The number of callers currently waiting for a slot."""
+        return self._queued
+
+    def acquire(self):
+        """Acquire a slot, waiting in the queue if necessary.
+
+        :raises OverloadedError: If the queue is full, or if no slot became
+            available within the queue timeout.
+        """
+        with self._cond:
+            if self._in_flight < self.max_in_flight and not self._queued:
+                self._take()
+                return
+
+            if self._queued >= self.max_queue:
+                self._reject('queue_full')
+
+            self._queued += 1
+            self._queued_gauge.set(self._queued)
+            started = time.monotonic()
+            try:
+                admitted = self._cond.wait_for(
+                    lambda: self._in_flight < self.max_in_flight,
+                    timeout=self.queue_timeout,
+                )
+            finally:
+                self._queued -= 1
+                self._queued_gauge.set(self._queued)
+                self._wait_histogram.observe(time.monotonic() - started)
+
+            if not admitted:
+                self._reject('queue_timeout')
+            self._take()
+
+    def release(self):
+        """Release a previously acquired slot."""
+        with self._cond:
+            self._in_flight -= 1
+            self._in_flight_gauge.set(self._in_flight)
+            self._cond.notify()
+
+    @contextmanager
+    def slot(self):
+        """Hold a slot for the duration of the ``with`` block."""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _take(self):
+        self._in_flight += 1
+        self._in_flight_gauge.set(self._in_flight)
+
+    def _reject(self, reason: str):
+        self._rejected_counter.inc(reason=reason)
+        logger.warning('Request rejected because of overload: %s', reason)
+        raise OverloadedError(
+            f'Too many concurrent requests ({reason})',
+            retry_after=self.retry_after,
+        )
@@ -10,61 +10,224 @@ This module provides a simplified interface to the OpenAI API.
 --------------------------------------------------------------
 """
 
+import asyncio
+import atexit
 import logging
-from typing import Any, Dict
+import time
+from contextlib import contextmanager, ExitStack
+from os import environ as env
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
 
-import backoff
+import aiohttp
 import openai
 
-from promptly.utils import threaded_execute
+from promptly.api.breaker import CircuitBreaker
+from promptly.api.cache import cache_key, create_cache, is_cacheable
+from promptly.api.limiter import ConcurrencyLimiter
+from promptly.api.ratelimit import create_rate_limiter, estimate_tokens, \
+    requested_model
+from promptly.api.retry import RetryPolicy
+from promptly.api.singleflight import SingleFlight
+from promptly.metrics import registry
+from promptly.profiling import span
+from promptly.tokenizer import count_prompt_tokens, count_tokens, \
+    default_model
+from promptly.utils import EventLoopThread, PROMPTLY_THREAD_TIMEOUT
 
 logger = logging.getLogger(__name__)
 
+PROMPTLY_OPENAI_POOL_SIZE: int = int(env.get('PROMPTLY_OPENAI_POOL_SIZE', 100))
+"""The maximum number of simultaneous connections to the OpenAI API.
 
-@backoff.on_exception(
-    wait_gen=backoff.expo,
-    exception=(
-        openai.error.ServiceUnavailableError,
-        openai.error.APIError,
-        openai.error.RateLimitError,
-        openai.error.APIConnectionError,
-        openai.error.Timeout,
-    ),
-    max_value=60,
-    factor=1.5,
+This constant uses the value of the ``PROMPTLY_OPENAI_POOL_SIZE`` environment
+variable, if set, or defaults to 100 connections.
+"""
+
+PROMPTLY_OPENAI_MAX_IN_FLIGHT: int = int(
+    env.get('PROMPTLY_OPENAI_MAX_IN_FLIGHT', 16))
+"""The maximum number of concurrent OpenAI API calls per process.
+
+This constant uses the value of the ``PROMPTLY_OPENAI_MAX_IN_FLIGHT``
+environment variable, if set, or defaults to 16 calls.
+"""
+
+PROMPTLY_OPENAI_QUEUE_DEPTH: int = int(
+    env.get('PROMPTLY_OPENAI_QUEUE_DEPTH', 32))
+"""The maximum number of OpenAI API calls waiting for a free slot.
+
+Calls beyond this limit are rejected immediately. This constant uses the
+value of the ``PROMPTLY_OPENAI_QUEUE_DEPTH`` environment variable, if set, or
+defaults to 32 calls.
+"""
+
+PROMPTLY_OPENAI_QUEUE_TIMEOUT: float = float(
+    env.get('PROMPTLY_OPENAI_QUEUE_TIMEOUT', 10))
+"""The maximum amount of time, in seconds, a call waits for a free slot.
+
+This constant uses the value of the ``PROMPTLY_OPENAI_QUEUE_TIMEOUT``
+environment variable, if set, or defaults to 10 seconds.
+"""
+
+PROMPTLY_SINGLEFLIGHT_DIR: str = env.get('PROMPTLY_SINGLEFLIGHT_DIR', '')
+"""The directory of the lock files coalescing completions across processes.
+
+This constant uses the value of the ``PROMPTLY_SINGLEFLIGHT_DIR`` environment
+variable, if set. Otherwise, identical completions are only coalesced within
+a process.
+"""
+
+RETRYABLE_ERRORS = (
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+    openai.error.RateLimitError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
 )
-def completion(*args, **kwargs) -> Dict[str, Any]:
-    """Generates a text completion using the OpenAI API.
+"""OpenAI errors that are considered transient and worth a retry."""
 
-    This function uses an exponential backoff strategy to handle the following
-    exceptions:
+_request_duration = registry.histogram(
+    'promptly_openai_request_duration_seconds',
+    'Duration of the OpenAI API requests by model, mode and outcome.',
+    labelnames=('model', 'stream', 'outcome'),
+)
+_tokens_total = registry.counter(
+    'promptly_openai_tokens_total',
+    'Number of tokens reported by the OpenAI API by model and kind.',
+    labelnames=('model', 'kind'),
+)
 
-    - ``openai.error.ServiceUnavailableError``
-    - ``openai.error.APIError``
-    - ``openai.error.RateLimitError``
-    - ``openai.error.APIConnectionError``
-    - ``openai.error.Timeout``
+limiter = ConcurrencyLimiter(
+    'promptly_openai',
+    max_in_flight=PROMPTLY_OPENAI_MAX_IN_FLIGHT,
+    max_queue=PROMPTLY_OPENAI_QUEUE_DEPTH,
+    queue_timeout=PROMPTLY_OPENAI_QUEUE_TIMEOUT,
+)
+"""The process-wide limiter of concurrent OpenAI API calls."""
 
-    The backoff delay starts at 1 second and increases by a factor of 1.5 with
-    each retry, capping at a maximum delay of 60 seconds between retries.
+breaker = CircuitBreaker(
+    'promptly_openai',
+    failures=(*RETRYABLE_ERRORS, asyncio.TimeoutError),
+)
+"""The circuit breaker of the OpenAI API calls."""
 
-    Any arguments or keyword arguments are forwarded directly to the
-    ``openai.ChatCompletion.create`` method. The OpenAI API key is read from
-    the ``OPENAI_API_KEY`` environment variable by any import openai's
-    ``__init__.py`` file.
+retry_policy = RetryPolicy('promptly_openai', retryable=RETRYABLE_ERRORS)
+"""The policy retrying the transient failures of the OpenAI API calls."""
+
+rate_limiter = create_rate_limiter('promptly_openai')
+"""The limiter pacing the calls to stay within the OpenAI API rate limits."""
+
+response_cache = create_cache()
+"""The cache of deterministic completions, see :mod:`promptly.api.cache`."""
+
+coalescer = SingleFlight(
+    'promptly_openai',
+    lock_dir=PROMPTLY_SINGLEFLIGHT_DIR or None,
+)
+"""The group coalescing identical deterministic completions."""
+
+_loop_thread = EventLoopThread(name='promptly-openai')
+_session: Optional[aiohttp.ClientSession] = None
+_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+async def _get_session() -> aiohttp.ClientSession:
+    """Get the shared HTTP session, creating it on first use.
+
+    The session keeps its connections to the OpenAI API alive between
+    requests, so that subsequent completions skip the TCP and TLS handshakes.
+    It is bound to the event loop it was created on, hence it is recreated
+    when called from another loop (e.g. after a fork).
+    """
+    global _session, _session_loop  # pylint: disable=global-statement
+
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=PROMPTLY_OPENAI_POOL_SIZE),
+            trace_configs=[rate_limiter.trace_config()],
+        )
+        _session_loop = loop
+
+    return _session
+
+
+async def _close_session():
+    """Close the shared HTTP session, if any."""
+    if _session is not None and not _session.closed:
+        await _session.close()
+
+
+@atexit.register
+def _shutdown():
+    """Release the HTTP session and stop the event loop on exit."""
+    if _session is None:
+        return
+
+    try:
+        _loop_thread.run(_close_session(), timeout=5)
+    except asyncio.TimeoutError:
+        pass
+    _loop_thread.stop()
+
+
+async def acompletion(*args, timeout: float = None,
+                      **kwargs) -> Dict[str, Any]:
+    """Generates a text completion using the OpenAI API asynchronously.
+
+    This is the coroutine behind :func:`.completion`. Transient errors are
+    retried by :data:`.retry_policy` until ``timeout`` expires. Requests are
+    sent through a shared ``aiohttp`` session, each one once
+    :data:`.rate_limiter` allows it.
+
+    Any other arguments or keyword arguments are forwarded directly to the
+    ``openai.ChatCompletion.acreate`` method.
 
     :param args: Variable-length argument list.
+    :param timeout: The overall deadline, in seconds. Defaults to
+        :const:`~promptly.utils.PROMPTLY_THREAD_TIMEOUT`.
     :param kwargs: Arbitrary keyword arguments.
     :return: The generated text completion.
     :rtype: dict
     :raises Exception: ``openai.error.OpenAIError`` if there is an error in the
         API request.
+    :raises asyncio.TimeoutError: If the deadline expired.
+    :raises OverloadedError: If the rate limits would be exceeded for longer
+        than :const:`~promptly.utils.PROMPTLY_THREAD_TIMEOUT` seconds.
     """
-    # For details see https://platform.openai.com/docs/api-reference
-    result = threaded_execute(openai.ChatCompletion.create, *args, **kwargs)
-    if 'error' in result:
-        logger.warning(result)
-        raise openai.error.APIError(result['error'])
+    # The session is stored in a context variable, which is local to the
+    # task running this coroutine, and inherited by the tasks of the hedged
+    # attempts.
+    openai.aiosession.set(await _get_session())
+
+    return await retry_policy.call(
+        lambda: _acreate(*args, **kwargs),
+        timeout=timeout or PROMPTLY_THREAD_TIMEOUT,
+    )
+
+
+async def _acreate(*args, **kwargs) -> Dict[str, Any]:
+    """Send a single completion request to the OpenAI API."""
+    model = kwargs.get('model')
+    if rate_limiter.enabled and model:
+        requested_model.set(model)
+        await rate_limiter.aacquire(
+            model,
+            estimate_tokens(kwargs),
+            max_wait=PROMPTLY_THREAD_TIMEOUT,
+        )
+
+    with _timed(model, stream=False), breaker.guard():
+        # For details see https://platform.openai.com/docs/api-reference
+        result = await openai.ChatCompletion.acreate(*args, **kwargs)
+        if 'error' in result:
+            logger.warning(result)
+            raise openai.error.APIError(result['error'])
+
+    usage = result.get('usage') or {}
+    for kind in ('prompt', 'completion'):
+        if usage.get(f'{kind}_tokens'):
+            _tokens_total.inc(usage[f'{kind}_tokens'],
+                              model=model or 'unknown', kind=kind)
 
     # Typically, the response is a single message, but it can be multiple
     # messages if the model is configured to generate multiple messages.
@@ -92,3 +255,348 @@ def completion(*args, **kwargs) -> Dict[str, Any]:
     #   }
     # }
     return result
+
+
+def completion(*args, timeout: float = None, **kwargs) -> Dict[str, Any]:
+    """Generates a text completion using the OpenAI API.
+
+    The following exceptions are considered transient, and retried by
+    :data:`.retry_policy` with a randomized exponential backoff, as long as
+    its retry budget allows it:
+
+    - ``openai.error.ServiceUnavailableError``
+    - ``openai.error.APIError``
+    - ``openai.error.RateLimitError``
+    - ``openai.error.APIConnectionError``
+    - ``openai.error.Timeout``
+
+    The request is executed by :func:`.acompletion` on a persistent background
+    event loop. The whole call, including retries and the wait for an
+    identical call in flight, is bounded by ``timeout``: once it expires the
+    request is cancelled and ``openai.error.Timeout`` is raised.
+
+    Deterministic requests, i.e. sampled with ``temperature=0``, are served
+    from :data:`.response_cache` when the very same request has already been
+    answered, without calling the API. Identical deterministic requests
+    made concurrently are coalesced by :data:`.coalescer`: only the first
+    one calls the API, the others wait for its response, or its error.
+    Responses which this call did not get from the API itself have no
+    ``usage``, since no tokens were billed for them, and are marked with
+    ``cached`` set to ``True``.
+
+    The number of concurrent calls is bounded by :data:`.limiter`. When no
+    slot is available the call waits in a bounded queue, or fails fast with
+    :class:`~promptly.api.limiter.OverloadedError` if the queue is full.
+    The calls are then paced by :data:`.rate_limiter`, so that they stay
+    within the rate limits of the OpenAI API.
+
+    While the OpenAI API is failing, :data:`.breaker` rejects the calls at
+    once with :class:`~promptly.api.breaker.CircuitOpenError`, unless they
+    are answered from the cache.
+
+    Any other arguments or keyword arguments are forwarded directly to the
+    ``openai.ChatCompletion.acreate`` method. The OpenAI API key is read from
+    the ``OPENAI_API_KEY`` environment variable by any import openai's
+    ``__init__.py`` file.
+
+    :param args: Variable-length argument list.
+    :param timeout: The overall deadline, in seconds. Defaults to
+        :const:`~promptly.utils.PROMPTLY_THREAD_TIMEOUT`.
+    :param kwargs: Arbitrary keyword arguments.
+    :return: The generated text completion.
+    :rtype: dict
+    :raises Exception: ``openai.error.OpenAIError`` if there is an error in the
+        API request.
+    :raises OverloadedError: If too many calls are already in flight, if the
+        rate limits are exhausted, or if the circuit is open.
+    """
+    if args or not is_cacheable(kwargs):
+        return _complete(*args, timeout=timeout, **kwargs)
+
+    key = cache_key(kwargs)
+    cached = response_cache.get(key)
+    if cached is not None:
+        return _reused(cached)
+
+    led = False
+    timeout = timeout or PROMPTLY_THREAD_TIMEOUT
+    deadline = time.monotonic() + timeout
+
+    def lead():
+        nonlocal led
+        led = True
+
+        # Another process may have answered the request while this one was
+        # waiting for the lock of the key.
+        if coalescer.lock_dir:
+            cached = response_cache.get(key)
+            if cached is not None:
+                return _reused(cached)
+
+        # The wait for the lock is charged against the deadline.
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError('The lock of the coalesced completion was '
+                               'held past the deadline')
+        response = _complete(timeout=remaining, **kwargs)
+        response_cache.set(key, response)
+        return response
+
+    try:
+        response = coalescer.do(key, lead, timeout=timeout)
+    except TimeoutError as exc:
+        raise openai.error.Timeout(
+            'The coalesced completion exceeded the given deadline') from exc
+
+    # The response of a coalesced call was billed to its leader only.
+    return response if led else _reused(response)
+
+
+def _reused(response: Dict[str, Any]) -> Dict[str, Any]:
+    """Mark a response answered without calling the API."""
+    response = {**response, 'cached': True}
+    response.pop('usage', None)
+    return response
+
+
+def _complete(*args, timeout: float = None, **kwargs) -> Dict[str, Any]:
+    """Call the OpenAI API once a slot of the limiter is available."""
+    with limiter.slot(), span(f'[openai] {kwargs.get("model")}'):
+        try:
+            return _loop_thread.run(
+                acompletion(*args, timeout=timeout, **kwargs),
+                timeout=timeout,
+            )
+        except asyncio.TimeoutError as exc:
+            raise openai.error.Timeout(
+                'The completion exceeded the given deadline') from exc
+
+
+async def _aopen_stream(*args, **kwargs) -> AsyncIterator[Dict[str, Any]]:
+    """Open a streamed chat completion, retrying transient errors.
+
+    The request is sent through the shared HTTP session, like those of
+    :func:`.acompletion`, so that the headers of its response update
+    :data:`.rate_limiter`. Only the initial request is retried, and never
+    hedged: once the first chunk has been received, an error is propagated
+    to the caller as is, because the already forwarded tokens cannot be
+    taken back.
+    """
+    openai.aiosession.set(await _get_session())
+    model = kwargs.get('model')
+    if rate_limiter.enabled and model:
+        requested_model.set(model)
+
+    async def create():
+        with breaker.guard():
+            return await openai.ChatCompletion.acreate(
+                *args, stream=True, **kwargs)
+
+    return await retry_policy.call(
+        create,
+        timeout=PROMPTLY_THREAD_TIMEOUT,
+        hedge=False,
+    )
+
+
+async def _anext(chunks: AsyncIterator[Dict[str, Any]]):
+    """Get the next chunk of a stream, or ``None`` once it is exhausted."""
+    try:
+        return await chunks.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+class CompletionStream:
+    """An iterator over the content deltas of a streamed completion.
+
+    The stream holds a slot of the limiter from its creation until it is
+    exhausted or closed, whichever comes first.
+
+    The API does not report the usage of streamed completions, which is
+    counted locally instead, see :attr:`usage`.
+    """
+
+    def __init__(self, deltas: Iterator[str], release: ExitStack,
+                 model: str, prompt_tokens: int):
+        """Initialize the stream.
+
+        :param deltas: The content deltas.
+        :param release: The callbacks releasing the resources of the stream.
+        :param str model: The model generating the completion.
+        :param int prompt_tokens: The number of tokens of the prompt.
+        """
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self._deltas = deltas
+        self._release = release
+        self._content: List[str] = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        try:
+            delta = next(self._deltas)
+        except BaseException:  # noqa: B902 - the error is re-raised
+            self.close()
+            raise
+        self._content.append(delta)
+        return delta
+
+    @property
+    def usage(self) -> Dict[str, int]:
+        """The usage of the completion received so far.
+
+        The tokens of the completion are counted from its content, like the
+        tokens of the prompt.
+
+        :rtype: dict
+        """
+        completion_tokens = count_tokens(''.join(self._content), self.model)
+        return {
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': self.prompt_tokens + completion_tokens,
+        }
+
+    def close(self):
+        """Stop the stream, and release its slot of the limiter."""
+        try:
+            self._deltas.close()
+        finally:
+            self._release.close()
+
+
+def stream_completion(*args, **kwargs) -> CompletionStream:
+    """Generates a text completion using the OpenAI API in streaming mode.
+
+    Works like :func:`.completion`, but requests the completion with
+    ``stream=True`` and yields the content deltas as soon as the API sends
+    them, instead of waiting for the whole completion to be generated. The
+    usage of the completion is then counted locally, see
+    :attr:`.CompletionStream.usage`.
+
+    The circuit is checked, and a slot of the limiter and the rate limits
+    are acquired, when this function is called rather than when the stream
+    is first iterated, so that the caller can reject an overloaded request
+    before it starts responding. The returned stream must therefore be
+    closed if it is not exhausted.
+
+    :param args: Variable-length argument list.
+    :param kwargs: Arbitrary keyword arguments.
+    :return: An iterator over the generated content deltas.
+    :rtype: CompletionStream
+    :raises Exception: ``openai.error.OpenAIError`` if there is an error in the
+        API request.
+    :raises OverloadedError: If too many calls are already in flight, if the
+        rate limits are exhausted, or if the circuit is open.
+    """
+    model = kwargs.get('model')
+    breaker.raise_if_open()
+    prompt_tokens = count_prompt_tokens(kwargs.get('messages') or (),
+                                        model or default_model())
+
+    with ExitStack() as stack:
+        stack.enter_context(limiter.slot())
+        if rate_limiter.enabled and model:
+            rate_limiter.acquire(
+                model,
+                estimate_tokens(kwargs, prompt_tokens),
+                max_wait=PROMPTLY_THREAD_TIMEOUT,
+            )
+        return CompletionStream(
+            _stream(*args, **kwargs),
+            stack.pop_all(),
+            model or default_model(),
+            prompt_tokens,
+        )
+
+
+def _stream(*args, **kwargs) -> Iterator[str]:
+    """Open a streamed chat completion, and yield its content deltas.
+
+    The chunks are received on the background event loop, each one within
+    :const:`~promptly.utils.PROMPTLY_THREAD_TIMEOUT` seconds.
+    """
+    model = kwargs.get('model')
+    with _timed(model, stream=True), span(f'[openai] {model}'):
+        try:
+            chunks = _loop_thread.run(
+                _aopen_stream(*args, **kwargs),
+                timeout=PROMPTLY_THREAD_TIMEOUT,
+            )
+        except asyncio.TimeoutError as exc:
+            raise openai.error.Timeout(
+                'The streamed completion exceeded the given deadline') from exc
+
+        try:
+            while True:
+                try:
+                    chunk = _loop_thread.run(
+                        _anext(chunks),
+                        timeout=PROMPTLY_THREAD_TIMEOUT,
+                    )
+                except asyncio.TimeoutError as exc:
+                    raise openai.error.Timeout(
+                        'The streamed completion stalled') from exc
+                if chunk is None:
+                    return
+
+                content = _delta_content(chunk)
+                if content:
+                    yield content
+        finally:
+            try:
+                _loop_thread.run(chunks.aclose(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+
+
+@contextmanager
+def _timed(model: Optional[str], stream: bool):
+    """Observe the duration and the outcome of an OpenAI API request.
+
+    A streamed request lasts until its last chunk is received.
+    """
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        _request_duration.observe(
+            time.perf_counter() - start,
+            model=model or 'unknown',
+            stream=str(stream).lower(),
+            outcome=outcome,
+        )
+
+
+def _delta_content(chunk: Dict[str, Any]) -> Optional[str]:
+    """Extract the content delta from a chunk of a streamed completion."""
+    # Example chunk:
+    # {
+    #   'id': 'chatcmpl-8CPG5CegoglqliSS1kD6E7zCXjzXO',
+    #   'object': 'chat.completion.chunk',
+    #   'created': 1697967721,
+    #   'model': 'gpt-3.5-turbo-16k-061',
+    #   'choices': [
+    #     {
+    #       'index': 0,
+    #       'delta': {
+    #         'content': '2 + 2'
+    #       },
+    #       'finish_reason': None,
+    #     }
+    #   ]
+    # }
+    if 'error' in chunk:
+        logger.warning(chunk)
+        raise openai.error.APIError(chunk['error'])
+
+    choices = chunk.get('choices') or []
+    if not choices:
+        return None
+
+    return choices[0].get('delta', {}).get('content')
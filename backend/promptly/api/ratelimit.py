@@ -0,0 +1,462 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""
+Client-side rate limiting of the OpenAI API.
+--------------------------------------------
+
+This module paces the calls to the OpenAI API so that they stay within the
+rate limits of the account, instead of exceeding them and backing off once
+the API answered with ``429 Too Many Requests``.
+
+Each model has two token buckets, refilled continuously at their limit per
+minute: one for the requests, one for the tokens. Before a request is sent,
+its cost, one request and an estimate of its tokens (see
+:func:`.estimate_tokens`), is reserved from both buckets. A bucket may go
+into debt: the request then waits for the time it takes to refill the debt,
+and the requests reserving after it wait even longer. This spreads out the
+requests at the allowed rate, rather than letting them all retry at once.
+
+The limits and the remaining capacity are adjusted from the
+``x-ratelimit-*`` headers of every response, which reflect the usage of the
+whole account. They are read by an ``aiohttp`` trace configuration, see
+:meth:`.RateLimiter.trace_config`.
+
+Two backends are available:
+
+- :class:`.RateLimiter`, local to the process;
+- :class:`.SQLiteRateLimiter`, whose buckets are stored in a SQLite database
+  file, so that all the processes of the host share them.
+
+"""
+
+import asyncio
+import contextvars
+import functools
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from os import environ as env
+from typing import Any, Callable, Dict, List, Mapping, NamedTuple, \
+    Optional, Tuple
+
+import aiohttp
+
+from promptly.api.limiter import OverloadedError
+from promptly.metrics import registry
+from promptly.tokenizer import count_prompt_tokens, default_model
+
+logger = logging.getLogger(__name__)
+
+PROMPTLY_OPENAI_RPM: int = int(env.get('PROMPTLY_OPENAI_RPM', 3500))
+"""The initial number of requests per minute allowed per model.
+
+The actual limit is then read from the responses of the API. Set it to 0 to
+disable the pacing of the requests. This constant uses the value of the
+``PROMPTLY_OPENAI_RPM`` environment variable, if set, or defaults to 3500
+requests.
+"""
+
+PROMPTLY_OPENAI_TPM: int = int(env.get('PROMPTLY_OPENAI_TPM', 90000))
+"""The initial number of tokens per minute allowed per model.
+
+The actual limit is then read from the responses of the API. Set it to 0 to
+disable the pacing of the tokens. This constant uses the value of the
+``PROMPTLY_OPENAI_TPM`` environment variable, if set, or defaults to 90000
+tokens.
+"""
+
+PROMPTLY_RATELIMIT_PATH: str = env.get('PROMPTLY_RATELIMIT_PATH', '')
+"""The path of the SQLite database file shared by the rate limiters.
+
+This constant uses the value of the ``PROMPTLY_RATELIMIT_PATH`` environment
+variable, if set. Otherwise, each process paces its own requests.
+"""
+
+KINDS = ('requests', 'tokens')
+"""The kinds of rate limits, as named by the ``x-ratelimit-*`` headers."""
+
+requested_model: contextvars.ContextVar = contextvars.ContextVar(
+    'requested_model', default=None)
+"""The model of the request being sent by the current task.
+
+The trace configuration reads it to update the buckets of the right model.
+"""
+
+_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_DURATION_UNITS = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Parse a duration of the ``x-ratelimit-reset-*`` headers.
+
+    :param str value: The duration, e.g. ``20ms``, ``1s`` or ``6m0s``.
+    :return: The duration in seconds, or ``None`` if it cannot be parsed.
+    :rtype: float or None
+    """
+    parts = _DURATION_RE.findall(value or '')
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit]
+               for number, unit in parts)
+
+
+def estimate_tokens(params: Dict[str, Any],
+                    prompt_tokens: Optional[int] = None) -> int:
+    """Estimate the tokens counted against the limit for a request.
+
+    The API counts the tokens of the prompt, plus the maximum number of
+    tokens of each completion when ``max_tokens`` is given.
+
+    :param dict params: The parameters of the completion request.
+    :param prompt_tokens: The already known number of tokens of the prompt,
+        which is then not tokenized again.
+    :type prompt_tokens: int, optional
+    :return: The number of tokens.
+    :rtype: int
+    """
+    if prompt_tokens is None:
+        prompt_tokens = count_prompt_tokens(
+            params.get('messages') or (),
+            params.get('model') or default_model(),
+        )
+    return prompt_tokens + (params.get('max_tokens') or 0) * \
+        params.get('n', 1)
+
+
+class Bucket(NamedTuple):
+    """The state of a token bucket."""
+
+    capacity: float
+    """The limit per minute, which is also the size of the bucket."""
+
+    level: float
+    """The available capacity, negative when in debt."""
+
+    updated_at: float
+    """The time of the last update, in seconds since the epoch."""
+
+    @property
+    def rate(self) -> float:
+        """The refill rate, per second."""
+        return self.capacity / 60
+
+    def refill(self, now: float) -> 'Bucket':
+        """Get the state of the bucket at a given time."""
+        level = self.level + max(0.0, now - self.updated_at) * self.rate
+        return self._replace(level=min(self.capacity, level), updated_at=now)
+
+
+class RateLimiter:
+    """A rate limiter local to the process.
+
+    Subclasses store the buckets elsewhere by implementing :meth:`_update`.
+    The time spent waiting and the rejected requests are exposed as metrics
+    prefixed with ``name``.
+
+    Usage::
+
+        limiter = RateLimiter('upstream', rpm=3500, tpm=90000)
+        limiter.acquire('gpt-4', tokens=1200)
+        call_upstream()
+
+    """
+
+    blocking: bool = False
+    """Whether updating the buckets may block, e.g. on I/O.
+
+    The asynchronous methods then update them in the default executor of
+    the event loop, rather than on the loop itself.
+    """
+
+    def __init__(self, name: str, rpm: int = PROMPTLY_OPENAI_RPM,
+                 tpm: int = PROMPTLY_OPENAI_TPM,
+                 clock: Callable[[], float] = time.time):
+        """Initialize the limiter.
+
+        :param str name: The prefix of the metrics of this limiter.
+        :param int rpm: The initial limit of requests per minute, or 0.
+        :param int tpm: The initial limit of tokens per minute, or 0.
+        :param clock: The function returning the current time, in seconds
+            since the epoch.
+        """
+        self.limits = {'requests': rpm, 'tokens': tpm}
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, Bucket] = {}
+
+        self._wait_histogram = registry.histogram(
+            f'{name}_ratelimit_wait_seconds',
+            'Time spent waiting for the rate limits.',
+        )
+        self._rejected_counter = registry.counter(
+            f'{name}_ratelimit_rejected_total',
+            'Number of requests rejected because of the rate limits.',
+        )
+
+    @property
+    def enabled(self) -> bool:
+        """Whether any of the rate limits is enforced."""
+        return any(self.limits.values())
+
+    def reserve(self, model: str, tokens: int,
+                max_wait: Optional[float] = None) -> float:
+        """Reserve the capacity of a request.
+
+        :param str model: The model of the request.
+        :param int tokens: The estimated tokens of the request.
+        :param max_wait: The maximum time, in seconds, the request may wait.
+        :type max_wait: float, optional
+        :return: The time, in seconds, to wait before sending the request.
+        :rtype: float
+        :raises OverloadedError: If the request would wait longer than
+            ``max_wait``, in which case nothing is reserved.
+        """
+        costs = {'requests': 1, 'tokens': tokens}
+        kinds = [kind for kind in KINDS if self.limits[kind]]
+        if not kinds:
+            return 0.0
+
+        def reserve(buckets: List[Bucket]) -> Tuple[List[Bucket], float]:
+            wait = max(
+                max(0.0, (costs[kind] - bucket.level) / bucket.rate)
+                for kind, bucket in zip(kinds, buckets)
+            )
+            if max_wait is not None and wait > max_wait:
+                return buckets, wait
+
+            return [
+                bucket._replace(level=bucket.level - costs[kind])
+                for kind, bucket in zip(kinds, buckets)
+            ], wait
+
+        wait = self._update(model, kinds, reserve)
+        if max_wait is not None and wait > max_wait:
+            self._rejected_counter.inc()
+            raise OverloadedError(
+                'The OpenAI API rate limits are exhausted',
+                retry_after=max(1, math.ceil(wait)),
+            )
+
+        self._wait_histogram.observe(wait)
+        return wait
+
+    def acquire(self, model: str, tokens: int,
+                max_wait: Optional[float] = None):
+        """Reserve the capacity of a request and wait until it can be sent.
+
+        See :meth:`reserve` for the parameters.
+        """
+        wait = self.reserve(model, tokens, max_wait)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, model: str, tokens: int,
+                       max_wait: Optional[float] = None):
+        """Asynchronous version of :meth:`acquire`."""
+        wait = await self._run(self.reserve, model, tokens, max_wait)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def update(self, model: str, headers: Mapping[str, str]):
+        """Adjust the buckets of a model from the headers of a response.
+
+        The limits of the buckets become those of the headers. Their levels
+        are lowered to the remaining capacity reported by the API, if lower,
+        which accounts for the requests sent by other hosts.
+
+        :param str model: The model of the request.
+        :param headers: The headers of the response.
+        """
+        reported = {}
+        for kind in KINDS:
+            try:
+                limit = float(headers[f'x-ratelimit-limit-{kind}'])
+                remaining = float(headers[f'x-ratelimit-remaining-{kind}'])
+            except (KeyError, ValueError):
+                continue
+            reset = parse_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+            if limit > 0:
+                reported[kind] = (limit, remaining, reset)
+
+        kinds = [kind for kind in reported if self.limits[kind]]
+        if not kinds:
+            return
+
+        def adjust(buckets: List[Bucket]) -> Tuple[List[Bucket], None]:
+            adjusted = []
+            for kind, bucket in zip(kinds, buckets):
+                limit, remaining, reset = reported[kind]
+                bucket = bucket._replace(capacity=limit)
+                if reset is not None:
+                    # The bucket is full again once reset.
+                    remaining = min(remaining, limit - reset * bucket.rate)
+                adjusted.append(
+                    bucket._replace(level=min(bucket.level, remaining)))
+            return adjusted, None
+
+        self._update(model, kinds, adjust)
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """Create the trace configuration of the HTTP session of the API.
+
+        It updates the buckets of :data:`requested_model` from the headers
+        of every response.
+
+        :rtype: aiohttp.TraceConfig
+        """
+        async def on_request_end(session, context, params):
+            model = requested_model.get()
+            if model:
+                await self._run(self.update, model, params.response.headers)
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_end.append(on_request_end)
+        return trace_config
+
+    async def _run(self, fn: Callable, *args) -> Any:
+        """Call a method updating the buckets from the event loop.
+
+        :param fn: The method, e.g. :meth:`reserve` or :meth:`update`.
+        :return: The result of ``fn``.
+        """
+        if not self.blocking:
+            return fn(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(fn, *args))
+
+    def _new_bucket(self, kind: str, now: float) -> Bucket:
+        return Bucket(self.limits[kind], self.limits[kind], now)
+
+    def _update(self, model: str, kinds: List[str],
+                fn: Callable[[List[Bucket]], Tuple[List[Bucket], Any]]):
+        """Atomically update the buckets of a model.
+
+        :param str model: The model.
+        :param list kinds: The kinds of the buckets.
+        :param fn: The function receiving the refilled buckets and returning
+            their new states, along with a result.
+        :return: The result of ``fn``.
+        """
+        with self._lock:
+            now = self.clock()
+            keys = [f'{model}:{kind}' for kind in kinds]
+            buckets = [
+                self._buckets.get(key, self._new_bucket(kind, now))
+                .refill(now)
+                for key, kind in zip(keys, kinds)
+            ]
+            buckets, result = fn(buckets)
+            self._buckets.update(zip(keys, buckets))
+        return result
+
+
+class SQLiteRateLimiter(RateLimiter):
+    """A rate limiter whose buckets are stored in a SQLite database file.
+
+    The buckets are read and written in ``BEGIN IMMEDIATE`` transactions, so
+    that the processes sharing the database update them one at a time.
+    Each thread uses its own connection.
+
+    As a transaction may wait for the lock of the database, the asynchronous
+    methods update the buckets in the default executor of the event loop.
+    """
+
+    blocking = True
+
+    def __init__(self, name: str, path: str, rpm: int = PROMPTLY_OPENAI_RPM,
+                 tpm: int = PROMPTLY_OPENAI_TPM,
+                 clock: Callable[[], float] = time.time):
+        """Initialize the limiter, creating its database if needed.
+
+        :param str path: The path of the SQLite database file.
+        """
+        super().__init__(name, rpm, tpm, clock)
+        self.path = path
+        self._local = threading.local()
+
+        self._connect().execute(
+            'CREATE TABLE IF NOT EXISTS rate_limits ('
+            'key TEXT PRIMARY KEY, '
+            'capacity REAL NOT NULL, '
+            'level REAL NOT NULL, '
+            'updated_at REAL NOT NULL)'
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        # Connections cannot be shared across forks, nor across threads.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            # Transactions are managed explicitly.
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _update(self, model: str, kinds: List[str],
+                fn: Callable[[List[Bucket]], Tuple[List[Bucket], Any]]):
+        try:
+            return self._update_shared(model, kinds, fn)
+        except sqlite3.Error as exc:
+            # Better pace the requests of this process only than not at all.
+            logger.warning('Failed to update the shared rate limits: %s', exc)
+            return super()._update(model, kinds, fn)
+
+    def _update_shared(self, model: str, kinds: List[str],
+                       fn: Callable[[List[Bucket]],
+                                    Tuple[List[Bucket], Any]]):
+        conn = self._connect()
+        keys = [f'{model}:{kind}' for kind in kinds]
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = self.clock()
+            rows = {
+                row[0]: Bucket(*row[1:]) for row in conn.execute(
+                    'SELECT key, capacity, level, updated_at '
+                    'FROM rate_limits WHERE key IN ({})'.format(
+                        ', '.join('?' * len(keys))),
+                    keys,
+                )
+            }
+            buckets = [
+                rows.get(key, self._new_bucket(kind, now)).refill(now)
+                for key, kind in zip(keys, kinds)
+            ]
+            buckets, result = fn(buckets)
+            conn.executemany(
+                'INSERT OR REPLACE INTO rate_limits '
+                '(key, capacity, level, updated_at) VALUES (?, ?, ?, ?)',
+                [(key, *bucket) for key, bucket in zip(keys, buckets)],
+            )
+            conn.execute('COMMIT')
+        except BaseException:  # noqa: B902 - re-raised below
+            conn.execute('ROLLBACK')
+            raise
+
+        return result
+
+
+def create_rate_limiter(name: str,
+                        path: str = PROMPTLY_RATELIMIT_PATH) -> RateLimiter:
+    """Create the rate limiter configured for the application.
+
+    :param str name: The prefix of the metrics of the limiter.
+    :param str path: The path of the SQLite database file shared with the
+        other processes, if any.
+    :rtype: RateLimiter
+    """
+    if path:
+        return SQLiteRateLimiter(name, path)
+    return RateLimiter(name)
@@ -0,0 +1,336 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""
+Retries of upstream calls.
+--------------------------
+
+This module provides the :class:`.RetryPolicy` class, which retries the
+transient failures of a call within an overall deadline:
+
+- every attempt, and every wait between two attempts, fits into the deadline
+  of the call, after which the last error is raised;
+- the waits are drawn uniformly between zero and an exponentially growing
+  bound ("full jitter"), so that the callers which failed together do not
+  retry together;
+- a :class:`.RetryBudget` caps the retries to a fraction of the calls, so
+  that an upstream outage does not multiply the load sent to it;
+- optionally, a call which takes longer than the 95th percentile of the
+  recent latencies is hedged: a second attempt is sent, and the first
+  response wins.
+
+"""
+
+import asyncio
+import itertools
+import random
+import threading
+import time
+from collections import deque
+from os import environ as env
+from typing import Any, Awaitable, Callable, Optional, Set, Tuple, Type
+
+from promptly.metrics import registry
+from promptly.utils import strtobool
+
+PROMPTLY_OPENAI_MAX_ATTEMPTS: int = int(
+    env.get('PROMPTLY_OPENAI_MAX_ATTEMPTS', 4))
+"""The maximum number of attempts of an OpenAI API call, retries included.
+
+This constant uses the value of the ``PROMPTLY_OPENAI_MAX_ATTEMPTS``
+environment variable, if set, or defaults to 4 attempts.
+"""
+
+PROMPTLY_OPENAI_RETRY_BUDGET: float = float(
+    env.get('PROMPTLY_OPENAI_RETRY_BUDGET', 0.1))
+"""The maximum ratio of retried, or hedged, OpenAI API calls.
+
+This constant uses the value of the ``PROMPTLY_OPENAI_RETRY_BUDGET``
+environment variable, if set, or defaults to 0.1, i.e. one retry per ten
+calls.
+"""
+
+PROMPTLY_OPENAI_HEDGE: bool = strtobool(
+    env.get('PROMPTLY_OPENAI_HEDGE', 'false'))
+"""Whether to hedge the slow OpenAI API calls.
+
+This constant uses the value of the ``PROMPTLY_OPENAI_HEDGE`` environment
+variable, if set, or defaults to ``False``.
+"""
+
+
+class RetryBudget:
+    """A token bucket limiting the ratio of retries to calls.
+
+    Every call deposits ``ratio`` tokens, and every retry withdraws one. The
+    bucket starts full, with ``max_tokens`` tokens, so that the retries of
+    a low traffic are not starved.
+    """
+
+    def __init__(self, ratio: float, max_tokens: float = 10):
+        """Initialize a full budget.
+
+        :param float ratio: The maximum ratio of retries to calls.
+        :param float max_tokens: The size of the bucket.
+        """
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self) -> float:
+        """The number of retries currently allowed."""
+        return self._tokens
+
+    def deposit(self):
+        """Record a call."""
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        """Record a retry, if the budget allows it.
+
+        :return: Whether the retry is allowed.
+        :rtype: bool
+        """
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class LatencyWindow:
+    """The latencies of the most recent successful attempts."""
+
+    def __init__(self, size: int = 1000, min_samples: int = 20):
+        """Initialize an empty window.
+
+        :param int size: The number of latencies kept.
+        :param int min_samples: The number of latencies below which the
+            quantiles are unknown.
+        """
+        self.min_samples = min_samples
+        self._samples: deque = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, latency: float):
+        """Record the latency of an attempt, in seconds."""
+        with self._lock:
+            self._samples.append(latency)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Get a quantile of the recorded latencies.
+
+        :param float q: The quantile, between 0 and 1.
+        :return: The latency, in seconds, or ``None`` if there are not
+            enough samples yet.
+        :rtype: float or None
+        """
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class RetryPolicy:
+    """Retry the transient failures of a call within a deadline.
+
+    The attempts, retries and hedges, and the calls refused a retry by the
+    budget are counted in metrics prefixed with ``name``.
+
+    Usage::
+
+        policy = RetryPolicy('upstream', retryable=(ConnectionError,))
+        response = await policy.call(lambda: fetch(url), timeout=30)
+
+    """
+
+    def __init__(self, name: str,
+                 retryable: Tuple[Type[BaseException], ...],
+                 max_attempts: int = PROMPTLY_OPENAI_MAX_ATTEMPTS,
+                 base_delay: float = 0.5, max_delay: float = 20,
+                 budget: Optional[RetryBudget] = None,
+                 hedge: bool = PROMPTLY_OPENAI_HEDGE,
+                 hedge_quantile: float = 0.95):
+        """Initialize the policy.
+
+        :param str name: The prefix of the metrics of this policy.
+        :param tuple retryable: The errors worth a retry.
+        :param int max_attempts: The maximum number of attempts of a call.
+        :param float base_delay: The bound of the wait before the first
+            retry, in seconds, which doubles with every retry.
+        :param float max_delay: The bound of the wait between two attempts.
+        :param budget: The budget of the retries and hedges. Defaults to
+            :const:`PROMPTLY_OPENAI_RETRY_BUDGET` of the calls.
+        :type budget: RetryBudget, optional
+        :param bool hedge: Whether to hedge the slow calls.
+        :param float hedge_quantile: The quantile of the recent latencies
+            after which a call is hedged.
+        """
+        self.retryable = retryable
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget(PROMPTLY_OPENAI_RETRY_BUDGET)
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.latencies = LatencyWindow()
+
+        self._attempts_counter = registry.counter(
+            f'{name}_attempts_total',
+            'Number of attempts by kind: first, retry or hedge.',
+            labelnames=('kind',),
+        )
+        self._exhausted_counter = registry.counter(
+            f'{name}_retry_budget_exhausted_total',
+            'Number of retries, or hedges, refused by the retry budget.',
+        )
+
+    def backoff(self, retry: int) -> float:
+        """Draw the time to wait before a retry.
+
+        :param int retry: The number of the retry, starting at 1.
+        :return: The time, in seconds.
+        :rtype: float
+        """
+        bound = min(self.max_delay, self.base_delay * 2 ** (retry - 1))
+        return random.uniform(0, bound)
+
+    async def call(self, fn: Callable[[], Awaitable[Any]],
+                   timeout: float, hedge: bool = True) -> Any:
+        """Call a coroutine function, retrying its transient failures.
+
+        :param fn: The function returning a new attempt.
+        :param float timeout: The overall deadline, in seconds.
+        :param bool hedge: Whether the attempts may be hedged, if the policy
+            hedges the slow calls. The latencies of the attempts which may
+            not are not recorded either.
+        :return: The result of the first successful attempt.
+        :raises asyncio.TimeoutError: If the deadline expired while an
+            attempt was in flight.
+        :raises Exception: The error of the last attempt.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        self._begin()
+
+        for number in itertools.count(1):
+            try:
+                if not hedge:
+                    return await asyncio.wait_for(fn(), deadline - loop.time())
+                return await self._attempt(fn, deadline)
+            except self.retryable:
+                delay = self._retry_delay(number, loop.time(), deadline)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+
+    def call_sync(self, fn: Callable[[], Any], timeout: float) -> Any:
+        """Call a function, retrying its transient failures.
+
+        Works like :meth:`call`, without hedging, and without bounding the
+        attempts themselves, which cannot be interrupted.
+
+        :param fn: The function.
+        :param float timeout: The overall deadline, in seconds.
+        :return: The result of the first successful attempt.
+        :raises Exception: The error of the last attempt.
+        """
+        deadline = time.monotonic() + timeout
+        self._begin()
+
+        for number in itertools.count(1):
+            try:
+                return fn()
+            except self.retryable:
+                delay = self._retry_delay(number, time.monotonic(), deadline)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+
+    def _begin(self):
+        """Record a new call."""
+        self.budget.deposit()
+        self._attempts_counter.inc(kind='first')
+
+    def _retry_delay(self, number: int, now: float,
+                     deadline: float) -> Optional[float]:
+        """Decide whether to retry a failed attempt.
+
+        :param int number: The number of the failed attempt.
+        :param float now: The current time of the clock of the deadline.
+        :param float deadline: The deadline of the call.
+        :return: The time to wait before the retry, or ``None`` if the call
+            is not to be retried.
+        :rtype: float or None
+        """
+        if number >= self.max_attempts:
+            return None
+
+        delay = self.backoff(number)
+        if now + delay >= deadline:
+            return None
+
+        if not self.budget.withdraw():
+            self._exhausted_counter.inc()
+            return None
+
+        self._attempts_counter.inc(kind='retry')
+        return delay
+
+    async def _attempt(self, fn: Callable[[], Awaitable[Any]],
+                       deadline: float) -> Any:
+        """Run an attempt, hedged if it is slow, within the deadline."""
+        loop = asyncio.get_running_loop()
+
+        async def timed():
+            start = loop.time()
+            result = await fn()
+            self.latencies.add(loop.time() - start)
+            return result
+
+        hedge_after = (
+            self.latencies.quantile(self.hedge_quantile)
+            if self.hedge else None
+        )
+        if hedge_after is None or loop.time() + hedge_after >= deadline:
+            return await asyncio.wait_for(timed(), deadline - loop.time())
+
+        pending: Set[asyncio.Future] = {asyncio.ensure_future(timed())}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=hedge_after)
+            if not done:
+                if self.budget.withdraw():
+                    self._attempts_counter.inc(kind='hedge')
+                    pending.add(asyncio.ensure_future(timed()))
+                else:
+                    self._exhausted_counter.inc()
+
+            error = None
+            while pending:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=remaining,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+
+            raise error
+        finally:
+            # The slower attempt is not needed anymore.
+            for task in pending:
+                task.cancel()
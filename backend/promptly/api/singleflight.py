@@ -0,0 +1,158 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""
+Coalescing of identical concurrent calls.
+-----------------------------------------
+
+This module provides the :class:`.SingleFlight` class, which makes sure that
+only one call per key is in flight at a time. The first caller of a key, the
+leader, executes the call; the callers arriving while it is in flight, the
+followers, wait for the leader and share its result, or its error.
+
+Calls are coalesced across the threads of a process. When a lock directory
+is given, leaders of different processes also take an exclusive lock file per
+key, so that the processes of a host run identical calls one after the other.
+Combined with a shared cache, this lets the later ones reuse the result of
+the first one.
+
+"""
+
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+from promptly.metrics import registry
+
+LOCK_STRIPES = 4096
+"""The number of lock files a key is hashed into, when locking across
+processes. Bounding the number of files keeps the lock directory small."""
+
+
+class _Call:
+    """A call in flight, along with its outcome once it completed."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Execute only one call per key at a time, and share its outcome.
+
+    Usage::
+
+        flight = SingleFlight('upstream')
+        response = flight.do(key, lambda: call_upstream(request))
+
+    """
+
+    def __init__(self, name: str, lock_dir: Optional[str] = None):
+        """Initialize the group.
+
+        :param str name: The prefix of the metrics of this group.
+        :param lock_dir: The directory of the lock files shared with other
+            processes. Calls are only coalesced within the process if not
+            given.
+        :type lock_dir: str, optional
+        """
+        self.lock_dir = lock_dir if fcntl is not None else None
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+
+        self._requests_counter = registry.counter(
+            f'{name}_coalesced_requests_total',
+            'Number of calls by role: executed (leader) or shared (follower).',
+            labelnames=('role',),
+        )
+
+    def do(self, key: str, fn: Callable[[], Any],
+           timeout: Optional[float] = None) -> Any:
+        """Call ``fn``, unless a call with the same key is already in flight.
+
+        :param str key: The key identifying identical calls.
+        :param fn: The function to call.
+        :param timeout: The maximum time, in seconds, to wait for a call in
+            flight, or for the lock file of the key.
+        :type timeout: float, optional
+        :return: The result of ``fn``, possibly called by another thread.
+        :raises TimeoutError: If the call in flight did not complete in time.
+        :raises Exception: The error raised by ``fn``, possibly in another
+            thread.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            self._requests_counter.inc(role='follower')
+            if not call.done.wait(timeout):
+                raise TimeoutError('The coalesced call did not complete in '
+                                   'time')
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        self._requests_counter.inc(role='leader')
+        try:
+            with self._file_lock(key, timeout):
+                call.result = fn()
+            return call.result
+        except BaseException as exc:  # noqa: B902 - re-raised below
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    @property
+    def in_flight(self) -> int:
+        """The number of keys currently in flight."""
+        return len(self._calls)
+
+    @contextmanager
+    def _file_lock(self, key: str, timeout: Optional[float]):
+        """Hold the lock file of a key, if locking across processes."""
+        if not self.lock_dir:
+            yield
+            return
+
+        # The built-in hash() is salted per process, hence unusable here.
+        digest = hashlib.sha256(key.encode('utf-8')).digest()
+        stripe = int.from_bytes(digest[:4], 'big') % LOCK_STRIPES
+        path = os.path.join(self.lock_dir, f'{stripe:04x}.lock')
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with open(path, 'a+b') as lock_file:
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError as exc:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise TimeoutError('The lock of the coalesced call '
+                                           'was not released in time') from exc
+                    time.sleep(0.01)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -14,15 +14,95 @@ requests. It processes a user's chat message and returns the model's
 response.
 """
 
-from flask import Blueprint, jsonify, request
+import json
+import logging
+import os
+import re
 
-from promptly.models import Chat, ChatEntry
-from promptly.services import OpenAIService
+import openai
+from flask import (
+    Blueprint,
+    current_app,
+    jsonify,
+    request,
+    Response,
+    stream_with_context,
+)
+
+from promptly.api.batch import (
+    Checkpoint,
+    PROMPTLY_BATCH_DIR,
+    PROMPTLY_BATCH_MAX_CONCURRENCY,
+    run_batch,
+)
+from promptly.api.breaker import requires_upstream
+from promptly.api.limiter import OverloadedError
+from promptly.models import Chat, ChatEntry, transaction
+from promptly.services import ContextTooLargeError, OpenAIService
 from promptly.utils import try_parse_int
 
 api_bp = Blueprint('api', __name__)
 openai_service = OpenAIService()
 
+logger = logging.getLogger(__name__)
+
+
+def resolve_chat(chat_id) -> Chat:
+    """Get the chat with the given ID or create a new one.
+
+    :param chat_id: The ID of the chat as sent by the client.
+    :return: The existing chat, or a new one if there is no such chat.
+    :rtype: promptly.models.Chat
+    """
+    chat_id = try_parse_int(chat_id)
+    chat = Chat.get(chat_id) if chat_id else None
+    if chat is None:
+        chat = Chat.create_new_chat()
+    return chat
+
+
+def sse_event(data: dict, event: str = None) -> str:
+    """Format a Server-Sent Event.
+
+    :param dict data: The event payload, serialized as JSON.
+    :param str event: The optional event name.
+    :return: The formatted event, ready to be sent to the client.
+    :rtype: str
+    """
+    payload = f'data: {json.dumps(data)}\n\n'
+    if event:
+        payload = f'event: {event}\n{payload}'
+    return payload
+
+
+@api_bp.errorhandler(OverloadedError)
+def overloaded(exc: OverloadedError):
+    """Reject the request when the upstream cannot take more calls.
+
+    :param exc: The raised error.
+    :type exc: promptly.api.limiter.OverloadedError
+    :return: A 503 Service Unavailable JSON response with a ``Retry-After``
+        header.
+    :rtype: tuple
+    """
+    return (
+        jsonify({'error': str(exc)}),
+        503,
+        {'Retry-After': str(exc.retry_after)},
+    )
+
+
+@api_bp.errorhandler(ContextTooLargeError)
+def context_too_large(exc: ContextTooLargeError):
+    """Reject a message which does not fit into the context of the model.
+
+    :param exc: The raised error.
+    :type exc: promptly.services.ContextTooLargeError
+    :return: A 413 Content Too Large JSON response.
+    :rtype: tuple
+    """
+    return jsonify({'error': str(exc)}), 413
+
 
 @api_bp.route('/conversation', methods=['POST'])
 def conversation():
@@ -37,21 +117,175 @@ def conversation():
     :rtype: flask.Response
     :raises Exception: ``openai.error.OpenAIError`` for issues with the OpenAI
         call.
+    :raises OverloadedError: If too many OpenAI calls are in flight, which is
+        turned into a 503 response by :func:`.overloaded`.
+    :raises ContextTooLargeError: If the message is too long, which is turned
+        into a 413 response by :func:`.context_too_large`. Nothing is stored
+        then.
     """
     data = request.json
-    message, chat_id = data.get('message'), data.get('chat_id')
+    message = data.get('message')
+    openai_service.check(message)
 
-    chat_id = try_parse_int(chat_id)
-    chat = Chat.get(chat_id) if chat_id else Chat.create_new_chat()
-    if chat is None:
-        chat = Chat.create_new_chat()
-
-    ChatEntry.create(content=message, chat=chat, role='user').save()
+    # A turn is written in two transactions: the user's message before the
+    # OpenAI call, and the model's response after it.
+    with transaction():
+        chat = resolve_chat(data.get('chat_id'))
+        ChatEntry.create(content=message, chat=chat, role='user')
 
-    response = openai_service.get_response(message)
-    ChatEntry.create(content=response, chat=chat, role='assistant').save()
+    response = openai_service.complete(message, chat.id)
+    answer = ChatEntry.create(
+        content=response.content,
+        chat=chat,
+        role='assistant',
+        model=response.model,
+        prompt_tokens=response.prompt_tokens,
+        completion_tokens=response.completion_tokens,
+    )
+    openai_service.remember(message, answer)
 
     return jsonify({
-        'message': response,
+        'message': response.content,
         'chat_id': chat.id,
     })
+
+
+@api_bp.route('/conversation/stream', methods=['POST'])
+@requires_upstream
+def conversation_stream():
+    """Process a user's chat message and stream the model's response.
+
+    Works like :func:`.conversation`, but forwards the model's response to
+    the user as a stream of Server-Sent Events while it is being generated.
+    The following events are sent:
+
+    - ``start``: ``{"chat_id": ...}``, sent before the model is called
+    - message (unnamed): ``{"delta": ...}``, one per received chunk
+    - ``error``: ``{"error": ...}``, if the OpenAI call failed
+    - ``done``: ``{"message": ..., "chat_id": ...}``, the complete response
+
+    The assistant's message is persisted once, when the stream ends, along
+    with its usage, as counted by
+    :attr:`promptly.api.openai_eval.CompletionStream.usage`.
+
+    An overloaded upstream, or a message too long, is reported before the
+    stream starts, with a 503 or 413 response, like in :func:`.conversation`.
+
+    :return: A ``text/event-stream`` response.
+    :rtype: flask.Response
+    """
+    data = request.json
+    message = data.get('message')
+    openai_service.check(message)
+
+    with transaction():
+        chat = resolve_chat(data.get('chat_id'))
+        ChatEntry.create(content=message, chat=chat, role='user')
+
+    # The call is admitted before the headers are sent, so that an
+    # OverloadedError still reaches the error handler of the blueprint.
+    stream = openai_service.stream_response(message, chat.id)
+
+    def generate():
+        chunks, failed = [], False
+        try:
+            yield sse_event({'chat_id': chat.id}, event='start')
+            for delta in stream:
+                chunks.append(delta)
+                yield sse_event({'delta': delta})
+        except (openai.error.OpenAIError, OverloadedError) as exc:
+            logger.warning('Streaming completion failed: %s', exc)
+            failed = True
+            yield sse_event({'error': str(exc)}, event='error')
+        finally:
+            # Persist whatever has been generated, even if the client went
+            # away in the middle of the stream.
+            if chunks:
+                usage = stream.usage
+                ChatEntry.create(
+                    content=''.join(chunks),
+                    chat=chat,
+                    role='assistant',
+                    model=stream.model,
+                    prompt_tokens=usage['prompt_tokens'],
+                    completion_tokens=usage['completion_tokens'],
+                )
+
+        if not failed:
+            yield sse_event(
+                {'message': ''.join(chunks), 'chat_id': chat.id},
+                event='done',
+            )
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        },
+    )
+    # Release the slot even if the response is never iterated.
+    response.call_on_close(stream.close)
+    return response
+
+
+@api_bp.route('/batch', methods=['POST'])
+def batch():
+    """Run a batch of completion requests and stream their results.
+
+    The request body is a JSONL document with one item per line, see
+    :mod:`promptly.api.batch`. The results are streamed back as a JSONL
+    document, one line per item, in completion order.
+
+    The following query parameters are supported:
+
+    - ``job_id``: the ID of the job, made of up to 64 letters, digits,
+      dashes and underscores. Items completed by a previous request with the
+      same job ID are skipped.
+    - ``concurrency``: the number of items in flight at a time, from 1 to
+      :data:`~promptly.api.batch.PROMPTLY_BATCH_MAX_CONCURRENCY`.
+
+    :return: An ``application/x-ndjson`` response, or a 400 Bad Request JSON
+        response if a query parameter is invalid.
+    :rtype: flask.Response
+    """
+    job_id = request.args.get('job_id')
+    if job_id is not None and not re.fullmatch(r'[\w-]{1,64}', job_id):
+        return jsonify({'error': 'Invalid job ID'}), 400
+
+    concurrency = None
+    if 'concurrency' in request.args:
+        concurrency = try_parse_int(request.args['concurrency'])
+        valid = range(1, PROMPTLY_BATCH_MAX_CONCURRENCY + 1)
+        if concurrency not in valid:
+            return jsonify({'error': 'Invalid concurrency'}), 400
+
+    checkpoint = Checkpoint(batch_checkpoint_path(job_id) if job_id else None)
+
+    def generate():
+        for result in run_batch(
+            request.stream,
+            checkpoint,
+            **({'concurrency': concurrency} if concurrency else {}),
+        ):
+            yield json.dumps(result) + '\n'
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'X-Accel-Buffering': 'no'},
+    )
+
+
+def batch_checkpoint_path(job_id: str) -> str:
+    """Get the path of the checkpoint file of a batch job.
+
+    :param str job_id: The ID of the job.
+    :return: The path of the file, whose directory is created if needed.
+    :rtype: str
+    """
+    directory = PROMPTLY_BATCH_DIR or os.path.join(
+        current_app.instance_path, 'batch')
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f'{job_id}.checkpoint')
@@ -12,6 +12,7 @@ Manage the application creation and configuration process.
 
 import os
 
+import click
 from flask import Flask
 
 
@@ -23,6 +24,7 @@ def create_app(config=None) -> Flask:
     configure_extensions(app)
     configure_context_processors(app)
     configure_blueprints(app)
+    configure_profiling(app)
 
     return app
 
@@ -66,13 +68,49 @@ def configure_app(app: Flask, config_name=None):
     app.config.from_envvar('PROMPTLY_SETTINGS', silent=True)
 
 
+def configure_database(app: Flask):
+    """Configure the database engines of the application."""
+    from promptly.config import engine_options
+    from promptly.models import (
+        db,
+        replica_binds,
+        set_sqlite_pragmas,
+        stick_to_primary,
+    )
+
+    # Read-only replicas of the database
+    replicas = replica_binds(app.config['DATABASE_REPLICA_URLS'])
+    if replicas:
+        app.config['SQLALCHEMY_BINDS'] = {
+            **app.config.get('SQLALCHEMY_BINDS', {}),
+            **replicas,
+        }
+        app.after_request(stick_to_primary)
+
+    # Flask-SQLAlchemy
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS',
+                          engine_options(app.config))
+    db.init_app(app)
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                set_sqlite_pragmas(engine, app.config['SQLITE_PRAGMAS'])
+
+
 def configure_extensions(app: Flask):
     """Configure extensions for the application."""
+    from promptly import instrumentation, tokenizer
     from promptly.models import db
     from flask_migrate import Migrate, upgrade
 
     # Flask-SQLAlchemy
-    db.init_app(app)
+    configure_database(app)
+
+    # Request and SQL metrics
+    instrumentation.init_app(app)
+
+    # Token counting
+    tokenizer.warn_if_approximate()
 
     # Flask-Migrate
     migrate = Migrate()
@@ -85,10 +123,117 @@ def configure_extensions(app: Flask):
         upgrade()
 
     @app.cli.command()
-    def seed():
+    @click.option('--chats', default=None, type=int,
+                  help='The number of chats.  [default: 15]')
+    @click.option('--entries-per-chat', default=None, type=int,
+                  help='The average number of entries per chat.  '
+                       '[default: 10]')
+    def seed(chats, entries_per_chat):
         """Add seed data to the database."""
         from tests.seeder import seed
-        seed()
+        seed(chats, entries_per_chat)
+
+    @app.cli.command('count-tokens')
+    @click.option('--model', default=None,
+                  help='The OpenAI model to count the tokens for.')
+    @click.option('--batch-size', default=500, show_default=True,
+                  help='The number of chat entries per batch.')
+    def count_tokens(model, batch_size):
+        """Count the tokens of the chat entries not counted yet."""
+        from promptly.models import ChatEntry
+        updated = ChatEntry.backfill_token_counts(model, batch_size)
+        click.echo(f'Updated {updated} chat entries.')
+
+    @app.cli.command('batch-eval')
+    @click.argument('source', type=click.File('r', encoding='utf-8'))
+    @click.option('--output', '-o', type=click.Path(dir_okay=False),
+                  default=None,
+                  help='The JSONL file the results are appended to. '
+                       'Defaults to the standard output.')
+    @click.option('--checkpoint', type=click.Path(dir_okay=False),
+                  default=None,
+                  help='The file of the IDs of the completed items. '
+                       'Defaults to the output file with a .checkpoint '
+                       'suffix.')
+    @click.option('--concurrency', type=click.IntRange(min=1), default=None,
+                  help='The number of items in flight at a time.')
+    def batch_eval(source, output, checkpoint, concurrency):
+        """Run the completion requests of a JSONL file.
+
+        Items completed by a previous run with the same checkpoint are
+        skipped, so that an interrupted run can be resumed.
+        """
+        import json
+        from promptly.api.batch import Checkpoint, run_batch
+
+        if checkpoint is None and output is not None:
+            checkpoint = f'{output}.checkpoint'
+
+        state = Checkpoint(checkpoint)
+        if len(state):
+            click.echo(f'Resuming after {len(state)} completed items.',
+                       err=True)
+
+        kwargs = {'concurrency': concurrency} if concurrency else {}
+        with click.open_file(output or '-', 'a', encoding='utf-8') as out:
+            for result in run_batch(source, state, **kwargs):
+                out.write(json.dumps(result) + '\n')
+                out.flush()
+
+
+def configure_profiling(app: Flask):
+    """Configure the profiling of the requests, if enabled."""
+    from promptly import profiling
+
+    store = profiling.ProfileStore(
+        profiling.PROMPTLY_PROFILE_DIR
+        or os.path.join(app.instance_path, 'profiles')
+    )
+    sample_rate = (
+        1.0 if profiling.PROMPTLY_PROFILE
+        else profiling.PROMPTLY_PROFILE_SAMPLE_RATE
+    )
+    if sample_rate > 0:
+        profiling.init_app(app, store, sample_rate)
+
+    @app.cli.group()
+    def profiles():
+        """List and dump the profiles of the requests."""
+
+    @profiles.command('list')
+    @click.option('--limit', '-n', default=20, show_default=True,
+                  help='The number of profiles to list, most recent first.')
+    def list_profiles(limit):
+        """List the profiles of the requests."""
+        for meta in store.list()[:limit]:
+            click.echo(
+                f"{meta['id']}  {meta['duration'] * 1000:9.1f} ms  "
+                f"{meta['samples']:6d} samples  {meta.get('status')} "
+                f"{meta.get('method')} {meta.get('path')}"
+            )
+
+    @profiles.command('dump')
+    @click.argument('profile_id')
+    @click.option('--output', '-o', type=click.Path(dir_okay=False),
+                  default='-', help='The file the folded stacks are '
+                                    'written to. Defaults to the standard '
+                                    'output.')
+    def dump_profile(profile_id, output):
+        """Dump a profile in the folded stacks format.
+
+        The output can be rendered by flame graph tools, e.g.
+        ``flamegraph.pl`` or speedscope.
+        """
+        try:
+            folded = store.load(profile_id)
+        except KeyError as exc:
+            raise click.BadParameter(
+                f'No such profile: {profile_id}',
+                param_hint='PROFILE_ID',
+            ) from exc
+
+        with click.open_file(output, 'w', encoding='utf-8') as out:
+            out.write(folded)
 
 
 def configure_context_processors(app: Flask):
@@ -0,0 +1,155 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""
+Rendered fragments of the chat pages.
+-------------------------------------
+
+The HTML of each message of a chat page is rendered once, and kept in a
+bounded LRU cache local to the process, :data:`.fragment_cache`.
+
+The fragments are keyed by the ID of their entry, since entries never
+change once created, and by :func:`templates_version`, which changes
+whenever a deployment changes the templates. A new entry of a chat is thus
+rendered alone, while the fragments of the previous templates are evicted as
+the cache fills up, in every process, without telling them.
+
+Hits and misses are counted in the ``promptly_fragment_cache_requests_total``
+metric, and evictions in the ``promptly_fragment_cache_evictions_total`` one.
+
+"""
+
+import hashlib
+from functools import lru_cache
+from os import environ as env
+from typing import List, Optional
+
+from flask import current_app, get_template_attribute
+from jinja2 import Environment
+from markupsafe import Markup
+
+from promptly import __version__
+from promptly.api.cache import MemoryCache, PROMPTLY_CACHE_TTL
+from promptly.metrics import registry
+
+PROMPTLY_FRAGMENT_CACHE_MAX_BYTES: int = int(
+    env.get('PROMPTLY_FRAGMENT_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+"""The maximum total size, in bytes, of the cached HTML fragments.
+
+This constant uses the value of the ``PROMPTLY_FRAGMENT_CACHE_MAX_BYTES``
+environment variable, if set, or defaults to 16 MiB. Set it to 0 to disable
+the cache.
+"""
+
+_requests_total = registry.counter(
+    'promptly_fragment_cache_requests_total',
+    'Number of fragment cache lookups.',
+    labelnames=('result',),
+)
+_evictions_total = registry.counter(
+    'promptly_fragment_cache_evictions_total',
+    'Number of fragments evicted from the fragment cache.',
+)
+
+
+class FragmentCache(MemoryCache):
+    """A thread-safe LRU cache of rendered HTML fragments.
+
+    The fragments of a page are looked up at once with :meth:`get_many`, and
+    stored as is, without the JSON serialization of the responses.
+    """
+
+    backend = 'fragment'
+
+    def get_many(self, keys: List[str]) -> List[Optional[Markup]]:
+        """Get cached fragments.
+
+        :param list keys: The keys of the fragments.
+        :return: The fragments, ``None`` for those which are not cached.
+        :rtype: list
+        """
+        fragments = [self._get(key) for key in keys]
+
+        hits = sum(fragment is not None for fragment in fragments)
+        if hits:
+            _requests_total.inc(hits, result='hit')
+        if hits < len(keys):
+            _requests_total.inc(len(keys) - hits, result='miss')
+
+        return [
+            None if fragment is None else Markup(fragment.decode('utf-8'))
+            for fragment in fragments
+        ]
+
+    def set(self, key: str, fragment: str):
+        """Cache a fragment.
+
+        Fragments larger than the cache itself are not stored.
+
+        :param str key: The key of the fragment.
+        :param str fragment: The HTML of the fragment.
+        """
+        data = fragment.encode('utf-8')
+        if len(data) <= self.max_bytes:
+            self._set(key, data)
+
+    def _evicted(self, count: int):
+        if count:
+            _evictions_total.inc(count)
+
+
+fragment_cache = FragmentCache(PROMPTLY_FRAGMENT_CACHE_MAX_BYTES,
+                               PROMPTLY_CACHE_TTL)
+"""The cache of the rendered chat messages."""
+
+
+def templates_version() -> str:
+    """Get the version of the templates of the application.
+
+    The version is a digest of the version of the application and of the
+    sources of all its templates. It is computed once per process, unless the
+    templates are reloaded when they change, e.g. in debug mode.
+
+    :return: The first 12 hexadecimal digits of the digest.
+    :rtype: str
+    """
+    jinja_env = current_app.jinja_env
+    if jinja_env.auto_reload:
+        return _templates_digest.__wrapped__(jinja_env)
+    return _templates_digest(jinja_env)
+
+
+@lru_cache(maxsize=8)
+def _templates_digest(jinja_env: Environment) -> str:
+    digest = hashlib.sha1(__version__.encode('utf-8'))
+    for name in sorted(jinja_env.list_templates()):
+        source, _, _ = jinja_env.loader.get_source(jinja_env, name)
+        digest.update(f'\0{name}\0{source}'.encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+
+def render_entries(entries: list) -> List[Markup]:
+    """Render the messages of chat entries, from the cache when possible.
+
+    :param list entries: The entries of the chat.
+    :return: The HTML of the messages, in the order of the entries.
+    :rtype: list[markupsafe.Markup]
+    """
+    version = templates_version()
+    keys = [f'{version}:{entry.id}' for entry in entries]
+    fragments = fragment_cache.get_many(keys)
+
+    render = None
+    for index, fragment in enumerate(fragments):
+        if fragment is None:
+            if render is None:
+                render = get_template_attribute('chat/_entry.html',
+                                                'chat_entry')
+            fragment = fragments[index] = render(entries[index])
+            fragment_cache.set(keys[index], fragment)
+
+    return fragments
@@ -12,6 +12,8 @@ The chat module for the application.
 
 from flask import (
     Blueprint,
+    current_app,
+    jsonify,
     make_response,
     redirect,
     render_template,
@@ -19,10 +21,12 @@ from flask import (
     Response,
     url_for,
 )
-from sqlalchemy import desc
+from werkzeug.http import is_resource_modified
 
-from promptly.models import Chat
+from promptly.models import Chat, ChatEntry, read_only, search_entries
+from promptly.models.search import parse_cursor
 from promptly.utils import try_parse_int
+from .fragments import render_entries, templates_version
 from .template_filters import human_readable_date
 
 chat_bp = Blueprint('chat', __name__)
@@ -30,51 +34,277 @@ chat_bp.add_app_template_filter(human_readable_date)
 
 
 @chat_bp.route('/', methods=['GET'])
+@read_only
 def chat_index() -> Response:
     """Redirect to the appropriate chat page based on cookie value.
 
     This function checks if a ``chat_id`` exists in cookies and if so,
-    redirects the user to that specific chat page. Otherwise, a new chat page
-    is rendered.
+    redirects the user to that specific chat page. Otherwise, the user is
+    redirected to :func:`.new_chat`.
 
-    :return: Redirect response or a call to :func:`.chat` function.
+    :return: Redirect response.
     :rtype: flask.Response
     """
     chat_id = try_parse_int(request.cookies.get('chat_id'))
     if chat_id and Chat.exists(chat_id):
         return redirect(url_for('chat.chat', chat_id=chat_id))
 
-    return chat()
+    return redirect(url_for('chat.new_chat'))
+
+
+@chat_bp.route('/new', methods=['GET'])
+def new_chat() -> Response:
+    """Create a new chat and redirect to its page.
+
+    The chat is created by this view, rather than by the views reading from
+    a replica, which must not write, see :func:`promptly.models.read_only`.
+
+    :return: Redirect response to the page of the new chat.
+    :rtype: flask.Response
+    """
+    chat_instance = Chat.create_new_chat()
+    return redirect(url_for('chat.chat', chat_id=chat_instance.id))
 
 
 @chat_bp.route('/<int:chat_id>', methods=['GET'])
-def chat(chat_id=None) -> Response:
+@read_only
+def chat(chat_id) -> Response:
     """Render the chat page of the application.
 
-    :param int chat_id: The ID of the chat. If not exists, a new chat is
-        created.
+    Only the most recent entries of the chat are rendered; older entries
+    are fetched by the client from :func:`.entries_json` as the user scrolls
+    up. The messages are rendered from :mod:`promptly.chat.fragments`.
+
+    The page is sent with the ``ETag`` and ``Last-Modified`` of the chat,
+    and must be revalidated: a conditional request for an unchanged chat is
+    answered with a ``304 Not Modified`` status, without rendering the page.
+    The ``ETag`` also covers the templates, see
+    :func:`promptly.chat.fragments.templates_version`, so that the pages are
+    rendered again after a deployment changing them.
+
+    :param int chat_id: The ID of the chat. If not exists, the user is
+        redirected to :func:`.new_chat`.
     :return: The rendered chat page template.
     :rtype: flask.Response
     """
     chat_instance = Chat.get(chat_id)
     if not chat_instance:
-        chat_instance = Chat.create_new_chat()
+        return redirect(url_for('chat.new_chat'))
 
-    template = render_template(
-        'chat/chat.html',
-        chat=chat_instance,
-    )
-    resp = make_response(template)
+    etag = f'{chat_instance.etag()}.{templates_version()}'
+    last_modified = chat_instance.last_modified()
+    if is_resource_modified(request.environ, etag=etag,
+                            last_modified=last_modified):
+        entries, next_cursor = entries_page(chat_instance.id)
+        resp = make_response(render_template(
+            'chat/chat.html',
+            chat=chat_instance,
+            fragments=render_entries(entries),
+            next_cursor=next_cursor,
+        ))
+    else:
+        resp = make_response('', 304)
+
+    resp.set_etag(etag)
+    resp.headers['Last-Modified'] = last_modified
+    resp.cache_control.no_cache = True
     resp.set_cookie('chat_id', str(chat_instance.id))
     return resp
 
 
+def entries_page(chat_id: int, before=None):
+    """Get a window of chat entries and the cursor of the preceding one.
+
+    :param int chat_id: The ID of the chat.
+    :param before: The cursor of the window, i.e. the ID of the oldest entry
+        of the following window.
+    :type before: int or None
+    :return: The entries, oldest first, and the cursor of the preceding
+        window, which is ``None`` if there are no older entries.
+    :rtype: tuple
+    """
+    per_page = current_app.config['CHAT_ENTRIES_PER_PAGE']
+
+    # Fetch one more entry than needed to find out if there are older ones.
+    entries = ChatEntry.window(chat_id, limit=per_page + 1, before=before)
+    if len(entries) > per_page:
+        entries = entries[1:]
+        return entries, str(entries[0].id)
+
+    return entries, None
+
+
+@chat_bp.route('/<int:chat_id>/entries.json', methods=['GET'])
+@read_only
+def entries_json(chat_id: int) -> Response:
+    """Get a window of older entries of a chat as JSON.
+
+    The window is selected by the ``cursor`` query parameter, as returned in
+    the ``next_cursor`` field of the following window. Without a cursor, the
+    most recent entries are returned.
+
+    :param int chat_id: The ID of the chat.
+    :return: A JSON object with the ``entries`` of the window, oldest first,
+        and the ``next_cursor``, which is ``null`` if there are no older
+        entries.
+    :rtype: flask.Response
+    """
+    entries, next_cursor = entries_page(
+        chat_id,
+        try_parse_int(request.args.get('cursor')),
+    )
+
+    return jsonify({
+        'entries': [
+            {
+                'id': entry.id,
+                'role': str(entry.role),
+                'content': entry.content,
+            }
+            for entry in entries
+        ],
+        'next_cursor': next_cursor,
+    })
+
+
+def history_page(before=None):
+    """Get a page of chat summaries and the cursor of the next page.
+
+    :param before: The cursor of the page, i.e. the ID of the last chat of
+        the previous page.
+    :type before: int or None
+    :return: The chat summaries and the cursor of the next page, which is
+        ``None`` if this is the last page.
+    :rtype: tuple
+    """
+    per_page = current_app.config['CHATS_PER_PAGE']
+
+    # Fetch one more chat than needed to find out if there is a next page.
+    chats = Chat.summaries(limit=per_page + 1, before=before)
+    if len(chats) > per_page:
+        chats = chats[:per_page]
+        return chats, str(chats[-1].id)
+
+    return chats, None
+
+
 @chat_bp.route('/history', methods=['GET'])
+@read_only
 def history() -> str:
     """Render the chat history page of the application.
 
+    Only the first page of chats is rendered; the next pages are fetched by
+    the client from :func:`.history_json` as the user scrolls.
+
+    If the ``q`` query parameter is given, the first page of the chat
+    entries matching it is rendered instead, and the next pages are fetched
+    from :func:`.search_json`.
+
     :return: The rendered chat history template.
     :rtype: str
     """
-    chats = Chat.query.order_by(desc(Chat.created_at)).all()
-    return render_template('chat/history.html', chats=chats)
+    query = request.args.get('q', '').strip()
+    if query:
+        results, next_cursor = search_page(query)
+        return render_template(
+            'chat/history.html',
+            query=query,
+            results=results,
+            next_cursor=next_cursor,
+        )
+
+    chats, next_cursor = history_page()
+    return render_template(
+        'chat/history.html',
+        chats=chats,
+        next_cursor=next_cursor,
+    )
+
+
+@chat_bp.route('/history.json', methods=['GET'])
+@read_only
+def history_json() -> Response:
+    """Get a page of the chat history as JSON.
+
+    The page is selected by the ``cursor`` query parameter, as returned in
+    the ``next_cursor`` field of the previous page. Without a cursor, the
+    first page is returned.
+
+    :return: A JSON object with the ``chats`` of the page and the
+        ``next_cursor``, which is ``null`` on the last page.
+    :rtype: flask.Response
+    """
+    chats, next_cursor = history_page(
+        try_parse_int(request.args.get('cursor')))
+
+    return jsonify({
+        'chats': [
+            {
+                'id': chat.id,
+                'title': chat.title,
+                'date': human_readable_date(chat.updated_at),
+                'teaser': chat.teaser,
+                'url': url_for('chat.chat', chat_id=chat.id),
+            }
+            for chat in chats
+        ],
+        'next_cursor': next_cursor,
+    })
+
+
+def search_page(query: str, after=None):
+    """Get a page of chat entries matching a query and the next cursor.
+
+    :param str query: The text entered by the user.
+    :param after: The cursor of the page, i.e. the score and the ID of the
+        last result of the previous page.
+    :type after: tuple or None
+    :return: The search results and the cursor of the next page, which is
+        ``None`` if this is the last page.
+    :rtype: tuple
+    """
+    per_page = current_app.config['SEARCH_RESULTS_PER_PAGE']
+
+    # Fetch one more result than needed to find out if there is a next page.
+    results = search_entries(query, limit=per_page + 1, after=after)
+    if len(results) > per_page:
+        results = results[:per_page]
+        return results, results[-1].cursor
+
+    return results, None
+
+
+@chat_bp.route('/history/search.json', methods=['GET'])
+@read_only
+def search_json() -> Response:
+    """Get a page of the chat entries matching a query as JSON.
+
+    The query is given by the ``q`` query parameter. Results are ranked by
+    relevance, and the matches are highlighted with ``<mark>`` tags in their
+    HTML ``snippet``. The page is selected by the ``cursor`` query
+    parameter, as returned in the ``next_cursor`` field of the previous page.
+
+    :return: A JSON object with the matching entries as ``chats`` and the
+        ``next_cursor``, which is ``null`` on the last page.
+    :rtype: flask.Response
+    """
+    results, next_cursor = search_page(
+        request.args.get('q', ''),
+        parse_cursor(request.args.get('cursor')),
+    )
+
+    return jsonify({
+        'chats': [
+            {
+                'id': result.chat_id,
+                'entry_id': result.entry_id,
+                'title': result.title,
+                'role': str(result.role),
+                'date': human_readable_date(result.created_at),
+                'snippet': str(result.snippet),
+                'url': url_for('chat.chat', chat_id=result.chat_id),
+            }
+            for result in results
+        ],
+        'next_cursor': next_cursor,
+    })
@@ -16,9 +16,13 @@ between different configurations.
 """
 
 import os
+from typing import Mapping
 
+import sqlalchemy as sa
 from flask import Flask
 
+from promptly.utils import strtobool
+
 
 class Config:
     """Base config, uses staging database server."""
@@ -27,6 +31,39 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_RECORD_QUERIES = True
     BASE_PATH = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+    CHATS_PER_PAGE = 50
+    CHAT_ENTRIES_PER_PAGE = 50
+    SEARCH_RESULTS_PER_PAGE = 20
+
+    # The pool of connections to a database server; not used with SQLite,
+    # whose connections are cheap to open.
+    DATABASE_POOL_SIZE = int(os.getenv('PROMPTLY_DB_POOL_SIZE', 5))
+    DATABASE_MAX_OVERFLOW = int(os.getenv('PROMPTLY_DB_MAX_OVERFLOW', 10))
+    DATABASE_POOL_RECYCLE = int(os.getenv('PROMPTLY_DB_POOL_RECYCLE', 1800))
+    DATABASE_POOL_PRE_PING = strtobool(
+        os.getenv('PROMPTLY_DB_POOL_PRE_PING', 'true'))
+
+    # The read-only replicas of the database, used by the views decorated
+    # with promptly.models.read_only. A client reads from the primary for
+    # DATABASE_REPLICA_LAG seconds after a write.
+    DATABASE_REPLICA_URLS = [
+        url.strip()
+        for url in os.getenv('PROMPTLY_DB_REPLICA_URLS', '').split(',')
+        if url.strip()
+    ]
+    DATABASE_REPLICA_LAG = int(os.getenv('PROMPTLY_DB_REPLICA_LAG', 5))
+
+    # The pragmas set on every connection to a SQLite database. In WAL mode,
+    # readers do not block the writer, and with synchronous=NORMAL the
+    # database is only synced at checkpoints: a power loss may roll back the
+    # last transactions, but cannot corrupt the database.
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': int(os.getenv('PROMPTLY_SQLITE_BUSY_TIMEOUT', 5000)),
+        'cache_size': int(os.getenv('PROMPTLY_SQLITE_CACHE_SIZE', -65536)),
+        'mmap_size': int(os.getenv('PROMPTLY_SQLITE_MMAP_SIZE', 268435456)),
+    }
 
     @staticmethod
     def init_app(app: Flask):
@@ -59,16 +96,42 @@ class TestingConfig(Config):
     """Uses in-memory database server."""
     TESTING = True
     SQLALCHEMY_DATABASE_URI = os.getenv('TEST_DATABASE_URL', 'sqlite://')
+    # An in-memory database has neither a journal nor pages to map.
+    SQLITE_PRAGMAS = {'busy_timeout': Config.SQLITE_PRAGMAS['busy_timeout']}
 
 
 class ProductionConfig(Config):
     """Uses production database server."""
+    SQLALCHEMY_RECORD_QUERIES = False
     SQLALCHEMY_DATABASE_URI = os.getenv(
         'DATABASE_URL',
         'sqlite:///' + os.path.join(Config.BASE_PATH, 'ddb.sqlite3')
     )
 
 
+def engine_options(config: Mapping) -> dict:
+    """Get the options of the SQLAlchemy engine of a configuration.
+
+    The options of the pool of connections are only set for a database
+    server: SQLAlchemy picks the pool of a SQLite database itself, which does
+    not accept them when the database is in memory.
+
+    :param config: The configuration of the application.
+    :type config: Mapping
+    :return: The keyword arguments of :func:`sqlalchemy.create_engine`.
+    :rtype: dict
+    """
+    url = sa.engine.make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() == 'sqlite':
+        return {}
+    return {
+        'pool_size': config['DATABASE_POOL_SIZE'],
+        'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+        'pool_recycle': config['DATABASE_POOL_RECYCLE'],
+        'pool_pre_ping': config['DATABASE_POOL_PRE_PING'],
+    }
+
+
 config = {
     'development': DevelopmentConfig,
     'testing': TestingConfig,
@@ -0,0 +1,200 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""
+Request and database instrumentation.
+-------------------------------------
+
+This module hooks the request signals of Flask and the execution events of
+the SQLAlchemy engines, to record in :data:`promptly.metrics.registry`:
+
+- the duration of the requests, by endpoint, method and status;
+- the number of SQL queries run by each request, and the time spent in them;
+- the number of slow queries, and of requests repeating the same query.
+
+Slow queries, and requests running the same query many times, which usually
+reveals an N+1 query, are also logged as warnings. The location of the
+repeated query is included when the queries are recorded by Flask-SQLAlchemy,
+i.e. when ``SQLALCHEMY_RECORD_QUERIES`` is set, which is not the case in
+production by default.
+
+.. note:: The queries run while a streamed response is being sent, after
+          the view returned, are not accounted to the request.
+
+"""
+
+import logging
+import time
+from collections import Counter
+from os import environ as env
+from typing import Optional
+
+import sqlalchemy as sa
+from flask import (
+    current_app,
+    Flask,
+    g,
+    has_app_context,
+    request,
+    request_finished,
+    request_started,
+    Response,
+)
+from flask_sqlalchemy.record_queries import get_recorded_queries
+
+from promptly.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+PROMPTLY_SLOW_QUERY_SECONDS: float = float(
+    env.get('PROMPTLY_SLOW_QUERY_SECONDS', 0.5))
+"""The duration, in seconds, beyond which a SQL query is logged as slow.
+
+This constant uses the value of the ``PROMPTLY_SLOW_QUERY_SECONDS``
+environment variable, if set, or defaults to 0.5 seconds.
+"""
+
+PROMPTLY_N_PLUS_ONE_QUERIES: int = int(
+    env.get('PROMPTLY_N_PLUS_ONE_QUERIES', 10))
+"""The number of runs of the same SQL query in a request logged as N+1.
+
+This constant uses the value of the ``PROMPTLY_N_PLUS_ONE_QUERIES``
+environment variable, if set, or defaults to 10 runs.
+"""
+
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+"""The buckets of the histogram of the number of queries per request."""
+
+_request_duration = registry.histogram(
+    'promptly_request_duration_seconds',
+    'Duration of the requests by endpoint, method and status.',
+    labelnames=('endpoint', 'method', 'status'),
+)
+_request_queries = registry.histogram(
+    'promptly_request_queries',
+    'Number of SQL queries per request by endpoint.',
+    labelnames=('endpoint',),
+    buckets=QUERY_COUNT_BUCKETS,
+)
+_request_db_duration = registry.histogram(
+    'promptly_request_db_duration_seconds',
+    'Time spent in SQL queries per request by endpoint.',
+    labelnames=('endpoint',),
+)
+_slow_queries_total = registry.counter(
+    'promptly_slow_queries_total',
+    'Number of SQL queries slower than the slow query threshold.',
+)
+_n_plus_one_total = registry.counter(
+    'promptly_n_plus_one_requests_total',
+    'Number of requests repeating a SQL query, by endpoint.',
+    labelnames=('endpoint',),
+)
+
+
+class RequestStats:
+    """The SQL queries of the current request."""
+
+    __slots__ = ('started_at', 'queries', 'db_duration', 'statements')
+
+    def __init__(self):
+        """Start recording a request."""
+        self.started_at = time.perf_counter()
+        self.queries = 0
+        self.db_duration = 0.0
+        self.statements: Counter = Counter()
+
+
+def request_stats() -> Optional[RequestStats]:
+    """Get the statistics of the current request.
+
+    :return: The statistics, or ``None`` outside of an instrumented request.
+    :rtype: RequestStats or None
+    """
+    if not has_app_context():
+        return None
+    return g.get('_promptly_request_stats')
+
+
+def init_app(app: Flask):
+    """Instrument an application.
+
+    :param app: The Flask application instance.
+    :type app: :class:`flask.Flask`
+    """
+    request_started.connect(_request_started, app)
+    request_finished.connect(_request_finished, app)
+
+    # The listeners are shared by all the engines, and only registered once.
+    if not sa.event.contains(sa.engine.Engine, 'before_cursor_execute',
+                             _before_cursor_execute):
+        sa.event.listen(sa.engine.Engine, 'before_cursor_execute',
+                        _before_cursor_execute)
+        sa.event.listen(sa.engine.Engine, 'after_cursor_execute',
+                        _after_cursor_execute)
+
+
+def _request_started(sender: Flask, **extra):
+    g._promptly_request_stats = RequestStats()
+
+
+def _request_finished(sender: Flask, response: Response, **extra):
+    stats = request_stats()
+    if stats is None:
+        return
+
+    endpoint = request.endpoint or '<unmatched>'
+    _request_duration.observe(
+        time.perf_counter() - stats.started_at,
+        endpoint=endpoint,
+        method=request.method,
+        status=response.status_code,
+    )
+    _request_queries.observe(stats.queries, endpoint=endpoint)
+    _request_db_duration.observe(stats.db_duration, endpoint=endpoint)
+
+    repeated = [
+        (statement, count)
+        for statement, count in stats.statements.items()
+        if count >= PROMPTLY_N_PLUS_ONE_QUERIES
+    ]
+    if repeated:
+        _n_plus_one_total.inc(endpoint=endpoint)
+    for statement, count in repeated:
+        logger.warning('%s ran the same query %d times, possibly an N+1 '
+                       'query%s: %s', endpoint, count,
+                       _location(statement), statement)
+
+
+def _location(statement: str) -> str:
+    """Get where a statement was run, if the queries are recorded."""
+    if not current_app.config.get('SQLALCHEMY_RECORD_QUERIES'):
+        return ''
+    for query in reversed(get_recorded_queries()):
+        if query.statement == statement:
+            return f' at {query.location}'
+    return ''
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    context._promptly_started_at = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    duration = time.perf_counter() - context._promptly_started_at
+
+    if duration > PROMPTLY_SLOW_QUERY_SECONDS:
+        _slow_queries_total.inc()
+        logger.warning('Slow query (%.3fs): %s', duration, statement)
+
+    stats = request_stats()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_duration += duration
+        stats.statements[statement] += 1
@@ -15,8 +15,10 @@ Promptly application, including the homepage and maintenance mode handling.
 
 import os
 
-from flask import abort, Blueprint, current_app, g
+from flask import abort, Blueprint, current_app, g, request, Response
 
+from promptly.api.openai_eval import breaker
+from promptly.metrics import registry
 from promptly.utils import strtobool
 
 main_bp = Blueprint('main', __name__)
@@ -42,8 +44,14 @@ def maintained():
     truthy value, the function will abort the request with a 503 Service
     Unavailable status.
 
+    Requests to the views which cannot answer without the OpenAI API, see
+    :func:`~promptly.api.breaker.requires_upstream`, are also rejected while
+    its circuit breaker is open.
+
     :raises: HTTPException: 503 Service Unavailable, if the app is in
         maintenance mode.
+    :raises CircuitOpenError: If the view requires the OpenAI API, and its
+        circuit is open.
     """
     try:
         if PROMPTLY_MAINTENANCE_MODE:
@@ -51,8 +59,25 @@ def maintained():
     except ValueError:
         pass
 
+    view = current_app.view_functions.get(request.endpoint)
+    if getattr(view, 'requires_upstream', False):
+        breaker.raise_if_open()
+
 
 @main_bp.before_request
 def setting_globals():
     """Set the debug mode for the application."""
     g.debug_mode = current_app.config['DEBUG']
+
+
+@main_bp.route('/metrics', methods=['GET'])
+def metrics() -> Response:
+    """Expose the application metrics in the Prometheus text format.
+
+    :return: The metrics of the current process.
+    :rtype: flask.Response
+    """
+    return Response(
+        registry.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
@@ -0,0 +1,237 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""
+Application metrics.
+--------------------
+
+This module provides a minimal, dependency-free metrics registry with
+counters, gauges and histograms, rendered in the Prometheus text exposition
+format. Metrics are kept in memory and are local to the process.
+
+Usage::
+
+    from promptly.metrics import registry
+
+    requests_total = registry.counter(
+        'promptly_requests_total',
+        'Total number of requests.',
+        labelnames=('endpoint',),
+    )
+    requests_total.inc(endpoint='chat.chat')
+
+"""
+
+import math
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf,
+)
+"""Default histogram buckets, in seconds."""
+
+
+class Metric:
+    """Base class for a metric family with optional labels."""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Iterable[str] = ()):
+        """Initialize the metric with a name, help text and label names."""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f'{self.name} expects labels {self.labelnames!r}, '
+                f'got {tuple(labels)!r}'
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def get(self, **labels) -> float:
+        """Get the current value for the given labels."""
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        """Get the samples of this metric as (name, labels, value) tuples."""
+        with self._lock:
+            return [
+                (self.name, dict(zip(self.labelnames, key)), value)
+                for key, value in sorted(self._values.items())
+            ]
+
+
+class Counter(Metric):
+    """A monotonically increasing counter."""
+
+    kind = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels):
+        """Increment the counter by the given amount."""
+        if amount < 0:
+            raise ValueError('Counters can only be incremented')
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down."""
+
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        """Set the gauge to the given value."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        """Increment the gauge by the given amount."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        """Decrement the gauge by the given amount."""
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """Samples observations and counts them in configurable buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        """Initialize the histogram with the given upper bucket bounds."""
+        super().__init__(name, documentation, labelnames)
+        buckets = sorted(buckets)
+        if buckets[-1] != math.inf:
+            buckets.append(math.inf)
+        self.buckets = tuple(buckets)
+        self._observations: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        """Record an observation."""
+        key = self._key(labels)
+        with self._lock:
+            # Per-bucket counts followed by the sum of all observations.
+            data = self._observations.setdefault(
+                key, [0.0] * (len(self.buckets) + 1))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+            data[-1] += value
+
+    def get(self, **labels) -> float:
+        """Get the number of observations for the given labels."""
+        with self._lock:
+            data = self._observations.get(self._key(labels))
+            return sum(data[:-1]) if data else 0.0
+
+    def sum(self, **labels) -> float:
+        """Get the sum of observations for the given labels."""
+        with self._lock:
+            data = self._observations.get(self._key(labels))
+            return data[-1] if data else 0.0
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        """Get the bucket, sum and count samples of this histogram."""
+        rv = []
+        with self._lock:
+            for key, data in sorted(self._observations.items()):
+                labels = dict(zip(self.labelnames, key))
+                cumulative = 0.0
+                for bound, count in zip(self.buckets, data):
+                    cumulative += count
+                    le = '+Inf' if bound == math.inf else repr(bound)
+                    rv.append((
+                        f'{self.name}_bucket',
+                        {**labels, 'le': le},
+                        cumulative,
+                    ))
+                rv.append((f'{self.name}_sum', labels, data[-1]))
+                rv.append((f'{self.name}_count', labels, cumulative))
+        return rv
+
+
+class Registry:
+    """A collection of metrics, which can be rendered as a whole."""
+
+    def __init__(self):
+        """Initialize an empty registry."""
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Metric] = {}
+
+    def _register(self, cls, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, *args, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError(f'{name} is already registered as a '
+                                 f'{metric.kind}')
+            return metric
+
+    def counter(self, name: str, *args, **kwargs) -> Counter:
+        """Get or create a counter."""
+        return self._register(Counter, name, *args, **kwargs)
+
+    def gauge(self, name: str, *args, **kwargs) -> Gauge:
+        """Get or create a gauge."""
+        return self._register(Gauge, name, *args, **kwargs)
+
+    def histogram(self, name: str, *args, **kwargs) -> Histogram:
+        """Get or create a histogram."""
+        return self._register(Histogram, name, *args, **kwargs)
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format.
+
+        :return: The metrics, one sample per line.
+        :rtype: str
+        """
+        lines = []
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{_format_labels(labels)} {value!r}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(
+            name,
+            value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+        )
+        for name, value in labels.items()
+    )
+    return '{' + pairs + '}'
+
+
+registry = Registry()
+"""The application-wide metrics registry."""
@@ -14,6 +14,19 @@ necessary modules for ease of access.
 
 """
 
-from .base import db  # noqa: F401
+from .base import (  # noqa: F401
+    db,
+    in_transaction,
+    primary,
+    read_only,
+    READ_PRIMARY_COOKIE,
+    reads_from_replica,
+    replica,
+    replica_binds,
+    set_sqlite_pragmas,
+    stick_to_primary,
+    transaction,
+)
 from .chat import *  # noqa: F401, F403
 from .prompt import *  # noqa: F401, F403
+from .search import *  # noqa: F401, F403
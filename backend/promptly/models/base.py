@@ -16,11 +16,17 @@ object to enforce a naming convention for database constraints.
 
 """
 
+import operator
+import random
+from contextlib import contextmanager
 from datetime import datetime
+from functools import wraps
+from typing import Dict, List
 
 import sqlalchemy as sa
-from flask import abort
+from flask import abort, current_app, request, Response
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from sqlalchemy import exists, MetaData, orm as so
 from sqlalchemy.sql import func
 
@@ -32,8 +38,233 @@ convention = {
     'pk': 'pk_%(table_name)s',
 }
 
+REPLICA_BIND_PREFIX = 'replica_'
+"""The prefix of the binds of the read-only replicas of the database."""
+
+READ_PRIMARY_COOKIE = 'read_primary'
+"""The cookie of the clients reading from the primary after a write."""
+
+_TRANSACTION_DEPTH = 'promptly.transaction_depth'
+_REPLICA = 'promptly.replica'
+_WROTE = 'promptly.wrote'
+
+
+class RoutingSession(Session):
+    """A session sending its reads to a replica of the database.
+
+    Inside a :func:`.replica` block, the queries of the session are sent to
+    a read-only replica, except for the flushes and the ``INSERT``,
+    ``UPDATE`` and ``DELETE`` statements, which are always sent to the
+    primary database. Once it wrote to the primary, the session reads from
+    it until it is closed, so that it reads back its own changes.
+
+    .. note:: Writes made with textual SQL are not told apart from reads,
+              and must be run outside of a :func:`.replica` block.
+
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        """Select the engine of a query.
+
+        :return: The engine of the replica of the session, if any and the
+            query is a read, otherwise the engine selected by the bind key
+            of the query.
+        :rtype: :class:`sqlalchemy.engine.Engine`
+        """
+        if bind is None:
+            if self._flushing or isinstance(clause, sa.UpdateBase):
+                self.info[_WROTE] = True
+                self.info.pop(_REPLICA, None)
+            elif _REPLICA in self.info:
+                return self._db.engines[self.info[_REPLICA]]
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
+
+
 metadata = MetaData(naming_convention=convention)
-db = SQLAlchemy(app=None, metadata=metadata)
+db = SQLAlchemy(app=None, metadata=metadata,
+                session_options={'class_': RoutingSession})
+
+
+@contextmanager
+def transaction():
+    """Provide a unit of work around a series of operations.
+
+    Changes made in the ``with`` block are committed together when the block
+    exits, or rolled back if it raises. Inside the block, :meth:`.save`,
+    :meth:`.create` and :meth:`.delete` only stage their changes instead of
+    committing them one by one. Nested blocks are merged into the outermost
+    one.
+
+    Usage::
+
+        with transaction():
+            chat = Chat.create(title='New chat')
+            ChatEntry.create(content='Hello', chat=chat, role='user')
+
+    :return: The current database session.
+    """
+    session = db.session()
+    depth = session.info.get(_TRANSACTION_DEPTH, 0)
+    session.info[_TRANSACTION_DEPTH] = depth + 1
+    committed = False
+    try:
+        yield session
+        if depth == 0:
+            session.commit()
+        committed = True
+    finally:
+        session.info[_TRANSACTION_DEPTH] = depth
+        if depth == 0 and not committed:
+            session.rollback()
+
+
+def in_transaction() -> bool:
+    """Check whether the caller runs inside a :func:`.transaction` block.
+
+    :return: True if changes should be staged rather than committed.
+    :rtype: bool
+    """
+    return db.session().info.get(_TRANSACTION_DEPTH, 0) > 0
+
+
+def replica_binds(urls: List[str]) -> Dict[str, str]:
+    """Name the binds of the read-only replicas of the database.
+
+    :param urls: The URLs of the replicas.
+    :type urls: list
+    :return: The URLs of the replicas by bind key, to add to the
+        ``SQLALCHEMY_BINDS`` of the configuration.
+    :rtype: dict
+    """
+    return {
+        f'{REPLICA_BIND_PREFIX}{number}': url
+        for number, url in enumerate(urls, 1)
+    }
+
+
+@contextmanager
+def replica():
+    """Send the reads of a block to a read-only replica of the database.
+
+    A replica is picked at random among the binds named by
+    :func:`.replica_binds`. The writes are still sent to the primary, see
+    :class:`.RoutingSession`. The block reads from the primary if no replica
+    is configured, or if the session already wrote to it.
+
+    Usage::
+
+        with replica():
+            chats = Chat.summaries(limit=50)
+
+    :return: The current database session.
+    """
+    session = db.session()
+    replicas = [
+        key for key in db.engines
+        if key and key.startswith(REPLICA_BIND_PREFIX)
+    ]
+    if not replicas or _REPLICA in session.info or session.info.get(_WROTE):
+        yield session
+        return
+
+    session.info[_REPLICA] = random.choice(replicas)
+    try:
+        yield session
+    finally:
+        session.info.pop(_REPLICA, None)
+
+
+@contextmanager
+def primary():
+    """Send the reads of a block to the primary database.
+
+    This is meant to read again from the primary what was not found on a
+    replica, which may lag behind it.
+
+    :return: The current database session.
+    """
+    session = db.session()
+    name = session.info.pop(_REPLICA, None)
+    try:
+        yield session
+    finally:
+        if name is not None and not session.info.get(_WROTE):
+            session.info[_REPLICA] = name
+
+
+def reads_from_replica() -> bool:
+    """Check whether the reads of the session are sent to a replica.
+
+    :return: True inside a :func:`.replica` block with a replica configured,
+        until the session writes.
+    :rtype: bool
+    """
+    return _REPLICA in db.session().info
+
+
+def read_only(view):
+    """Decorate a view only reading from the database to use a replica.
+
+    The view is run in a :func:`.replica` block, unless the client wrote to
+    the database in the last ``DATABASE_REPLICA_LAG`` seconds, as told by
+    the cookie set by :func:`.stick_to_primary`, so that it does not miss
+    its changes while the replicas catch up.
+
+    :param view: The view function.
+    :return: The decorated view function.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.cookies.get(READ_PRIMARY_COOKIE):
+            return view(*args, **kwargs)
+        with replica():
+            return view(*args, **kwargs)
+
+    return wrapper
+
+
+def stick_to_primary(response: Response) -> Response:
+    """Have the client read from the primary for a while after a write.
+
+    Meant to be registered as an ``after_request`` function when replicas
+    are configured, see :func:`.read_only`.
+
+    :param response: The response of the request.
+    :type response: :class:`flask.Response`
+    :return: The response, with the :data:`.READ_PRIMARY_COOKIE` cookie if
+        the request wrote to the database.
+    :rtype: :class:`flask.Response`
+    """
+    lag = current_app.config['DATABASE_REPLICA_LAG']
+    if lag > 0 and db.session().info.get(_WROTE):
+        response.set_cookie(READ_PRIMARY_COOKIE, '1', max_age=lag)
+    return response
+
+
+def set_sqlite_pragmas(engine: sa.engine.Engine, pragmas: dict):
+    """Set pragmas on every new connection of a SQLite engine.
+
+    Most pragmas of SQLite only last as long as the connection, and are set
+    again on each one when it is opened by the pool.
+
+    :param engine: The engine of a SQLite database.
+    :type engine: :class:`sqlalchemy.engine.Engine`
+    :param pragmas: The values of the pragmas, by name.
+    :type pragmas: dict
+    """
+    if not pragmas:
+        return
+
+    @sa.event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+        finally:
+            cursor.close()
 
 
 class BaseMixin:
@@ -55,7 +286,13 @@ class BaseMixin:
         """
         if entity_id is None:
             return None
-        return db.session.get(cls, entity_id)
+
+        rv = db.session.get(cls, entity_id)
+        if rv is None and reads_from_replica():
+            # The record may not have reached the replica yet.
+            with primary():
+                rv = db.session.get(cls, entity_id)
+        return rv
 
     @classmethod
     def get_or_404(cls, entity_id):
@@ -75,34 +312,64 @@ class BaseMixin:
         return rv
 
     @classmethod
-    def create(cls, **kwargs):
+    def create(cls, commit=None, **kwargs):
         """Create and save a new model instance.
 
         Creates a new instance of the model, saves it to the database,
         and returns the created instance.
 
+        :param commit: Whether to commit the session, see :meth:`save`.
+        :type commit: bool or None
         :param kwargs: The keyword arguments to initialize the model instance.
         :return: The created model instance.
         """
         instance = cls(**kwargs)
-        instance.save()
+        instance.save(commit=commit)
         return instance
 
-    def save(self):
+    def save(self, commit=None):
         """Save the current model to the database.
 
+        By default, the session is committed right away, unless the call is
+        made inside a :func:`.transaction` block, in which case the model is
+        only added to the session and committed with the whole block.
+
+        :param commit: Pass ``False`` to only add the model to the session,
+            or ``True`` to always commit.
+        :type commit: bool or None
         :return: None
         """
         db.session.add(self)
-        db.session.commit()
+        self._commit(commit)
 
-    def delete(self):
+    def delete(self, commit=None):
         """Delete the current model from the database.
 
+        :param commit: Whether to commit the session, see :meth:`save`.
+        :type commit: bool or None
         :return: None
         """
         db.session.delete(self)
-        db.session.commit()
+        self._commit(commit)
+
+    def flush(self):
+        """Flush the pending changes of the session to the database.
+
+        Flushing emits the pending SQL statements, e.g. to obtain the
+        generated primary key of a new model, without committing the
+        transaction.
+
+        :return: None
+        """
+        db.session.add(self)
+        db.session.flush()
+
+    @staticmethod
+    def _commit(commit=None):
+        if commit is None:
+            commit = not in_transaction()
+        if commit:
+            db.session.commit()
 
 
 class IdentityMixin:
@@ -139,7 +406,13 @@ class IdentityMixin:
             This method assumes an active SQLAlchemy database session.
 
         """
-        return db.session.query(exists().where(cls.id == entity_id)).scalar()
+        query = db.session.query(exists().where(cls.id == entity_id))
+        rv = query.scalar()
+        if not rv and reads_from_replica():
+            # The record may not have reached the replica yet.
+            with primary():
+                rv = query.scalar()
+        return rv
 
 
 class TimestampMixin:
@@ -160,6 +433,70 @@ class TimestampMixin:
         server_default=func.now(),
     )
 
+    @classmethod
+    def created_before(cls, entity_id: int) -> sa.ColumnElement[bool]:
+        """Build a keyset condition matching records older than a record.
+
+        Records are ordered by ``(created_at, id)``. The condition matches the
+        records that come before the record with the given ID (the anchor) in
+        that order, and is meant to paginate through a table without
+        ``OFFSET``: a page is fetched by ordering the records by
+        ``(created_at, id)`` descending and filtering with the last record of
+        the previous page as the anchor.
+
+        The records are compared with the anchor as a row value, which the
+        database serves with a range search of the index of ``created_at``,
+        and the ``created_at`` of the anchor is read by a subquery, so that
+        it is compared with its stored representation.
+
+        If the anchor has been deleted meanwhile, the record which follows it
+        by ID is used instead, assuming IDs are assigned in creation order;
+        the anchor is resolved with a lookup of the primary key when the
+        condition is built.
+
+        :param int entity_id: The ID of the anchor record.
+        :return: The SQL condition.
+
+        .. note::
+            This method assumes the model also uses :class:`.IdentityMixin`.
+
+        """
+        return cls._keyset_condition(entity_id, operator.lt)
+
+    @classmethod
+    def created_after(cls, entity_id: int) -> sa.ColumnElement[bool]:
+        """Build a keyset condition matching records newer than a record.
+
+        This is the counterpart of :meth:`created_before`, to paginate with
+        the records ordered by ``(created_at, id)`` ascending.
+
+        :param int entity_id: The ID of the anchor record.
+        :return: The SQL condition.
+        """
+        return cls._keyset_condition(entity_id, operator.gt)
+
+    @classmethod
+    def _keyset_condition(cls, entity_id, compare) -> sa.ColumnElement[bool]:
+        # The anchor, or the nearest record on the side of the previous
+        # pages if it has been deleted.
+        if compare is operator.lt:
+            nearest = sa.select(cls.id).where(cls.id >= entity_id) \
+                .order_by(cls.id)
+        else:
+            nearest = sa.select(cls.id).where(cls.id <= entity_id) \
+                .order_by(cls.id.desc())
+        anchor_id = db.session.scalar(nearest.limit(1))
+        if anchor_id is None:
+            # Every record comes after the anchor.
+            return sa.true()
+
+        anchor = (
+            sa.select(cls.created_at, cls.id)
+            .where(cls.id == anchor_id)
+            .scalar_subquery()
+        )
+        return compare(sa.tuple_(cls.created_at, cls.id), anchor)
+
     def last_modified(self) -> str:
         """Get the time of the last model update.
 
@@ -17,15 +17,63 @@ within the application, including the :class:`.Chat` and
           and the necessary base mixins for identity and timestamp handling.
 """
 
+import hashlib
+from datetime import datetime
 from enum import Enum
-from typing import List
+from typing import List, NamedTuple, Optional
 
 import sqlalchemy as sa
 from sqlalchemy import orm as so
 
+from promptly.tokenizer import count_tokens, default_model, encoding_name
 from .base import BaseMixin, db, IdentityMixin, TimestampMixin
 
-__all__ = ['Chat', 'ChatEntry']
+__all__ = ['Chat', 'ChatEntry', 'ChatSummary', 'TokenUsage']
+
+TEASER_LENGTH = 150
+"""The default maximum length of a chat teaser."""
+
+
+def truncate(text: Optional[str], length: int) -> str:
+    """Truncate a text to the given length, adding an ellipsis if needed.
+
+    :param text: The text to truncate, or ``None``.
+    :param int length: The maximum length of the result.
+    :return: The truncated text, or an empty string if there is no text.
+    :rtype: str
+    """
+    if not text:
+        return ''
+
+    if len(text) > length:
+        return text[:length - 3] + '...'
+
+    return text
+
+
+class ChatSummary(NamedTuple):
+    """A lightweight, read-only summary of a :class:`.Chat`.
+
+    Used to list chats without loading their entries.
+    """
+
+    id: int
+    title: str
+    created_at: datetime
+    updated_at: datetime
+    teaser: str
+
+
+class TokenUsage(NamedTuple):
+    """The number of tokens consumed by the OpenAI calls of a chat."""
+
+    prompt_tokens: int
+    completion_tokens: int
+
+    @property
+    def total_tokens(self) -> int:
+        """The total number of consumed tokens."""
+        return self.prompt_tokens + self.completion_tokens
 
 
 class Chat(BaseMixin, IdentityMixin, TimestampMixin, db.Model):
@@ -45,28 +93,121 @@ class Chat(BaseMixin, IdentityMixin, TimestampMixin, db.Model):
 
     entry: so.Mapped[List['ChatEntry']] = so.relationship(
         back_populates='chat',
+        order_by='(ChatEntry.created_at, ChatEntry.id)',
     )
 
     def teaser(self, length=None) -> str:
         """Return a teaser for the chat."""
-        if not self.entry:
-            return ''
+        length = length or TEASER_LENGTH
+        query = self._first_entry_content(length)
+        content = db.session.scalar(query.where(ChatEntry.chat_id == self.id))
+        return truncate(content, length)
 
-        first_entry = min(self.entry, key=lambda x: x.created_at)
-        length = length or 150
+    @staticmethod
+    def _first_entry_content(length: int) -> sa.Select:
+        """Build a query for the beginning of the first entry of a chat.
 
-        if len(first_entry.content) > length:
-            return first_entry.content[:length - 3] + '...'
+        One character more than ``length`` is selected, so that the caller
+        can tell whether the content has to be truncated, without loading
+        the whole message.
+        """
+        return (
+            sa.select(sa.func.substr(ChatEntry.content, 1, length + 1))
+            .order_by(ChatEntry.created_at, ChatEntry.id)
+            .limit(1)
+        )
 
-        return first_entry.content[:length]
+    @classmethod
+    def summaries(cls, length=None, limit=None,
+                  before=None) -> List[ChatSummary]:
+        """Get the summaries of chats, most recent first.
+
+        The summaries, including the teaser built from the first entry of
+        each chat, are fetched with a single query. Use ``limit`` and
+        ``before`` to paginate through the chats with a keyset cursor: pass
+        the ID of the last chat of a page as ``before`` to get the next page.
+
+        :param length: The maximum length of the teasers.
+        :type length: int or None
+        :param limit: The maximum number of summaries to return.
+        :type limit: int or None
+        :param before: The ID of the chat the summaries should follow.
+        :type before: int or None
+        :return: The list of chat summaries.
+        :rtype: list[ChatSummary]
+        """
+        length = length or TEASER_LENGTH
+        first_entry = (
+            cls._first_entry_content(length)
+            .where(ChatEntry.chat_id == cls.id)
+            .correlate(cls)
+            .scalar_subquery()
+        )
+
+        query = (
+            sa.select(
+                cls.id,
+                cls.title,
+                cls.created_at,
+                cls.updated_at,
+                first_entry,
+            )
+            .order_by(cls.created_at.desc(), cls.id.desc())
+            .limit(limit)
+        )
+        if before is not None:
+            query = query.where(cls.created_before(before))
+
+        return [
+            ChatSummary(*row[:-1], teaser=truncate(row[-1], length))
+            for row in db.session.execute(query)
+        ]
+
+    def token_usage(self) -> TokenUsage:
+        """Get the number of tokens consumed by the OpenAI calls of the chat.
+
+        The usage reported by OpenAI for each response is summed by the
+        database, without loading the entries of the chat.
+
+        :return: The prompt and completion token totals.
+        :rtype: TokenUsage
+        """
+        query = (
+            sa.select(
+                sa.func.coalesce(sa.func.sum(ChatEntry.prompt_tokens), 0),
+                sa.func.coalesce(sa.func.sum(ChatEntry.completion_tokens), 0),
+            )
+            .where(ChatEntry.chat_id == self.id)
+        )
+        return TokenUsage(*db.session.execute(query).one())
+
+    def etag(self) -> str:
+        """Get the entity tag of the current version of the chat.
+
+        The tag changes whenever an entry is added to or deleted from the
+        chat, which bumps ``updated_at``. The ID of the latest entry tells
+        apart the versions stored within the same second, the resolution of
+        some databases; unlike the number of entries, it is read from an
+        index without scanning the entries of the chat.
+
+        :return: The entity tag, unquoted.
+        :rtype: str
+        """
+        latest_entry = (
+            sa.select(ChatEntry.id)
+            .where(ChatEntry.chat_id == self.id)
+            .order_by(ChatEntry.created_at.desc(), ChatEntry.id.desc())
+            .limit(1)
+        )
+        version = (f'{self.id}:{self.updated_at.isoformat()}:'
+                   f'{db.session.scalar(latest_entry)}')
+        return hashlib.sha1(version.encode('utf-8')).hexdigest()
 
     @classmethod
-    def create_new_chat(cls, title=None):
+    def create_new_chat(cls, title=None, commit=None):
         """Create a new chat and return the new chat."""
         title = title or 'New chat'
-        new_chat = cls.create(title=title)
-        new_chat.save()
-        return new_chat
+        return cls.create(title=title, commit=commit)
 
 
 class ChatEntry(BaseMixin, IdentityMixin, TimestampMixin, db.Model):
@@ -89,6 +230,15 @@ class ChatEntry(BaseMixin, IdentityMixin, TimestampMixin, db.Model):
             return self.name.strip().lower()
 
     __tablename__ = 'chat_entries'
+    __table_args__ = (
+        # Backs per-chat entry loads, ordered by (created_at, id).
+        sa.Index(
+            'ix_chat_entries_chat_id_created_at',
+            'chat_id',
+            'created_at',
+            'id',
+        ),
+    )
 
     content: so.Mapped[str] = so.mapped_column(
         sa.Text,
@@ -109,6 +259,164 @@ class ChatEntry(BaseMixin, IdentityMixin, TimestampMixin, db.Model):
         nullable=False,
     )
 
+    # The number of tokens of the content, and the encoding they were
+    # counted with. Both are set when the entry is inserted.
+    token_count: so.Mapped[Optional[int]] = so.mapped_column(
+        sa.Integer,
+        nullable=True,
+    )
+
+    token_encoding: so.Mapped[Optional[str]] = so.mapped_column(
+        sa.String(32),
+        nullable=True,
+    )
+
+    # The model and the usage reported by OpenAI for assistant entries.
+    model: so.Mapped[Optional[str]] = so.mapped_column(
+        sa.String(64),
+        nullable=True,
+    )
+
+    prompt_tokens: so.Mapped[Optional[int]] = so.mapped_column(
+        sa.Integer,
+        nullable=True,
+    )
+
+    completion_tokens: so.Mapped[Optional[int]] = so.mapped_column(
+        sa.Integer,
+        nullable=True,
+    )
+
     chat: so.Mapped['Chat'] = so.relationship(
         back_populates='entry',
     )
+
+    def update_token_count(self, model: Optional[str] = None):
+        """Count the tokens of the content and store them on the entry.
+
+        :param model: The name of the OpenAI model to count the tokens for.
+            Defaults to the model configured for the application.
+        :type model: str, optional
+        """
+        model = model or default_model()
+        self.token_count = count_tokens(self.content, model)
+        self.token_encoding = encoding_name(model)
+
+    @classmethod
+    def backfill_token_counts(cls, model: Optional[str] = None,
+                              batch_size: int = 500) -> int:
+        """Count the tokens of the entries that have not been counted yet.
+
+        Entries without a token count, or counted with another encoding, are
+        processed in batches of ``batch_size``. Each batch is committed on
+        its own, so that the backfill can be interrupted and resumed.
+
+        :param model: The name of the OpenAI model to count the tokens for.
+            Defaults to the model configured for the application.
+        :type model: str, optional
+        :param int batch_size: The number of entries per batch.
+        :return: The number of updated entries.
+        :rtype: int
+        """
+        model = model or default_model()
+        encoding = encoding_name(model)
+        pending = sa.or_(
+            cls.token_count.is_(None),
+            cls.token_encoding.is_(None),
+            cls.token_encoding != encoding,
+        )
+
+        updated, last_id = 0, 0
+        while True:
+            rows = db.session.execute(
+                sa.select(cls.id, cls.content)
+                .where(pending, cls.id > last_id)
+                .order_by(cls.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                return updated
+
+            db.session.execute(sa.update(cls), [
+                {
+                    'id': row.id,
+                    'token_count': count_tokens(row.content, model),
+                    'token_encoding': encoding,
+                }
+                for row in rows
+            ])
+            db.session.commit()
+
+            updated += len(rows)
+            last_id = rows[-1].id
+
+    @classmethod
+    def window(cls, chat_id: int, limit: int,
+               before=None) -> List['ChatEntry']:
+        """Get the most recent entries of a chat, in chronological order.
+
+        The entries are selected newest first over ``(created_at, id)``, so
+        that only ``limit`` rows are read however long the chat is. Pass the
+        ID of the oldest entry of a window as ``before`` to get the window of
+        entries preceding it.
+
+        :param int chat_id: The ID of the chat.
+        :param int limit: The maximum number of entries to return.
+        :param before: The ID of the entry the window should precede.
+        :type before: int or None
+        :return: The entries, oldest first.
+        :rtype: list[ChatEntry]
+        """
+        query = (
+            sa.select(cls)
+            .where(cls.chat_id == chat_id)
+            .order_by(cls.created_at.desc(), cls.id.desc())
+            .limit(limit)
+        )
+        if before is not None:
+            query = query.where(cls.created_before(before))
+
+        return list(reversed(db.session.scalars(query).all()))
+
+
+@sa.event.listens_for(ChatEntry, 'before_insert')
+def count_entry_tokens(mapper, connection, target: ChatEntry):
+    """Count the tokens of a new entry, unless they already are."""
+    if target.token_count is None:
+        target.update_token_count()
+
+
+@sa.event.listens_for(ChatEntry, 'after_insert')
+@sa.event.listens_for(ChatEntry, 'after_delete')
+def touch_chat(mapper, connection, target: ChatEntry):
+    """Bump the ``updated_at`` of the chat of a new or deleted entry.
+
+    The update is made in the flush of the entry, so that a change of the
+    entries always changes the version of their chat, see
+    :meth:`.Chat.etag`. The chat loaded in the session, if any, reads the
+    new value once the flush is over, see :func:`expire_touched_chats`.
+    """
+    connection.execute(
+        sa.update(Chat)
+        .where(Chat.id == target.chat_id)
+        .values(updated_at=sa.func.now())
+    )
+
+
+@sa.event.listens_for(so.Session, 'after_flush')
+def expire_touched_chats(session: so.Session, flush_context):
+    """Expire the ``updated_at`` of the chats bumped by :func:`touch_chat`.
+
+    The state of the session cannot be changed by the mapper events of a
+    flush, hence the chats of the flushed entries are expired afterwards, and
+    read their new ``updated_at`` on the next access.
+    """
+    chat_ids = {
+        instance.chat_id
+        for instance in (*session.new, *session.deleted)
+        if isinstance(instance, ChatEntry)
+    }
+    for chat_id in chat_ids:
+        chat = session.identity_map.get(session.identity_key(Chat, chat_id))
+        if chat is not None:
+            session.expire(chat, ['updated_at'])
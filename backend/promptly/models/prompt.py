@@ -88,6 +88,7 @@ class Rule(BaseMixin, IdentityMixin, db.Model):
 
     prompt_id: so.Mapped[int] = so.mapped_column(
         sa.ForeignKey('prompts.id'),
+        index=True,
         nullable=False
     )
 
@@ -123,6 +124,7 @@ class Reference(BaseMixin, IdentityMixin, db.Model):
 
     prompt_id: so.Mapped[int] = so.mapped_column(
         sa.ForeignKey('prompts.id'),
+        index=True,
         nullable=False
     )
 
@@ -149,6 +151,7 @@ class KeyInsight(BaseMixin, IdentityMixin, db.Model):
 
     reference_id: so.Mapped[int] = so.mapped_column(
         sa.ForeignKey('prompt_references.id'),
+        index=True,
         nullable=False
     )
 
@@ -177,6 +180,7 @@ class Criterion(BaseMixin, IdentityMixin, db.Model):
 
     prompt_id: so.Mapped[int] = so.mapped_column(
         sa.ForeignKey('prompts.id'),
+        index=True,
         nullable=False
     )
 
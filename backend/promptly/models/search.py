@@ -0,0 +1,279 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""
+Full-text search over the chat history.
+---------------------------------------
+
+This module searches the content of the chat entries through the full-text
+index of the database:
+
+- on SQLite, the ``chat_entries_fts`` FTS5 table, which indexes the content
+  of ``chat_entries`` and is kept in sync by triggers;
+- on PostgreSQL, the GIN-indexed ``search_vector`` column of
+  ``chat_entries``, which is kept in sync by a trigger.
+
+Both are created by the migrations, and are not declared by the models:
+:func:`include_object` hides them from the autogenerate of Alembic. On other
+databases, the content is scanned with ``LIKE``.
+
+Results are ranked by relevance, highlighted, and paginated with a keyset
+cursor made of the score and the ID of the last result of a page.
+
+"""
+
+import re
+from datetime import datetime
+from typing import List, NamedTuple, Optional, Tuple
+
+import sqlalchemy as sa
+from markupsafe import escape, Markup
+
+from .base import db
+from .chat import Chat, ChatEntry
+
+__all__ = ['SearchResult', 'search_entries']
+
+HIGHLIGHT_START = '\x02'
+"""The marker of the start of a match, replaced by ``<mark>``."""
+
+HIGHLIGHT_STOP = '\x03'
+"""The marker of the end of a match, replaced by ``</mark>``."""
+
+SNIPPET_WORDS = 16
+"""The approximate number of words of a snippet."""
+
+TS_CONFIG = 'english'
+"""The PostgreSQL text search configuration."""
+
+
+class SearchResult(NamedTuple):
+    """A chat entry matching a search query."""
+
+    entry_id: int
+    chat_id: int
+    title: str
+    role: ChatEntry.Role
+    created_at: datetime
+    snippet: Markup
+    score: float
+
+    @property
+    def cursor(self) -> str:
+        """The cursor of the page following this result."""
+        return f'{self.score!r}:{self.entry_id}'
+
+
+def parse_cursor(cursor: Optional[str]) -> Optional[Tuple[float, int]]:
+    """Parse a search cursor.
+
+    :param cursor: The cursor, as returned by :attr:`SearchResult.cursor`.
+    :type cursor: str or None
+    :return: The score and the entry ID, or ``None`` if the cursor is
+        missing or invalid.
+    :rtype: tuple or None
+    """
+    try:
+        score, entry_id = cursor.rsplit(':', 1)
+        return float(score), int(entry_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def highlight(snippet: Optional[str]) -> Markup:
+    """Escape a snippet and turn its match markers into ``<mark>`` tags.
+
+    :param snippet: The snippet returned by the database.
+    :type snippet: str or None
+    :rtype: markupsafe.Markup
+    """
+    escaped = str(escape(snippet or ''))
+    return Markup(
+        escaped
+        .replace(HIGHLIGHT_START, '<mark>')
+        .replace(HIGHLIGHT_STOP, '</mark>')
+    )
+
+
+def include_object(object_, name: str, type_: str, reflected: bool,
+                   compare_to) -> bool:
+    """Tell whether the autogenerate of Alembic compares a schema object.
+
+    This is the ``include_object`` hook of the migrations environment. It
+    excludes the objects of the full-text index, which would otherwise be
+    dropped by the next autogenerated revision.
+
+    :param object_: The schema object.
+    :param str name: The name of the object.
+    :param str type_: The kind of object, e.g. ``table`` or ``index``.
+    :param bool reflected: Whether the object was reflected from the
+        database.
+    :param compare_to: The object it is compared to, or ``None``.
+    :return: ``False`` for the objects of the full-text index.
+    :rtype: bool
+    """
+    if type_ == 'table':
+        # The FTS5 table, and its shadow tables.
+        return not name.startswith('chat_entries_fts')
+    if type_ == 'column':
+        return not (name == 'search_vector'
+                    and object_.table.name == ChatEntry.__tablename__)
+    if type_ == 'index':
+        return name != 'ix_chat_entries_search_vector'
+    return True
+
+
+def fts5_query(text: str) -> str:
+    """Build an FTS5 query matching all the words of a text.
+
+    Words are quoted, so that the FTS5 query syntax cannot be injected, and
+    the last one matches as a prefix.
+
+    :param str text: The text entered by the user.
+    :return: The FTS5 query, or an empty string if there are no words.
+    :rtype: str
+    """
+    words = re.findall(r'\w+', text)
+    if not words:
+        return ''
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+
+def search_entries(text: str, limit: int,
+                   after: Optional[Tuple[float, int]] = None
+                   ) -> List[SearchResult]:
+    """Search the chat entries containing the words of a text.
+
+    Results are ordered by increasing score, i.e. by decreasing relevance,
+    then by decreasing ID.
+
+    :param str text: The text entered by the user.
+    :param int limit: The maximum number of results.
+    :param after: The score and the entry ID of the last result of the
+        previous page, see :func:`parse_cursor`.
+    :type after: tuple or None
+    :return: The matching entries.
+    :rtype: list[SearchResult]
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        ranked = _sqlite_ranked(text)
+    elif dialect == 'postgresql':
+        ranked = _postgresql_ranked(text)
+    else:
+        ranked = _like_ranked(text)
+
+    if ranked is None:
+        return []
+
+    ranked = ranked.subquery()
+    query = (
+        sa.select(
+            ranked.c.id,
+            ranked.c.chat_id,
+            Chat.title,
+            ranked.c.role,
+            ranked.c.created_at,
+            _postgresql_headline(ranked, text)
+            if dialect == 'postgresql' else ranked.c.snippet,
+            ranked.c.score,
+        )
+        .join(Chat, Chat.id == ranked.c.chat_id)
+        .order_by(ranked.c.score, ranked.c.id.desc())
+        .limit(limit)
+    )
+    if after is not None:
+        score, entry_id = after
+        query = query.where(sa.or_(
+            ranked.c.score > score,
+            sa.and_(ranked.c.score == score, ranked.c.id < entry_id),
+        ))
+
+    return [
+        SearchResult(*row[:5], snippet=highlight(row[5]), score=row[6])
+        for row in db.session.execute(query)
+    ]
+
+
+def _entry_columns():
+    return (
+        ChatEntry.id,
+        ChatEntry.chat_id,
+        ChatEntry.role,
+        ChatEntry.created_at,
+    )
+
+
+def _sqlite_ranked(text: str) -> Optional[sa.Select]:
+    match = fts5_query(text)
+    if not match:
+        return None
+
+    fts = sa.table('chat_entries_fts', sa.column('rowid'))
+    fts_column = sa.literal_column('chat_entries_fts')
+    return (
+        sa.select(
+            *_entry_columns(),
+            sa.func.snippet(
+                fts_column, 0, HIGHLIGHT_START, HIGHLIGHT_STOP, '…',
+                SNIPPET_WORDS,
+            ).label('snippet'),
+            # BM25 scores are negative, the lower the better.
+            sa.func.bm25(fts_column).label('score'),
+        )
+        .select_from(fts)
+        .join(ChatEntry, ChatEntry.id == fts.c.rowid)
+        .where(fts_column.op('MATCH')(match))
+    )
+
+
+def _postgresql_tsquery(text: str):
+    return sa.func.websearch_to_tsquery(TS_CONFIG, text)
+
+
+def _postgresql_ranked(text: str) -> Optional[sa.Select]:
+    if not text.strip():
+        return None
+
+    search_vector = sa.literal_column('chat_entries.search_vector')
+    tsquery = _postgresql_tsquery(text)
+    return (
+        sa.select(
+            *_entry_columns(),
+            ChatEntry.content,
+            # Negated, so that the lower the score the better, as on SQLite.
+            (-sa.func.ts_rank_cd(search_vector, tsquery)).label('score'),
+        )
+        .where(search_vector.op('@@')(tsquery))
+    )
+
+
+def _postgresql_headline(ranked, text: str):
+    # Headlines are computed on the page only, they are expensive.
+    return sa.func.ts_headline(
+        TS_CONFIG,
+        ranked.c.content,
+        _postgresql_tsquery(text),
+        f'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, '
+        f'MaxWords={SNIPPET_WORDS}, MinWords={SNIPPET_WORDS // 2}',
+    )
+
+
+def _like_ranked(text: str) -> Optional[sa.Select]:
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+
+    return (
+        sa.select(
+            *_entry_columns(),
+            sa.func.substr(ChatEntry.content, 1, 200).label('snippet'),
+            sa.literal(0.0).label('score'),
+        )
+        .where(*(ChatEntry.content.contains(word, autoescape=True)
+                 for word in words))
+    )
@@ -0,0 +1,451 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""
+Sampling profiler of the requests.
+----------------------------------
+
+This module provides an opt-in profiler for the requests of the application,
+meant to find where the time of a slow request goes in production:
+
+- the :class:`.ProfilingMiddleware` profiles every request, or a sampled
+  fraction of them, until its response has been sent;
+- a :class:`.Profile` samples the stack of the thread handling the request
+  at a fixed interval, from a background thread, so that the request itself
+  runs at full speed;
+- the samples taken during a SQL query, or an OpenAI API call, see
+  :func:`.span`, are annotated with a ``[sql]`` or ``[openai]`` frame;
+- the profiles are written to a :class:`.ProfileStore`, a ring buffer of
+  files in the "folded stacks" format, which flame graph tools read
+  (e.g. ``flamegraph.pl``, ``inferno-flamegraph`` or speedscope).
+
+Usage::
+
+    $ export PROMPTLY_PROFILE_SAMPLE_RATE=0.01
+    $ flask --app runner:app run
+    $ flask --app runner:app profiles list
+    $ flask --app runner:app profiles dump 20231021T101500123-4242-1 \\
+        | flamegraph.pl > profile.svg
+
+"""
+
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from os import environ as env
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import sqlalchemy as sa
+from werkzeug.wsgi import ClosingIterator
+
+from promptly.utils import strtobool
+
+logger = logging.getLogger(__name__)
+
+PROMPTLY_PROFILE: bool = strtobool(env.get('PROMPTLY_PROFILE', 'false'))
+"""Whether to profile every request.
+
+This constant uses the value of the ``PROMPTLY_PROFILE`` environment
+variable, if set, or defaults to ``False``.
+"""
+
+PROMPTLY_PROFILE_SAMPLE_RATE: float = float(
+    env.get('PROMPTLY_PROFILE_SAMPLE_RATE', 0.0))
+"""The fraction of the requests to profile.
+
+This constant uses the value of the ``PROMPTLY_PROFILE_SAMPLE_RATE``
+environment variable, if set, or defaults to 0, i.e. no request is profiled
+unless :const:`PROMPTLY_PROFILE` is set.
+"""
+
+PROMPTLY_PROFILE_INTERVAL: float = float(
+    env.get('PROMPTLY_PROFILE_INTERVAL', 0.005))
+"""The time, in seconds, between two samples of a profiled request.
+
+This constant uses the value of the ``PROMPTLY_PROFILE_INTERVAL``
+environment variable, if set, or defaults to 5 milliseconds.
+"""
+
+PROMPTLY_PROFILE_DIR: str = env.get('PROMPTLY_PROFILE_DIR', '')
+"""The directory the profiles are written to.
+
+This constant uses the value of the ``PROMPTLY_PROFILE_DIR`` environment
+variable, if set, or defaults to the ``profiles`` directory of the instance
+folder.
+"""
+
+PROMPTLY_PROFILE_MAX_FILES: int = int(
+    env.get('PROMPTLY_PROFILE_MAX_FILES', 100))
+"""The number of profiles kept, the oldest ones being deleted first.
+
+This constant uses the value of the ``PROMPTLY_PROFILE_MAX_FILES``
+environment variable, if set, or defaults to 100 profiles.
+"""
+
+SPAN_LABEL_LENGTH = 60
+"""The maximum length of the label of a span."""
+
+# The labels of the spans in progress, by profiled thread.
+_spans: Dict[int, List[str]] = {}
+
+
+@contextmanager
+def span(label: str):
+    """Annotate the samples taken while running a block of code.
+
+    The label is added as a frame on top of the stack of the samples, so
+    that the time spent, e.g. waiting for a SQL query, stands out in the
+    flame graph. This does nothing if the current thread is not profiled.
+
+    :param str label: The label of the span, e.g. ``[openai] gpt-4``.
+    """
+    spans = _spans.get(threading.get_ident())
+    if spans is None:
+        yield
+        return
+
+    spans.append(_clean_label(label))
+    try:
+        yield
+    finally:
+        spans.pop()
+
+
+def _clean_label(label: str) -> str:
+    """Make a label fit into a frame of the folded stacks format."""
+    label = ' '.join(label.replace(';', ',').split())
+    if len(label) > SPAN_LABEL_LENGTH:
+        label = label[:SPAN_LABEL_LENGTH - 3] + '...'
+    return label
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    module = frame.f_globals.get('__name__', '?')
+    name = getattr(code, 'co_qualname', code.co_name)
+    return f'{module}:{name}'
+
+
+class Profile:
+    """The stack samples of a thread.
+
+    Usage::
+
+        profile = Profile()
+        profile.start()
+        handle_request()
+        profile.stop()
+        print(profile.folded())
+
+    """
+
+    def __init__(self, thread_id: Optional[int] = None,
+                 interval: float = PROMPTLY_PROFILE_INTERVAL):
+        """Initialize the profile of a thread.
+
+        :param thread_id: The identifier of the profiled thread. Defaults to
+            the current thread.
+        :type thread_id: int, optional
+        :param float interval: The time, in seconds, between two samples.
+        """
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.started_at: Optional[datetime] = None
+        self.duration = 0.0
+
+        self._start = 0.0
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start sampling the stack of the thread."""
+        _spans[self.thread_id] = []
+        self.started_at = datetime.now(timezone.utc)
+        self._start = time.perf_counter()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='promptly-profiler',
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling."""
+        self._stopped.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self._start
+        _spans.pop(self.thread_id, None)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.reverse()
+            stack.extend(_spans.get(self.thread_id, ()))
+
+            self.stacks[';'.join(stack)] += 1
+            self.samples += 1
+
+    def folded(self) -> str:
+        """Get the samples in the folded stacks format.
+
+        Each line is a stack, from the root to the leaf, its frames
+        separated by semicolons, followed by its number of samples.
+
+        :return: The folded stacks.
+        :rtype: str
+        """
+        return ''.join(
+            f'{stack} {count}\n'
+            for stack, count in self.stacks.most_common()
+        )
+
+
+class ProfileStore:
+    """A directory of profiles, keeping only the most recent ones.
+
+    Every profile is written as two files named after its identifier: the
+    folded stacks, with the ``.folded`` extension, and the metadata of the
+    profiled request, with the ``.json`` extension. The identifiers sort
+    in chronological order.
+    """
+
+    def __init__(self, directory: str,
+                 max_profiles: int = PROMPTLY_PROFILE_MAX_FILES):
+        """Initialize the store.
+
+        :param str directory: The directory of the profiles, created on
+            first write.
+        :param int max_profiles: The number of profiles kept.
+        """
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self._ids = itertools.count(1)
+
+    def save(self, profile: Profile, **metadata: Any) -> str:
+        """Write a profile, and delete the oldest ones beyond the limit.
+
+        :param profile: The stopped profile.
+        :type profile: Profile
+        :param metadata: The description of the profiled request.
+        :return: The identifier of the profile.
+        :rtype: str
+        """
+        started_at = profile.started_at
+        profile_id = '{}{:03d}-{}-{}'.format(
+            started_at.strftime('%Y%m%dT%H%M%S'),
+            started_at.microsecond // 1000,
+            os.getpid(),
+            next(self._ids),
+        )
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._write(f'{profile_id}.folded', profile.folded())
+        # The metadata is written last: a profile is listed once complete.
+        self._write(f'{profile_id}.json', json.dumps({
+            'id': profile_id,
+            'started_at': started_at.isoformat(),
+            'duration': profile.duration,
+            'samples': profile.samples,
+            'interval': profile.interval,
+            **metadata,
+        }))
+
+        self._prune()
+        return profile_id
+
+    def list(self) -> List[Dict[str, Any]]:
+        """Get the metadata of the profiles, most recent first.
+
+        :return: The metadata of each profile.
+        :rtype: list[dict]
+        """
+        profiles = []
+        for name in self._names():
+            try:
+                with open(os.path.join(self.directory, name),
+                          encoding='utf-8') as metadata_file:
+                    profiles.append(json.load(metadata_file))
+            except (OSError, ValueError):
+                # Deleted by another process in the meantime, or corrupted.
+                continue
+        return profiles
+
+    def load(self, profile_id: str) -> str:
+        """Read the folded stacks of a profile.
+
+        :param str profile_id: The identifier of the profile.
+        :return: The folded stacks.
+        :rtype: str
+        :raises KeyError: If there is no such profile.
+        """
+        if os.path.basename(profile_id) != profile_id:
+            raise KeyError(profile_id)
+        try:
+            with open(os.path.join(self.directory, f'{profile_id}.folded'),
+                      encoding='utf-8') as folded_file:
+                return folded_file.read()
+        except FileNotFoundError as exc:
+            raise KeyError(profile_id) from exc
+
+    def _names(self) -> List[str]:
+        """Get the names of the metadata files, most recent first."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(
+            (name for name in names if name.endswith('.json')),
+            reverse=True,
+        )
+
+    def _write(self, name: str, content: str):
+        path = os.path.join(self.directory, name)
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as tmp_file:
+            tmp_file.write(content)
+        os.replace(f'{path}.tmp', path)
+
+    def _prune(self):
+        for name in self._names()[self.max_profiles:]:
+            stem = name[:-len('.json')]
+            for extension in ('.json', '.folded'):
+                try:
+                    os.remove(os.path.join(self.directory, stem + extension))
+                except FileNotFoundError:
+                    pass
+
+
+class ProfilingMiddleware:
+    """A WSGI middleware profiling a sampled fraction of the requests.
+
+    A request is profiled until its response has been sent, so that the
+    profile of a streamed response covers its generation. The profiles are
+    written to a :class:`.ProfileStore` along with the method, the path
+    and the status of their request. Profiles without any sample, i.e. of
+    requests shorter than the sampling interval, are discarded.
+    """
+
+    def __init__(self, wsgi_app: Callable, store: ProfileStore,
+                 sample_rate: float = 1.0,
+                 interval: float = PROMPTLY_PROFILE_INTERVAL):
+        """Wrap a WSGI application.
+
+        :param wsgi_app: The WSGI application.
+        :param store: The store of the profiles.
+        :type store: ProfileStore
+        :param float sample_rate: The fraction of the requests to profile.
+        :param float interval: The time, in seconds, between two samples.
+        """
+        self.wsgi_app = wsgi_app
+        self.store = store
+        self.sample_rate = sample_rate
+        self.interval = interval
+
+    def __call__(self, environ: Dict[str, Any],
+                 start_response: Callable) -> Iterator[bytes]:
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return self.wsgi_app(environ, start_response)
+
+        profile = Profile(interval=self.interval)
+        statuses = []
+
+        def profiled_start_response(status, headers, exc_info=None):
+            statuses.append(int(status.split(' ', 1)[0]))
+            return start_response(status, headers, exc_info)
+
+        def finish():
+            self._finish(profile, environ, statuses[-1] if statuses else 500)
+
+        profile.start()
+        try:
+            response = self.wsgi_app(environ, profiled_start_response)
+        except BaseException:  # noqa: B902 - re-raised below
+            finish()
+            raise
+
+        return ClosingIterator(response, finish)
+
+    def _finish(self, profile: Profile, environ: Dict[str, Any],
+                status: int):
+        profile.stop()
+        if not profile.samples:
+            return
+
+        try:
+            profile_id = self.store.save(
+                profile,
+                method=environ.get('REQUEST_METHOD'),
+                path=environ.get('PATH_INFO'),
+                status=status,
+            )
+        except OSError as exc:
+            logger.warning('Failed to save the profile of %s: %s',
+                           environ.get('PATH_INFO'), exc)
+        else:
+            logger.info('Profiled %s in %s', environ.get('PATH_INFO'),
+                        profile_id)
+
+
+def init_app(app, store: ProfileStore, sample_rate: float):
+    """Profile a sampled fraction of the requests of an application.
+
+    Also annotates the SQL queries run by the profiled requests.
+
+    :param app: The Flask application instance.
+    :type app: :class:`flask.Flask`
+    :param store: The store of the profiles.
+    :type store: ProfileStore
+    :param float sample_rate: The fraction of the requests to profile.
+    """
+    app.wsgi_app = ProfilingMiddleware(app.wsgi_app, store, sample_rate)
+
+    # The listeners are shared by all the engines, and only registered once.
+    if not sa.event.contains(sa.engine.Engine, 'before_cursor_execute',
+                             _before_cursor_execute):
+        sa.event.listen(sa.engine.Engine, 'before_cursor_execute',
+                        _before_cursor_execute)
+        sa.event.listen(sa.engine.Engine, 'after_cursor_execute',
+                        _after_cursor_execute)
+        sa.event.listen(sa.engine.Engine, 'handle_error', _handle_error)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    spans = _spans.get(threading.get_ident())
+    if spans is not None:
+        spans.append(_clean_label(f'[sql] {statement}'))
+        context._promptly_span = spans
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    spans = getattr(context, '_promptly_span', None)
+    if spans:
+        spans.pop()
+        context._promptly_span = None
+
+
+def _handle_error(exception_context):
+    context = exception_context.execution_context
+    if context is not None:
+        _after_cursor_execute(None, None, None, None, context, None)
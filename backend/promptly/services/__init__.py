@@ -15,4 +15,8 @@ OpenAI API.
 
 """
 
-from .openai_service import OpenAIService  # noqa: F401
+from .context_builder import (  # noqa: F401
+    ContextBuilder,
+    ContextTooLargeError,
+)
+from .openai_service import Completion, OpenAIService  # noqa: F401
@@ -0,0 +1,156 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""
+Conversation Context Builder.
+-----------------------------
+
+The :mod:`promptly.services.context_builder` module assembles the messages
+sent to OpenAI from the history of a chat, through the
+:class:`.ContextBuilder` class. Only the most recent messages that fit into
+the token budget of the model are sent, so that the request size stays
+bounded however long the chat is.
+
+"""
+
+import os
+from typing import Dict, List
+
+from promptly.models import ChatEntry
+from promptly.tokenizer import count_message_tokens, encoding_name
+
+CONTEXT_WINDOWS = {
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16385,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+}
+"""The context window size, in tokens, of the known models."""
+
+DEFAULT_CONTEXT_WINDOW = 4096
+"""The context window size assumed for unknown models."""
+
+
+class ContextTooLargeError(ValueError):
+    """Raised when the latest message of a chat exceeds the token budget.
+
+    Attributes:
+        tokens (int): The number of tokens of the message.
+        budget (int): The maximum number of prompt tokens.
+    """
+
+    def __init__(self, tokens: int, budget: int):
+        """Initialize the error with the size of the message and the budget."""
+        super().__init__(
+            f'The message is too long: {tokens} tokens, '
+            f'at most {budget} allowed'
+        )
+        self.tokens = tokens
+        self.budget = budget
+
+
+def context_window(model: str) -> int:
+    """Get the context window size of a model.
+
+    The size is read from the ``OPENAI_CONTEXT_WINDOW`` environment variable,
+    if set. Otherwise, it is looked up by the longest known model name the
+    given model starts with (e.g. ``gpt-4-0613`` is a ``gpt-4`` model).
+
+    :param str model: The name of the OpenAI model.
+    :return: The number of tokens the model can process per request.
+    :rtype: int
+    """
+    if os.getenv('OPENAI_CONTEXT_WINDOW'):
+        return int(os.getenv('OPENAI_CONTEXT_WINDOW'))
+
+    for name in sorted(CONTEXT_WINDOWS, key=len, reverse=True):
+        if model.startswith(name):
+            return CONTEXT_WINDOWS[name]
+
+    return DEFAULT_CONTEXT_WINDOW
+
+
+class ContextBuilder:
+    """
+    Build the messages of a chat completion request from a chat history.
+
+    Attributes:
+        model (str): The model the messages are built for.
+        budget (int): The maximum number of prompt tokens. This is the
+            context window of the model minus the tokens reserved for the
+            completion.
+        batch_size (int): The number of entries loaded at a time.
+    """
+
+    def __init__(self, model: str, max_tokens: int, batch_size: int = 20):
+        """Initialize the builder for a model and a completion size.
+
+        :param str model: The name of the OpenAI model.
+        :param int max_tokens: The maximum number of tokens of the
+            completion, which are reserved in the context window.
+        :param int batch_size: The number of entries loaded at a time.
+        """
+        self.model = model
+        self.budget = context_window(model) - max_tokens
+        self.batch_size = batch_size
+
+    def check(self, message: Dict[str, str]):
+        """Check that a new message fits into the budget on its own.
+
+        :param dict message: The message, with its ``role`` and ``content``.
+        :raises ContextTooLargeError: If the message exceeds the budget, in
+            which case :meth:`build` would reject it once stored.
+        """
+        tokens = count_message_tokens(message, self.model)
+        if tokens > self.budget:
+            raise ContextTooLargeError(tokens, self.budget)
+
+    def build(self, chat_id: int) -> List[Dict[str, str]]:
+        """Build the messages for the latest entries of a chat.
+
+        Entries are loaded newest first, in batches, and their tokens are
+        counted as they come. Loading stops as soon as the budget is
+        exhausted, so that older entries are never read.
+
+        :param int chat_id: The ID of the chat.
+        :return: The messages, oldest first.
+        :rtype: list[dict]
+        :raises ContextTooLargeError: If the most recent entry exceeds the
+            budget on its own, since OpenAI would reject it anyway.
+        """
+        encoding = encoding_name(self.model)
+        messages, used, before = [], 0, None
+
+        while True:
+            entries = ChatEntry.window(
+                chat_id,
+                limit=self.batch_size,
+                before=before,
+            )
+
+            for entry in reversed(entries):
+                message = {'role': str(entry.role), 'content': entry.content}
+                tokens = count_message_tokens(
+                    message,
+                    self.model,
+                    # Reuse the count stored at insert time, if it was made
+                    # with the encoding of this model.
+                    entry.token_count
+                    if entry.token_encoding == encoding else None,
+                )
+                if used + tokens > self.budget:
+                    if not messages:
+                        raise ContextTooLargeError(tokens, self.budget)
+                    return messages[::-1]
+
+                messages.append(message)
+                used += tokens
+
+            if len(entries) < self.batch_size:
+                return messages[::-1]
+
+            before = entries[0].id
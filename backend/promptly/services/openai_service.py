@@ -16,13 +16,27 @@ It handles query construction, API calls, and response extraction.
 """
 
 import logging
-import os
+from typing import Any, Dict, NamedTuple, Optional
 
-from promptly.api.openai_eval import completion
+from promptly.api.openai_eval import completion, CompletionStream, \
+    stream_completion
+from promptly.models import ChatEntry
+from promptly.services.context_builder import ContextBuilder
+from promptly.services.semantic_cache import get_semantic_cache, SemanticCache
+from promptly.tokenizer import default_model
 
 logger = logging.getLogger(__name__)
 
 
+class Completion(NamedTuple):
+    """A model's response along with the usage reported by OpenAI."""
+
+    content: str
+    model: str
+    prompt_tokens: Optional[int]
+    completion_tokens: Optional[int]
+
+
 class OpenAIService:
     """
     A service class for interacting with the OpenAI API.
@@ -33,33 +47,146 @@ class OpenAIService:
             ``OPENAI_MODEL``. For details on available models, see
             the `OpenAI API documentation
             <https://platform.openai.com/docs/models/overview>`_.
+        max_tokens (int): The maximum number of tokens of a response.
+        context_builder (ContextBuilder): The builder of the conversation
+            context sent along with a query.
+        semantic_cache (SemanticCache): The cache answering queries similar
+            to already answered ones, or ``None`` if it is disabled.
     """
 
     def __init__(self):
         """Initialize the OpenAIService with the specified model."""
-        self.model = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')
+        self.model = default_model()
+        self.max_tokens = 2048
+        self.context_builder = ContextBuilder(self.model, self.max_tokens)
+        self.semantic_cache = get_semantic_cache()
 
-    def get_response(self, query: str) -> str:
+    def get_response(self, query: str, chat_id: Optional[int] = None) -> str:
         """
         Send a query to OpenAI and return the model's response.
 
         The method constructs a message from the query, sends it to OpenAI for
         processing, and extracts the response from OpenAI's reply.
 
+        If ``chat_id`` is given, the latest entries of the chat are sent
+        instead, as far as they fit into the token budget of the model. The
+        query is then expected to be the latest entry of the chat.
+
         :param query: The user's message.
         :type query: str
+        :param chat_id: The ID of the chat the query belongs to.
+        :type chat_id: int, optional
         :return: The model's response.
         :rtype: str
         """
-        response = completion(
-            messages=[{'role': 'user', 'content': query}],
-            model=self.model,
-            temperature=0,
-            max_tokens=2048,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0
+        return self.complete(query, chat_id).content
+
+    def complete(self, query: str,
+                 chat_id: Optional[int] = None) -> Completion:
+        """
+        Send a query to OpenAI and return the model's response and usage.
+
+        Works like :meth:`get_response`, but also returns the model which
+        generated the response and the number of tokens it consumed.
+
+        On the first turn of a chat, the query is looked up in the semantic
+        cache first, if enabled. A hit is reported with the
+        :attr:`.SemanticCache.MODEL` model and no usage. A response served
+        from the response cache has no usage either, since it was not billed.
+
+        :param query: The user's message.
+        :type query: str
+        :param chat_id: The ID of the chat the query belongs to.
+        :type chat_id: int, optional
+        :return: The model's response.
+        :rtype: Completion
+        """
+        params = self._build_params(query, chat_id)
+
+        # Answers only depend on the query on the first turn of a chat.
+        if self.semantic_cache and len(params['messages']) == 1:
+            entry = self.semantic_cache.lookup(query)
+            if entry is not None:
+                return Completion(entry.content, SemanticCache.MODEL,
+                                  None, None)
+
+        response = completion(**params)
+
+        logger.debug('OpenAI response: %s', response)
+        usage = response.get('usage') or {}
+        return Completion(
+            content=response['choices'][0]['message']['content'],
+            model=response.get('model', self.model),
+            prompt_tokens=usage.get('prompt_tokens'),
+            completion_tokens=usage.get('completion_tokens'),
         )
 
-        logger.debug('OpenAI response: {}', response)
-        return response['choices'][0]['message']['content']
+    def check(self, query: str):
+        """
+        Check that a query fits into the context of the model.
+
+        This is meant to be called before the query is stored, so that a
+        rejected query is never sent along with the next ones.
+
+        :param query: The user's message.
+        :type query: str
+        :raises ContextTooLargeError: If the query is too long on its own.
+        """
+        self.context_builder.check({'role': 'user', 'content': query})
+
+    def remember(self, query: str, entry: ChatEntry):
+        """
+        Let the semantic cache know about the answer to a query, if enabled.
+
+        :param query: The user's message.
+        :type query: str
+        :param entry: The persisted answer.
+        :type entry: ChatEntry
+        """
+        if self.semantic_cache:
+            self.semantic_cache.remember(query, entry)
+
+    def stream_response(
+        self,
+        query: str,
+        chat_id: Optional[int] = None,
+    ) -> CompletionStream:
+        """
+        Send a query to OpenAI and stream the model's response.
+
+        Works like :meth:`get_response`, but yields the response in chunks
+        as soon as OpenAI generates them. The call is admitted, or rejected,
+        before this method returns, see
+        :func:`promptly.api.openai_eval.stream_completion`.
+
+        :param query: The user's message.
+        :type query: str
+        :param chat_id: The ID of the chat the query belongs to.
+        :type chat_id: int, optional
+        :return: An iterator over the model's response chunks, to be closed
+            if it is not exhausted.
+        :rtype: promptly.api.openai_eval.CompletionStream
+        :raises OverloadedError: If the call cannot be made now.
+        """
+        return stream_completion(**self._build_params(query, chat_id))
+
+    def _build_params(
+        self,
+        query: str,
+        chat_id: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """Build the chat completion request parameters for a query."""
+        if chat_id is None:
+            messages = [{'role': 'user', 'content': query}]
+        else:
+            messages = self.context_builder.build(chat_id)
+
+        return {
+            'messages': messages,
+            'model': self.model,
+            'temperature': 0,
+            'max_tokens': self.max_tokens,
+            'top_p': 1,
+            'frequency_penalty': 0,
+            'presence_penalty': 0,
+        }
@@ -0,0 +1,466 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""
+Semantic Response Cache.
+------------------------
+
+The :mod:`promptly.services.semantic_cache` module answers queries which are
+near-duplicates of already answered ones ("what is 2+2" and "what's 2 + 2?")
+with the stored answer, through the :class:`.SemanticCache` class.
+
+Queries are embedded locally with the :class:`.HashingVectorizer`, and their
+nearest neighbor is looked up in an in-process :class:`.VectorIndex`: a NumPy
+matrix searched by brute force, or an HNSW graph if `hnswlib`_ is installed
+and enabled. An answer is reused if the cosine similarity of the queries
+reaches the configured threshold.
+
+Only the first turn of a chat is cached: later answers depend on the history
+of the chat, not only on the query.
+
+This stage requires NumPy, and is disabled unless ``PROMPTLY_SEMANTIC_CACHE``
+is set.
+
+.. _hnswlib: https://github.com/nmslib/hnswlib
+
+"""
+
+import logging
+import os
+import re
+import threading
+import zlib
+from typing import List, Optional, Tuple
+
+import sqlalchemy as sa
+from sqlalchemy import orm as so
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+try:
+    import hnswlib
+except ImportError:  # pragma: no cover
+    hnswlib = None
+
+from promptly.metrics import registry
+from promptly.models import ChatEntry, db
+from promptly.utils import strtobool
+
+logger = logging.getLogger(__name__)
+
+PROMPTLY_SEMANTIC_CACHE: bool = strtobool(
+    os.getenv('PROMPTLY_SEMANTIC_CACHE', 'False'))
+"""The flag enabling the semantic cache.
+
+This constant uses the ``PROMPTLY_SEMANTIC_CACHE`` environment variable,
+converted to a boolean value using the :func:`.strtobool` function.
+"""
+
+PROMPTLY_SEMANTIC_CACHE_THRESHOLD: float = float(
+    os.getenv('PROMPTLY_SEMANTIC_CACHE_THRESHOLD', 0.92))
+"""The minimum cosine similarity of two queries sharing an answer.
+
+This constant uses the value of the ``PROMPTLY_SEMANTIC_CACHE_THRESHOLD``
+environment variable, if set, or defaults to 0.92.
+"""
+
+PROMPTLY_SEMANTIC_CACHE_ANN: bool = strtobool(
+    os.getenv('PROMPTLY_SEMANTIC_CACHE_ANN', 'False'))
+"""The flag enabling the approximate nearest neighbor index.
+
+This constant uses the ``PROMPTLY_SEMANTIC_CACHE_ANN`` environment variable,
+converted to a boolean value using the :func:`.strtobool` function. It has
+no effect unless ``hnswlib`` is installed.
+"""
+
+CONTRACTIONS = (
+    ("n't", ' not'),
+    ("'re", ' are'),
+    ("'s", ' is'),
+    ("'m", ' am'),
+    ("'ll", ' will'),
+    ("'ve", ' have'),
+    ("'d", ' would'),
+)
+"""The English contractions expanded before vectorizing a text."""
+
+_requests_total = registry.counter(
+    'promptly_semantic_cache_requests_total',
+    'Number of semantic cache lookups.',
+    labelnames=('result',),
+)
+
+
+class HashingVectorizer:
+    """Embed texts into fixed-size vectors without any trained model.
+
+    The words of the text and the character trigrams of each word are
+    hashed into ``dim`` buckets, with a hashed sign to reduce the bias of
+    collisions. The vectors are L2-normalized, so that their dot product is
+    their cosine similarity.
+    """
+
+    def __init__(self, dim: int = 384):
+        """Initialize the vectorizer.
+
+        :param int dim: The number of dimensions of the vectors.
+        """
+        self.dim = dim
+
+    @staticmethod
+    def features(text: str) -> List[str]:
+        """Get the features of a text: its words and their trigrams.
+
+        :param str text: The text.
+        :rtype: list[str]
+        """
+        text = text.lower().replace('’', "'")
+        for contraction, expansion in CONTRACTIONS:
+            text = text.replace(contraction, expansion)
+
+        words = re.findall(r'\w+', text)
+        features = [f'w:{word}' for word in words]
+        for word in words:
+            padded = f'<{word}>'
+            features.extend(
+                f't:{padded[i:i + 3]}' for i in range(len(padded) - 2))
+        return features
+
+    def transform(self, text: str) -> 'np.ndarray':
+        """Embed a text.
+
+        :param str text: The text.
+        :return: The unit vector of the text, or a zero vector if the text
+            has no words.
+        :rtype: numpy.ndarray
+        """
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in self.features(text):
+            digest = zlib.crc32(feature.encode('utf-8'))
+            sign = 1.0 if digest & 0x80000000 else -1.0
+            vector[digest % self.dim] += sign
+
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class VectorIndex:
+    """An exact nearest neighbor index over unit vectors.
+
+    Vectors are stored in a preallocated matrix, which doubles in size when
+    full, so that adding a vector takes amortized constant time. Lookups
+    compute the dot product of the query with every stored vector.
+    """
+
+    def __init__(self, dim: int, capacity: int = 1024):
+        """Initialize an empty index.
+
+        :param int dim: The number of dimensions of the vectors.
+        :param int capacity: The number of vectors preallocated.
+        """
+        self.dim = dim
+        self._lock = threading.Lock()
+        self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self._ids = np.zeros(capacity, dtype=np.int64)
+        self._size = 0
+
+    def __len__(self) -> int:
+        """Get the number of vectors in the index."""
+        return self._size
+
+    @property
+    def nbytes(self) -> int:
+        """The memory allocated by the index, in bytes."""
+        return self._vectors.nbytes + self._ids.nbytes
+
+    def add(self, ids: 'np.ndarray', vectors: 'np.ndarray'):
+        """Add vectors to the index.
+
+        :param ids: The IDs of the vectors, one per row of ``vectors``.
+        :param vectors: The unit vectors, one per row.
+        """
+        count = len(ids)
+        with self._lock:
+            size = self._size + count
+            if size > len(self._ids):
+                capacity = max(size, 2 * len(self._ids))
+                self._vectors = _resize(self._vectors, capacity)
+                self._ids = _resize(self._ids, capacity)
+
+            self._vectors[self._size:size] = vectors
+            self._ids[self._size:size] = ids
+            self._size = size
+
+    def search(self, vector: 'np.ndarray',
+               k: int = 1) -> List[Tuple[int, float]]:
+        """Find the nearest neighbors of a vector.
+
+        :param vector: The unit vector to search for.
+        :param int k: The number of neighbors.
+        :return: The IDs of the neighbors and their cosine similarities,
+            most similar first.
+        :rtype: list[tuple[int, float]]
+        """
+        # Rows below the size are never written again, hence they can be
+        # read outside the lock.
+        with self._lock:
+            vectors = self._vectors[:self._size]
+            ids = self._ids[:self._size]
+
+        if not len(ids):
+            return []
+
+        scores = vectors @ vector
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i]), float(scores[i])) for i in top]
+
+
+class HnswIndex:
+    """An approximate nearest neighbor index, backed by ``hnswlib``.
+
+    Lookups take logarithmic time, at the cost of a larger memory footprint
+    and of a slower insertion than :class:`.VectorIndex`.
+    """
+
+    def __init__(self, dim: int, capacity: int = 1024):
+        """Initialize an empty index.
+
+        :param int dim: The number of dimensions of the vectors.
+        :param int capacity: The number of vectors preallocated.
+        """
+        self.dim = dim
+        self._lock = threading.Lock()
+        self._index = hnswlib.Index(space='ip', dim=dim)
+        self._index.init_index(max_elements=capacity, ef_construction=200,
+                               M=16)
+        self._index.set_ef(64)
+
+    def __len__(self) -> int:
+        """Get the number of vectors in the index."""
+        return self._index.get_current_count()
+
+    def add(self, ids: 'np.ndarray', vectors: 'np.ndarray'):
+        """Add vectors to the index."""
+        with self._lock:
+            size = len(self) + len(ids)
+            if size > self._index.get_max_elements():
+                self._index.resize_index(
+                    max(size, 2 * self._index.get_max_elements()))
+            self._index.add_items(vectors, ids)
+
+    def search(self, vector: 'np.ndarray',
+               k: int = 1) -> List[Tuple[int, float]]:
+        """Find the approximate nearest neighbors of a vector."""
+        k = min(k, len(self))
+        if not k:
+            return []
+
+        labels, distances = self._index.knn_query(vector, k=k)
+        # The inner product distance is one minus the similarity.
+        return [
+            (int(label), 1.0 - float(distance))
+            for label, distance in zip(labels[0], distances[0])
+        ]
+
+
+def _resize(array: 'np.ndarray', capacity: int) -> 'np.ndarray':
+    resized = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+    resized[:len(array)] = array
+    return resized
+
+
+def create_index(dim: int, ann: bool = PROMPTLY_SEMANTIC_CACHE_ANN):
+    """Create a vector index.
+
+    :param int dim: The number of dimensions of the vectors.
+    :param bool ann: Whether to use an approximate index, if available.
+    :rtype: VectorIndex or HnswIndex
+    """
+    if ann and hnswlib is not None:
+        return HnswIndex(dim)
+    if ann:
+        logger.warning('hnswlib is not installed, using an exact index')
+    return VectorIndex(dim)
+
+
+class SemanticCache:
+    """
+    Reuse the answers to queries similar to a new one.
+
+    The index maps the embedding of the first query of each chat to the ID
+    of the answer to it. It is built from the database on first use, and
+    kept up to date with :meth:`remember`.
+
+    Attributes:
+        threshold (float): The minimum cosine similarity of two queries
+            sharing an answer.
+        vectorizer (HashingVectorizer): The query vectorizer.
+        index (VectorIndex): The index of the answered queries.
+    """
+
+    MODEL = 'semantic-cache'
+    """The model recorded for the answers served from the cache."""
+
+    def __init__(self, threshold: float = PROMPTLY_SEMANTIC_CACHE_THRESHOLD,
+                 vectorizer: Optional[HashingVectorizer] = None,
+                 index=None):
+        """Initialize the cache.
+
+        :param float threshold: The minimum similarity of two queries.
+        :param vectorizer: The query vectorizer.
+        :param index: The index of the answered queries.
+        """
+        self.threshold = threshold
+        self.vectorizer = vectorizer or HashingVectorizer()
+        self.index = index or create_index(self.vectorizer.dim)
+        self._built = False
+        self._build_lock = threading.Lock()
+
+    def lookup(self, query: str) -> Optional[ChatEntry]:
+        """Find the answer to a query similar to the given one.
+
+        :param str query: The user's message.
+        :return: The answer, or ``None`` if no query is similar enough.
+        :rtype: ChatEntry or None
+        """
+        self._ensure_built()
+        neighbors = self.index.search(self.vectorizer.transform(query))
+
+        entry = None
+        if neighbors and neighbors[0][1] >= self.threshold:
+            entry = db.session.get(ChatEntry, neighbors[0][0])
+
+        _requests_total.inc(result='miss' if entry is None else 'hit')
+        return entry
+
+    def add(self, query: str, entry_id: int):
+        """Add the answer to a query to the cache.
+
+        :param str query: The user's message.
+        :param int entry_id: The ID of the answer.
+        """
+        self.index.add(
+            np.array([entry_id], dtype=np.int64),
+            self.vectorizer.transform(query)[np.newaxis],
+        )
+
+    def remember(self, query: str, entry: ChatEntry):
+        """Add an answer to the cache, if it is the first one of its chat.
+
+        Answers served from the cache are not added again.
+
+        :param str query: The user's message.
+        :param ChatEntry entry: The answer.
+        """
+        if entry.model == self.MODEL:
+            return
+
+        count = db.session.scalar(
+            sa.select(sa.func.count(ChatEntry.id))
+            .where(ChatEntry.chat_id == entry.chat_id)
+        )
+        if count != 2:
+            return
+
+        # The first build reads the entry from the database already.
+        if self._built:
+            self.add(query, entry.id)
+        else:
+            self._ensure_built()
+
+    def rebuild(self, batch_size: int = 1000) -> int:
+        """Index the first turn of every chat stored in the database.
+
+        The turns are streamed from the database and embedded in batches of
+        ``batch_size``, so that the whole history never sits in memory.
+
+        :param int batch_size: The number of turns per batch.
+        :return: The number of indexed answers.
+        :rtype: int
+        """
+        ranked = (
+            sa.select(
+                ChatEntry.id,
+                ChatEntry.chat_id,
+                ChatEntry.role,
+                ChatEntry.model,
+                ChatEntry.content,
+                sa.func.row_number().over(
+                    partition_by=ChatEntry.chat_id,
+                    order_by=(ChatEntry.created_at, ChatEntry.id),
+                ).label('position'),
+            )
+            .subquery()
+        )
+        query_entry = so.aliased(ranked)
+        answer = so.aliased(ranked)
+        query = (
+            sa.select(query_entry.c.content, answer.c.id)
+            .join(answer, sa.and_(
+                answer.c.chat_id == query_entry.c.chat_id,
+                answer.c.position == 2,
+            ))
+            .where(
+                query_entry.c.position == 1,
+                query_entry.c.role == ChatEntry.Role.USER,
+                answer.c.role == ChatEntry.Role.ASSISTANT,
+                sa.or_(answer.c.model.is_(None),
+                       answer.c.model != self.MODEL),
+            )
+            .order_by(answer.c.id)
+            .execution_options(yield_per=batch_size)
+        )
+
+        added = 0
+        for rows in db.session.execute(query).partitions():
+            self.index.add(
+                np.array([row[1] for row in rows], dtype=np.int64),
+                np.stack([self.vectorizer.transform(row[0]) for row in rows]),
+            )
+            added += len(rows)
+
+        self._built = True
+        return added
+
+    def _ensure_built(self):
+        if self._built:
+            return
+        with self._build_lock:
+            if not self._built:
+                added = self.rebuild()
+                logger.info('Semantic cache built with %s answers', added)
+
+
+_semantic_cache: Optional[SemanticCache] = None
+_semantic_cache_lock = threading.Lock()
+
+
+def get_semantic_cache() -> Optional[SemanticCache]:
+    """Get the process-wide semantic cache.
+
+    :return: The cache, or ``None`` if it is disabled or NumPy is missing.
+    :rtype: SemanticCache or None
+    """
+    global _semantic_cache  # pylint: disable=global-statement
+
+    if not PROMPTLY_SEMANTIC_CACHE:
+        return None
+
+    if np is None:
+        logger.warning('NumPy is not installed, the semantic cache is '
+                       'disabled')
+        return None
+
+    with _semantic_cache_lock:
+        if _semantic_cache is None:
+            _semantic_cache = SemanticCache()
+        return _semantic_cache
@@ -0,0 +1,153 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""
+Local token counting.
+---------------------
+
+This module counts the tokens of texts and chat messages locally, without
+calling the OpenAI API. It uses the `tiktoken`_ tokenizer when it is
+installed, and falls back to a conservative estimate of
+:const:`CHARS_PER_TOKEN` characters per token otherwise, which is reported
+once the application starts, see :func:`warn_if_approximate`.
+
+.. _tiktoken: https://github.com/openai/tiktoken
+
+"""
+
+import logging
+import math
+import os
+from functools import lru_cache
+from typing import Dict, Iterable, Optional
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = 'gpt-3.5-turbo'
+"""The OpenAI model used when ``OPENAI_MODEL`` is not set."""
+
+APPROXIMATE_ENCODING = 'approx'
+"""The name of the encoding used when ``tiktoken`` is not available."""
+
+CHARS_PER_TOKEN = 3
+"""The number of characters per token estimated without ``tiktoken``.
+
+English text averages about four characters per token, but code and other
+languages take fewer. The estimate rather overcounts the tokens, so that the
+prompts it lets through fit into the context window of the model.
+"""
+
+TOKENS_PER_MESSAGE = 4
+"""The number of tokens each chat message adds to the prompt.
+
+Every message is wrapped into ``<|start|>{role}\\n{content}<|end|>\\n`` by
+the chat models, which costs a few tokens on top of its content.
+"""
+
+
+REPLY_TOKENS = 3
+"""The number of tokens priming the reply of the chat models.
+
+Every reply is primed with ``<|start|>assistant<|message|>``.
+"""
+
+
+def default_model() -> str:
+    """Get the name of the OpenAI model configured for the application.
+
+    :return: The value of the ``OPENAI_MODEL`` environment variable, or
+        :const:`DEFAULT_MODEL` if it is not set.
+    :rtype: str
+    """
+    return os.getenv('OPENAI_MODEL', DEFAULT_MODEL)
+
+
+def warn_if_approximate():
+    """Warn that the tokens are estimated, if ``tiktoken`` is not installed."""
+    if tiktoken is None:
+        logger.warning('tiktoken is not installed, the tokens are estimated '
+                       'at %s characters per token', CHARS_PER_TOKEN)
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model: str):
+    if tiktoken is None:
+        return None
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+
+def encoding_name(model: str) -> str:
+    """Get the name of the encoding used to count tokens for a model.
+
+    :param str model: The name of the OpenAI model.
+    :return: The name of the encoding, or :const:`APPROXIMATE_ENCODING` if
+        the tokens are estimated.
+    :rtype: str
+    """
+    encoding = _get_encoding(model)
+    return encoding.name if encoding else APPROXIMATE_ENCODING
+
+
+def count_tokens(text: str, model: str) -> int:
+    """Count the tokens of a text.
+
+    :param str text: The text to count the tokens of.
+    :param str model: The name of the OpenAI model.
+    :return: The number of tokens.
+    :rtype: int
+    """
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(message: Dict[str, str], model: str,
+                         content_tokens: Optional[int] = None) -> int:
+    """Count the tokens a chat message adds to a prompt.
+
+    :param dict message: The message, with its ``role`` and ``content``.
+    :param str model: The name of the OpenAI model.
+    :param content_tokens: The already known number of tokens of the
+        content, which is then not tokenized again.
+    :type content_tokens: int, optional
+    :return: The number of tokens.
+    :rtype: int
+    """
+    if content_tokens is None:
+        content_tokens = count_tokens(message['content'], model)
+
+    return (
+        TOKENS_PER_MESSAGE
+        + count_tokens(message['role'], model)
+        + content_tokens
+    )
+
+
+def count_prompt_tokens(messages: Iterable[Dict[str, str]],
+                        model: str) -> int:
+    """Count the tokens of the prompt of a chat completion request.
+
+    :param messages: The messages of the request.
+    :param str model: The name of the OpenAI model.
+    :return: The number of tokens, as reported in the ``usage`` of the
+        response.
+    :rtype: int
+    """
+    return sum(
+        count_message_tokens(message, model) for message in messages
+    ) + REPLY_TOKENS
@@ -10,8 +10,10 @@ A module with utility functions.
 --------------------------------
 """
 
+import asyncio
 import logging
-from concurrent import futures
+import os
+import threading
 from os import environ as env
 
 _BOOL_MAP = {
@@ -35,9 +37,9 @@ _BOOL_MAP = {
 logger = logging.getLogger(__name__)
 
 PROMPTLY_THREAD_TIMEOUT: float = float(env.get('PROMPTLY_THREAD_TIMEOUT', 60))
-"""The maximum amount of time, in seconds, that the :func:`.threaded_execute`
-function will wait for the completion of the function it is executing in a
-separate thread.
+"""The maximum amount of time, in seconds, that the
+:meth:`.EventLoopThread.run` method will wait for the completion of the
+coroutine it is executing in the background event loop before cancelling it.
 
 This constant uses the value of the ``PROMPTLY_THREAD_TIMEOUT`` environment
 variable, if set, or defaults to 60 seconds.
@@ -85,30 +87,86 @@ def try_parse_int(value: str) -> int or None:
         return None
 
 
-def threaded_execute(func, *args, timeout=None, **kwargs):
-    """Worker thread for timed request execution.
+class EventLoopThread:
+    """An asyncio event loop running forever in a background daemon thread.
 
-    This function will continuously attempt to execute ``func`` until it
-    succeeds without encountering a :class:`concurrent.futures.TimeoutError`.
-    If a :class:`concurrent.futures.TimeoutError` occurs, a warning is logged,
-    and the function is re-invoked with the same arguments.
+    Lets synchronous code, such as Flask views, run coroutines on a single
+    long-lived event loop, so that resources bound to the loop (like an
+    ``aiohttp`` connection pool) can be shared between requests.
+
+    The thread is started lazily on first use, and restarted if the process
+    has been forked since (e.g. by a pre-forking server like gunicorn),
+    because threads do not survive a ``fork()``.
+
+    Usage::
+
+        loop_thread = EventLoopThread()
+        result = loop_thread.run(fetch_something(), timeout=10)
 
-    :param func: The function to be executed.
-    :param args: Positional arguments to pass to ``func``.
-    :param timeout: The time, in seconds, within which ``func`` should complete
-        execution. Defaults to :const:`PROMPTLY_THREAD_TIMEOUT`.
-    :param kwargs: Keyword arguments to pass to ``func``.
-    :return: The return value of ``func``, if it completes successfully within
-        the allotted time.
-    :raises: Any exceptions raised by ``func``, except for
-        :class:`concurrent.futures.TimeoutError` which is caught and logged.
     """
-    timeout = timeout or PROMPTLY_THREAD_TIMEOUT
-    while True:
-        with futures.ThreadPoolExecutor(max_workers=1) as executor:
-            future = executor.submit(func, *args, **kwargs)
-            try:
-                return future.result(timeout=timeout)
-            except futures.TimeoutError:
-                logger.warning('The operation exceeded the given deadline')
-                continue
+
+    def __init__(self, name: str = 'promptly-event-loop'):
+        """Initialize the event loop thread with the given thread name."""
+        self.name = name
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._pid = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """Get the running event loop, starting it if necessary."""
+        with self._lock:
+            if not self._is_running():
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever,
+                    name=self.name,
+                    daemon=True,
+                )
+                self._thread.start()
+                self._pid = os.getpid()
+            return self._loop
+
+    def _is_running(self) -> bool:
+        return (
+            self._thread is not None
+            and self._pid == os.getpid()
+            and self._thread.is_alive()
+        )
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the event loop and wait for its result.
+
+        Unlike a thread, a coroutine can be cancelled: when ``timeout``
+        expires, the coroutine is cancelled on the event loop, so no work
+        is left running in the background.
+
+        :param coro: The coroutine to run.
+        :param timeout: The time, in seconds, within which ``coro`` should
+            complete execution. Defaults to :const:`PROMPTLY_THREAD_TIMEOUT`.
+        :return: The return value of ``coro``.
+        :raises asyncio.TimeoutError: If ``coro`` did not complete in time.
+        :raises: Any exceptions raised by ``coro``.
+        """
+        timeout = timeout or PROMPTLY_THREAD_TIMEOUT
+        future = asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(coro, timeout),
+            self.loop,
+        )
+
+        try:
+            return future.result()
+        except asyncio.TimeoutError:
+            logger.warning('The operation exceeded the given deadline')
+            raise
+
+    def stop(self):
+        """Stop the event loop and wait for the thread to finish."""
+        with self._lock:
+            if not self._is_running():
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._thread = None
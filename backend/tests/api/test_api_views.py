@@ -5,17 +5,24 @@
 # For the full copyright and license information, please view
 # the LICENSE file that was distributed with this source code.
 
+from contextlib import ExitStack
+
 import pytest
 
-from promptly.services import OpenAIService
+from promptly.api import views
+from promptly.api.limiter import OverloadedError
+from promptly.api.openai_eval import CompletionStream
+from promptly.models import Chat, ChatEntry
+from promptly.services import Completion, OpenAIService
+from promptly.tokenizer import count_tokens
 
 
 @pytest.fixture
 def openai_service(monkeypatch):
-    def mock_get_response(_ignore, *args):
-        return 'Hello, world!'
+    def mock_complete(_ignore, *args):
+        return Completion('Hello, world!', 'gpt-4', 10, 4)
 
-    monkeypatch.setattr(OpenAIService, 'get_response', mock_get_response)
+    monkeypatch.setattr(OpenAIService, 'complete', mock_complete)
     return OpenAIService()
 
 
@@ -29,3 +36,121 @@ def test_conversation(client, openai_service):
     assert response.json['message'] == 'Hello, world!'
     assert response.json['chat_id'] == 1
     assert len(response.json) == 2
+
+    assistant = Chat.get(1).entry[-1]
+    assert assistant.model == 'gpt-4'
+    assert (assistant.prompt_tokens, assistant.completion_tokens) == (10, 4)
+
+
+@pytest.fixture
+def streaming_openai_service(monkeypatch):
+    def mock_stream_response(_ignore, *args):
+        deltas = (delta for delta in ['Hello', ', ', 'world!'])
+        return CompletionStream(deltas, ExitStack(), 'gpt-4', 10)
+
+    monkeypatch.setattr(
+        OpenAIService,
+        'stream_response',
+        mock_stream_response,
+    )
+    return OpenAIService()
+
+
+def test_conversation_stream(client, streaming_openai_service):
+    response = client.post(
+        '/conversation/stream',
+        json={'message': 'Hello, world!', 'chat_id': None},
+    )
+
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+
+    body = response.get_data(as_text=True)
+    events = [event for event in body.split('\n\n') if event]
+
+    assert events[0] == 'event: start\ndata: {"chat_id": 1}'
+    assert events[1:4] == [
+        'data: {"delta": "Hello"}',
+        'data: {"delta": ", "}',
+        'data: {"delta": "world!"}',
+    ]
+    assert events[4] == (
+        'event: done\n'
+        'data: {"message": "Hello, world!", "chat_id": 1}'
+    )
+
+    entries = Chat.get(1).entry
+    assert [(str(e.role), e.content) for e in entries] == [
+        ('user', 'Hello, world!'),
+        ('assistant', 'Hello, world!'),
+    ]
+
+    assistant = entries[-1]
+    assert assistant.model == 'gpt-4'
+    assert (assistant.prompt_tokens, assistant.completion_tokens) == (
+        10, count_tokens('Hello, world!', 'gpt-4'))
+
+
+def test_conversation_overloaded(client, monkeypatch):
+    def mock_complete(_ignore, *args):
+        raise OverloadedError('Too many requests', retry_after=7)
+
+    monkeypatch.setattr(OpenAIService, 'complete', mock_complete)
+
+    response = client.post(
+        '/conversation',
+        json={'message': 'Hello, world!', 'chat_id': None},
+    )
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '7'
+    assert response.json == {'error': 'Too many requests'}
+
+
+def test_conversation_stream_overloaded(client, monkeypatch):
+    def mock_stream_response(_ignore, *args):
+        raise OverloadedError('Too many requests', retry_after=7)
+
+    monkeypatch.setattr(OpenAIService, 'stream_response',
+                        mock_stream_response)
+
+    response = client.post(
+        '/conversation/stream',
+        json={'message': 'Hello, world!', 'chat_id': None},
+    )
+
+    # The request is rejected before the stream starts.
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '7'
+    assert response.json == {'error': 'Too many requests'}
+
+
+def test_conversation_too_large(client, monkeypatch):
+    monkeypatch.setattr(views.openai_service.context_builder, 'budget', 100)
+    chat = Chat.create_new_chat()
+
+    for endpoint in ('/conversation', '/conversation/stream'):
+        for chat_id in (None, chat.id):
+            response = client.post(
+                endpoint,
+                json={'message': 'Hello, world! ' * 1000, 'chat_id': chat_id},
+            )
+
+            assert response.status_code == 413
+            assert response.json['error'].startswith(
+                'The message is too long')
+
+    # The rejected messages are not replayed in the context of later ones.
+    assert Chat.query.all() == [chat]
+    assert ChatEntry.query.count() == 0
+
+
+def test_conversation_commits_twice(client, commits, openai_service):
+    response = client.post(
+        '/conversation',
+        json={'message': 'Hello, world!', 'chat_id': None},
+    )
+
+    assert response.status_code == 200
+    assert len(commits) == 2
+    assert len(Chat.get(response.json['chat_id']).entry) == 2
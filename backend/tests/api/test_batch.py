@@ -0,0 +1,149 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+import json
+
+import openai
+import pytest
+
+from promptly.api import batch, views
+from promptly.api.batch import Checkpoint, run_batch
+from promptly.models import Prompt
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+
+    def mock_completion(**params):
+        calls.append(params)
+        content = params['messages'][-1]['content']
+        if content == 'fail':
+            raise openai.error.APIError('Upstream failure')
+        return {
+            'choices': [{'message': {'content': content.upper()}}],
+            'usage': {'prompt_tokens': 1, 'completion_tokens': 1},
+        }
+
+    monkeypatch.setattr(batch, 'completion', mock_completion)
+    return calls
+
+
+def lines(*items):
+    return [json.dumps(item) + '\n' for item in items]
+
+
+def test_run_batch(app, calls):
+    source = lines(
+        {'id': 'a', 'message': 'hello'},
+        {'messages': [{'role': 'user', 'content': 'world'}]},
+        {'id': 'c', 'message': 'fail'},
+        {'id': 'd'},
+    ) + ['not json\n', '\n']
+    checkpoint = Checkpoint()
+
+    results = {r['id']: r for r in run_batch(source, checkpoint, 2)}
+
+    assert results['a']['status'] == 'ok'
+    assert results['a']['content'] == 'HELLO'
+    assert results['2']['content'] == 'WORLD'
+    assert results['c'] == {
+        'id': 'c',
+        'status': 'error',
+        'error': 'Upstream failure',
+    }
+    assert results['d']['status'] == 'error'
+    assert results['5']['status'] == 'error'
+    assert len(results) == 5
+    assert 'a' in checkpoint and '2' in checkpoint
+    assert 'c' not in checkpoint
+
+
+def test_run_batch_resumes_from_checkpoint(app, calls, tmp_path):
+    path = str(tmp_path / 'job.checkpoint')
+    source = lines(*({'id': i, 'message': f'm{i}'} for i in range(10)))
+
+    first = run_batch(source, Checkpoint(path), 2)
+    for _ in range(3):
+        next(first)
+    first.close()
+    completed = len(Checkpoint(path))
+    calls.clear()
+
+    results = list(run_batch(source, Checkpoint(path), 2))
+
+    assert completed >= 3
+    assert sum(r['status'] == 'skipped' for r in results) == completed
+    assert len(calls) == 10 - completed
+    assert len(Checkpoint(path)) == 10
+
+
+def test_run_batch_with_prompt(app, calls):
+    prompt = Prompt.create(prompt='Be terse.', role='assistant', field='',
+                           task='Test', task_description='Test')
+    source = lines(
+        {'id': 1, 'message': 'hi', 'prompt_id': prompt.id, 'model': 'gpt-4'},
+        {'id': 2, 'message': 'hi', 'prompt_id': 999},
+    )
+
+    results = {r['id']: r for r in run_batch(source, Checkpoint())}
+
+    assert calls[0]['messages'][0] == {
+        'role': 'system',
+        'content': 'Be terse.',
+    }
+    assert calls[0]['model'] == 'gpt-4'
+    assert results['2']['error'] == 'Prompt 999 does not exist'
+
+
+def test_batch_endpoint(client, calls, tmp_path, monkeypatch):
+    monkeypatch.setattr(views, 'PROMPTLY_BATCH_DIR', str(tmp_path))
+    body = ''.join(lines(
+        {'id': 'a', 'message': 'hello'},
+        {'id': 'b', 'message': 'world'},
+    ))
+
+    response = client.post('/batch?job_id=job-1', data=body,
+                           content_type='application/x-ndjson')
+    results = [json.loads(line) for line in response.get_data(as_text=True)
+               .splitlines()]
+
+    assert response.mimetype == 'application/x-ndjson'
+    assert sorted(r['status'] for r in results) == ['ok', 'ok']
+    assert (tmp_path / 'job-1.checkpoint').exists()
+
+    response = client.post('/batch?job_id=job-1', data=body)
+    assert response.get_data(as_text=True).count('"skipped"') == 2
+
+    response = client.post('/batch?job_id=../etc', data=body)
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize('concurrency', ['0', '-1', '33', 'many', ''])
+def test_batch_endpoint_rejects_invalid_concurrency(client, calls,
+                                                    monkeypatch, concurrency):
+    monkeypatch.setattr(views, 'PROMPTLY_BATCH_MAX_CONCURRENCY', 32)
+    response = client.post(f'/batch?concurrency={concurrency}',
+                           data=''.join(lines({'id': 'a', 'message': 'hi'})))
+
+    assert response.status_code == 400
+    assert response.json == {'error': 'Invalid concurrency'}
+    assert not calls
+
+
+def test_batch_eval_command(runner, calls, tmp_path):
+    source = tmp_path / 'items.jsonl'
+    source.write_text(''.join(lines({'id': 'a', 'message': 'hello'})))
+    output = tmp_path / 'results.jsonl'
+
+    runner.invoke(args=['batch-eval', str(source), '-o', str(output)])
+    result = runner.invoke(
+        args=['batch-eval', str(source), '-o', str(output)])
+
+    assert 'Resuming after 1 completed items.' in result.output
+    assert [json.loads(line)['status'] for line in
+            output.read_text().splitlines()] == ['ok', 'skipped']
@@ -0,0 +1,204 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+import asyncio
+
+import openai
+import pytest
+import sqlalchemy as sa
+
+from promptly.api import openai_eval
+from promptly.api.breaker import CircuitBreaker, CircuitOpenError, CLOSED, \
+    HALF_OPEN, OPEN
+from promptly.api.openai_eval import completion, RETRYABLE_ERRORS
+from promptly.api.retry import RetryPolicy
+from promptly.main import views as main_views
+from promptly.metrics import registry
+from promptly.models import ChatEntry, db
+
+MESSAGES = [{'role': 'user', 'content': 'Hello'}]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker('test_breaker', failures=(ConnectionError,),
+                          min_calls=4, open_seconds=30, slow_call=5,
+                          clock=clock)
+
+
+def call(breaker, error=None, duration=0, clock=None):
+    with breaker.guard():
+        if clock is not None:
+            clock.now += duration
+        if error is not None:
+            raise error
+
+
+def fail(breaker, times=1):
+    for _ in range(times):
+        with pytest.raises(ConnectionError):
+            call(breaker, ConnectionError())
+
+
+def test_opens_on_failure_rate(breaker):
+    call(breaker)
+    call(breaker)
+    fail(breaker)
+    assert breaker.state == CLOSED
+
+    fail(breaker)
+    assert breaker.state == OPEN
+    assert registry.gauge('test_breaker_circuit_state').get() == 2
+
+    with pytest.raises(CircuitOpenError) as exc_info:
+        call(breaker)
+    assert exc_info.value.retry_after == 30
+
+
+def test_needs_enough_calls(breaker):
+    fail(breaker, times=3)
+
+    assert breaker.state == CLOSED
+
+
+def test_failures_leave_the_window(breaker, clock):
+    fail(breaker, times=3)
+    clock.now += 61
+    call(breaker)
+
+    assert breaker.state == CLOSED
+
+
+def test_slow_calls_count_as_failures(breaker, clock):
+    for _ in range(4):
+        call(breaker, duration=6, clock=clock)
+
+    assert breaker.state == OPEN
+
+
+def test_other_errors_are_not_failures(breaker):
+    for _ in range(4):
+        with pytest.raises(ValueError):
+            call(breaker, ValueError())
+
+    assert breaker.state == CLOSED
+
+
+def test_half_open_probe_closes(breaker, clock):
+    fail(breaker, times=4)
+    clock.now += 30
+    assert breaker.state == HALF_OPEN
+
+    with breaker.guard():
+        # Only one probe at a time.
+        with pytest.raises(CircuitOpenError):
+            call(breaker)
+
+    assert breaker.state == CLOSED
+    call(breaker)
+
+
+def test_half_open_probe_reopens(breaker, clock):
+    fail(breaker, times=4)
+    clock.now += 30
+
+    fail(breaker)
+
+    assert breaker.state == OPEN
+    assert breaker.retry_after == 30
+
+
+def test_cancelled_probe_is_released(breaker, clock):
+    fail(breaker, times=4)
+    clock.now += 30
+
+    with pytest.raises(asyncio.CancelledError):
+        call(breaker, asyncio.CancelledError())
+
+    assert breaker.state == HALF_OPEN
+    call(breaker)
+    assert breaker.state == CLOSED
+
+
+def test_raise_if_open(breaker, clock):
+    breaker.raise_if_open()
+    fail(breaker, times=4)
+
+    with pytest.raises(CircuitOpenError):
+        breaker.raise_if_open()
+
+    clock.now += 30
+    breaker.raise_if_open()
+    assert breaker.state == HALF_OPEN
+
+
+@pytest.fixture
+def open_breaker(monkeypatch):
+    breaker = CircuitBreaker('test_completion_breaker',
+                             failures=RETRYABLE_ERRORS, min_calls=2)
+    monkeypatch.setattr(openai_eval, 'breaker', breaker)
+    monkeypatch.setattr(main_views, 'breaker', breaker)
+    monkeypatch.setattr(openai_eval, 'retry_policy', RetryPolicy(
+        'test_breaker_retry', retryable=RETRYABLE_ERRORS, max_attempts=1))
+    return breaker
+
+
+def test_completion_fails_fast_while_open(fake_openai, open_breaker):
+    fake_openai.fail(503, 503)
+    for _ in range(2):
+        with pytest.raises(openai.error.ServiceUnavailableError):
+            completion(model='gpt-4', messages=MESSAGES)
+
+    with pytest.raises(CircuitOpenError):
+        completion(model='gpt-4', messages=MESSAGES)
+
+    assert fake_openai.requests == 2
+
+
+def test_completion_is_served_from_cache_while_open(fake_openai, open_breaker,
+                                                    monkeypatch):
+    monkeypatch.setattr(openai_eval, 'response_cache',
+                        openai_eval.create_cache('memory'))
+    params = {'model': 'gpt-4', 'messages': MESSAGES, 'temperature': 0}
+    completion(**params)
+
+    fake_openai.fail(503)
+    with pytest.raises(openai.error.ServiceUnavailableError):
+        completion(model='gpt-4', messages=MESSAGES)
+
+    assert open_breaker.state == OPEN
+    assert completion(**params)['choices'][0]['message']['content'] == 'Hello'
+
+
+def test_maintained_rejects_upstream_views(client, open_breaker):
+    for _ in range(2):
+        with pytest.raises(openai.error.APIError):
+            with open_breaker.guard():
+                raise openai.error.APIError('Down')
+
+    response = client.post(
+        '/conversation/stream',
+        json={'message': 'Hello, world!', 'chat_id': None},
+    )
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '30'
+    assert 'circuit is open' in response.json['error']
+    assert db.session.scalar(sa.select(sa.func.count(ChatEntry.id))) == 0
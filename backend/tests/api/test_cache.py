@@ -0,0 +1,117 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+import pytest
+
+from promptly.api import cache as cache_module
+from promptly.api.cache import (
+    cache_key,
+    create_cache,
+    is_cacheable,
+    MemoryCache,
+    SQLiteCache,
+)
+
+
+def response(content):
+    return {'choices': [{'message': {'content': content}}]}
+
+
+def test_cache_key_is_canonical():
+    assert cache_key({'model': 'gpt-4', 'temperature': 0}) == cache_key(
+        {'temperature': 0, 'model': 'gpt-4'})
+    assert cache_key({'model': 'gpt-4'}) != cache_key({'model': 'gpt-3'})
+
+
+def test_is_cacheable():
+    assert is_cacheable({'temperature': 0})
+    assert not is_cacheable({'temperature': 0.7})
+    assert not is_cacheable({})
+    assert not is_cacheable({'temperature': 0, 'stream': True})
+    assert not is_cacheable({'temperature': 0, 'n': 2})
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_cache(request, tmp_path):
+    def factory(**kwargs):
+        if request.param == 'memory':
+            return MemoryCache(**kwargs)
+        return SQLiteCache(str(tmp_path / 'cache.sqlite3'), **kwargs)
+    return factory
+
+
+def test_get_and_set(make_cache):
+    cache = make_cache()
+
+    assert cache.get('foo') is None
+    cache.set('foo', response('bar'))
+    assert cache.get('foo') == response('bar')
+
+
+def test_ttl(make_cache):
+    cache = make_cache(ttl=-1)
+
+    cache.set('foo', response('bar'))
+    assert cache.get('foo') is None
+
+
+def test_lru_eviction_by_size(make_cache, monkeypatch):
+    size = len(b'{"choices":[{"message":{"content":"a"}}]}')
+    cache = make_cache(max_bytes=2 * size)
+    # Make access times strictly increasing for the SQLite backend.
+    clock = iter(range(1, 100))
+    monkeypatch.setattr(cache_module.time, 'time', lambda: next(clock))
+
+    cache.set('a', response('a'))
+    cache.set('b', response('b'))
+    assert cache.get('a') is not None
+    cache.set('c', response('c'))
+
+    assert cache.get('b') is None
+    assert cache.get('a') == response('a')
+    assert cache.get('c') == response('c')
+
+
+def test_sqlite_cache_tracks_its_size(tmp_path):
+    size = len(b'{"choices":[{"message":{"content":"a"}}]}')
+    cache = SQLiteCache(str(tmp_path / 'cache.sqlite3'), max_bytes=3 * size)
+
+    cache.set('a', response('a'))
+    cache.set('b', response('b'))
+    cache.set('b', response('bb'))
+    assert cache.size == 2 * size + 1
+
+    # Only the least recently used response is evicted.
+    cache.set('c', response('c'))
+    assert cache.size == 2 * size + 1
+    assert cache.get('a') is None
+    assert cache.get('b') == response('bb')
+
+
+def test_oversized_response_is_not_cached(make_cache):
+    cache = make_cache(max_bytes=10)
+
+    cache.set('foo', response('bar'))
+    assert cache.get('foo') is None
+
+
+def test_sqlite_cache_is_shared(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    SQLiteCache(path).set('foo', response('bar'))
+
+    assert SQLiteCache(path).get('foo') == response('bar')
+
+
+def test_create_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        cache_module, 'PROMPTLY_CACHE_PATH', str(tmp_path / 'c.sqlite3'))
+
+    assert isinstance(create_cache('memory'), MemoryCache)
+    assert isinstance(create_cache('sqlite'), SQLiteCache)
+    assert create_cache('none').get('foo') is None
+    with pytest.raises(ValueError):
+        create_cache('redis')
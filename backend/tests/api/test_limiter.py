@@ -0,0 +1,58 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+import threading
+
+import pytest
+
+from promptly.api.limiter import ConcurrencyLimiter, OverloadedError
+
+
+@pytest.fixture
+def limiter(request):
+    return ConcurrencyLimiter(
+        f'test_{request.node.name}',
+        max_in_flight=1,
+        max_queue=1,
+        queue_timeout=0.2,
+    )
+
+
+def test_slot_is_released(limiter):
+    with limiter.slot():
+        assert limiter.in_flight == 1
+    assert limiter.in_flight == 0
+
+
+def test_queue_timeout(limiter):
+    limiter.acquire()
+    with pytest.raises(OverloadedError) as exc_info:
+        limiter.acquire()
+
+    assert exc_info.value.retry_after == 1
+    assert limiter.queued == 0
+    assert limiter._rejected_counter.get(reason='queue_timeout') == 1
+    assert limiter._wait_histogram.get() == 1
+
+
+def test_queue_full(limiter):
+    limiter.queue_timeout = 5
+    limiter.acquire()
+
+    waiter = threading.Thread(target=limiter.acquire)
+    waiter.start()
+    while limiter.queued == 0:
+        pass
+
+    with pytest.raises(OverloadedError):
+        limiter.acquire()
+    assert limiter._rejected_counter.get(reason='queue_full') == 1
+
+    limiter.release()
+    waiter.join()
+    assert limiter.in_flight == 1
+    assert limiter.queued == 0
@@ -0,0 +1,221 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+import asyncio
+import threading
+import time
+
+import openai
+import pytest
+
+from promptly.api import openai_eval
+from promptly.api.cache import cache_key, MemoryCache
+from promptly.api.limiter import ConcurrencyLimiter, OverloadedError
+from promptly.api.openai_eval import completion, stream_completion
+from promptly.api.ratelimit import RateLimiter
+from promptly.api.singleflight import SingleFlight
+from promptly.tokenizer import count_tokens
+
+
+def test_completion_uses_shared_session(monkeypatch):
+    sessions = []
+
+    async def mock_acreate(*args, **kwargs):
+        sessions.append(openai.aiosession.get())
+        return {'choices': [{'message': {'content': kwargs['model']}}]}
+
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', mock_acreate)
+
+    assert completion(model='foo')['choices'][0]['message']['content'] == 'foo'
+    assert completion(model='bar')['choices'][0]['message']['content'] == 'bar'
+    assert sessions[0] is not None
+    assert sessions[0] is sessions[1]
+
+
+def test_completion_retries_transient_errors(monkeypatch):
+    calls = 0
+
+    async def mock_acreate(*args, **kwargs):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise openai.error.ServiceUnavailableError('Try again')
+        return {'choices': [{'message': {'content': 'OK'}}]}
+
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', mock_acreate)
+    monkeypatch.setattr(asyncio, 'sleep', _no_sleep(asyncio.sleep))
+
+    assert completion(model='foo')['choices'][0]['message']['content'] == 'OK'
+    assert calls == 2
+
+
+def test_completion_deadline_cancels_request(monkeypatch):
+    cancelled = asyncio.Event()
+
+    async def mock_acreate(*args, **kwargs):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', mock_acreate)
+
+    with pytest.raises(openai.error.Timeout):
+        completion(model='foo', timeout=0.1)
+
+    assert cancelled.is_set()
+
+
+def _no_sleep(sleep):
+    async def wrapper(delay, *args, **kwargs):
+        return await sleep(0)
+    return wrapper
+
+
+def test_completion_caches_deterministic_requests(monkeypatch):
+    calls = []
+
+    async def mock_acreate(*args, **kwargs):
+        calls.append(kwargs)
+        return {
+            'choices': [{'message': {'content': str(len(calls))}}],
+            'usage': {'prompt_tokens': 10, 'completion_tokens': 4},
+        }
+
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', mock_acreate)
+    monkeypatch.setattr(openai_eval, 'response_cache', MemoryCache())
+
+    first = completion(model='foo', temperature=0)
+    second = completion(temperature=0, model='foo')
+    completion(model='foo', temperature=1)
+
+    assert first['choices'] == second['choices']
+    assert len(calls) == 2
+    # The cached response was not billed.
+    assert first['usage'] == {'prompt_tokens': 10, 'completion_tokens': 4}
+    assert 'usage' not in second
+    assert second['cached'] is True
+
+
+def test_completion_coalesces_identical_requests(monkeypatch):
+    calls, release = [], threading.Event()
+
+    async def mock_acreate(*args, **kwargs):
+        calls.append(kwargs)
+        await asyncio.get_running_loop().run_in_executor(None, release.wait)
+        return {'choices': [{'message': {'content': 'OK'}}]}
+
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', mock_acreate)
+    monkeypatch.setattr(openai_eval, 'response_cache', MemoryCache())
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(
+            completion(model='foo', temperature=0)))
+        for _ in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    while not calls:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert len(results) == 3
+    assert sum(not result.get('cached') for result in results) == 1
+
+
+def test_completion_deadline_covers_the_lock_wait(monkeypatch, tmp_path):
+    timeouts, release = [], threading.Event()
+
+    def mock_complete(*args, timeout=None, **kwargs):
+        timeouts.append(timeout)
+        return {'choices': [{'message': {'content': 'OK'}}]}
+
+    def hold_lock(params):
+        """Hold the lock of a request, like another process would."""
+        locked = threading.Event()
+        other = SingleFlight('test_other_process', lock_dir=str(tmp_path))
+        thread = threading.Thread(target=other.do, args=(
+            cache_key(params),
+            lambda: locked.set() or release.wait(5),
+        ))
+        thread.start()
+        locked.wait()
+        return thread
+
+    monkeypatch.setattr(openai_eval, '_complete', mock_complete)
+    monkeypatch.setattr(openai_eval, 'response_cache', MemoryCache())
+    monkeypatch.setattr(openai_eval, 'coalescer', SingleFlight(
+        'test_completion', lock_dir=str(tmp_path)))
+
+    thread = hold_lock({'model': 'foo', 'temperature': 0})
+    threading.Timer(0.3, release.set).start()
+    completion(model='foo', temperature=0, timeout=1)
+    thread.join()
+
+    assert timeouts[0] <= 0.7
+
+    release.clear()
+    thread = hold_lock({'model': 'bar', 'temperature': 0})
+    try:
+        with pytest.raises(openai.error.Timeout):
+            completion(model='bar', temperature=0, timeout=0.2)
+    finally:
+        release.set()
+        thread.join()
+
+    assert len(timeouts) == 1
+
+
+def test_completion_is_paced_by_rate_limits(monkeypatch):
+    delays = []
+
+    async def mock_acreate(*args, **kwargs):
+        return {'choices': [{'message': {'content': 'OK'}}]}
+
+    async def mock_sleep(delay, *args, **kwargs):
+        delays.append(delay)
+
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', mock_acreate)
+    monkeypatch.setattr(asyncio, 'sleep', mock_sleep)
+    monkeypatch.setattr(openai_eval, 'rate_limiter', RateLimiter(
+        'test_completion', rpm=60, tpm=0, clock=lambda: 1000.0))
+
+    for _ in range(61):
+        completion(model='foo', messages=[{'role': 'user', 'content': 'Hi'}])
+
+    assert delays == [pytest.approx(1)]
+
+
+def test_stream_completion_is_admitted_eagerly(monkeypatch):
+    async def mock_acreate(*args, **kwargs):
+        async def chunks():
+            yield {'choices': [{'delta': {'content': 'OK'}}]}
+        return chunks()
+
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', mock_acreate)
+    limiter = ConcurrencyLimiter('test_stream_completion', max_in_flight=1,
+                                 max_queue=0, queue_timeout=0)
+    monkeypatch.setattr(openai_eval, 'limiter', limiter)
+
+    stream = stream_completion(model='foo')
+    assert limiter.in_flight == 1
+    # The slot is taken before the stream is iterated.
+    with pytest.raises(OverloadedError):
+        stream_completion(model='foo')
+
+    assert list(stream) == ['OK']
+    assert limiter.in_flight == 0
+    assert stream.usage['completion_tokens'] == count_tokens('OK', 'foo')
+
+    # A stream which is never iterated releases its slot once closed.
+    stream_completion(model='foo').close()
+    assert limiter.in_flight == 0
@@ -0,0 +1,185 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from promptly.api.limiter import OverloadedError
+from promptly.api.ratelimit import (
+    estimate_tokens,
+    parse_duration,
+    RateLimiter,
+    requested_model,
+    SQLiteRateLimiter,
+)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_limiter(request, tmp_path, clock):
+    def factory(**kwargs):
+        if request.param == 'memory':
+            return RateLimiter('test', clock=clock, **kwargs)
+        return SQLiteRateLimiter('test', str(tmp_path / 'limits.sqlite3'),
+                                 clock=clock, **kwargs)
+    return factory
+
+
+def test_parse_duration():
+    assert parse_duration('20ms') == pytest.approx(0.02)
+    assert parse_duration('1s') == 1
+    assert parse_duration('6m0s') == 360
+    assert parse_duration('1h2m3.5s') == 3723.5
+    assert parse_duration('') is None
+    assert parse_duration(None) is None
+
+
+def test_estimate_tokens():
+    messages = [{'role': 'user', 'content': 'Hello'}]
+    prompt = estimate_tokens({'model': 'gpt-4', 'messages': messages})
+
+    assert prompt > 3
+    assert estimate_tokens({
+        'model': 'gpt-4',
+        'messages': messages,
+        'max_tokens': 100,
+        'n': 2,
+    }) == prompt + 200
+
+
+def test_requests_are_paced(make_limiter, clock):
+    limiter = make_limiter(rpm=60, tpm=0)
+
+    assert [limiter.reserve('gpt-4', 1) for _ in range(60)] == [0.0] * 60
+    assert limiter.reserve('gpt-4', 1) == pytest.approx(1)
+    assert limiter.reserve('gpt-4', 1) == pytest.approx(2)
+    assert limiter.reserve('gpt-3.5-turbo', 1) == 0
+
+    clock.now += 2
+    assert limiter.reserve('gpt-4', 1) == pytest.approx(1)
+
+
+def test_tokens_are_paced(make_limiter, clock):
+    limiter = make_limiter(rpm=60, tpm=600)
+
+    assert limiter.reserve('gpt-4', 550) == 0
+    assert limiter.reserve('gpt-4', 100) == pytest.approx(5)
+
+    clock.now += 10
+    assert limiter.reserve('gpt-4', 100) == pytest.approx(5)
+
+
+def test_reserve_rejects_long_waits(make_limiter):
+    limiter = make_limiter(rpm=0, tpm=600)
+    limiter.reserve('gpt-4', 600)
+
+    with pytest.raises(OverloadedError) as exc_info:
+        limiter.reserve('gpt-4', 300, max_wait=10)
+
+    assert exc_info.value.retry_after == 30
+    assert limiter.reserve('gpt-4', 100, max_wait=10) == pytest.approx(10)
+
+
+def test_disabled_limiter(make_limiter):
+    limiter = make_limiter(rpm=0, tpm=0)
+
+    assert not limiter.enabled
+    assert limiter.reserve('gpt-4', 10 ** 9) == 0
+
+
+def test_update_from_headers(make_limiter):
+    limiter = make_limiter(rpm=3500, tpm=90000)
+
+    limiter.update('gpt-4', {
+        'x-ratelimit-limit-requests': '60',
+        'x-ratelimit-remaining-requests': '0',
+        'x-ratelimit-reset-requests': '3s',
+        'x-ratelimit-limit-tokens': '6000',
+        'x-ratelimit-remaining-tokens': '5990',
+        'x-ratelimit-reset-tokens': '100ms',
+    })
+
+    # Another host exhausted the requests, which are then refilled at the
+    # reported limit of 1 per second.
+    assert limiter.reserve('gpt-4', 10) == pytest.approx(1)
+    assert limiter.reserve('gpt-4', 10) == pytest.approx(2)
+    assert limiter.reserve('gpt-3.5-turbo', 10) == 0
+
+
+def test_update_ignores_missing_headers(make_limiter):
+    limiter = make_limiter(rpm=60, tpm=600)
+
+    limiter.update('gpt-4', {'x-ratelimit-limit-requests': 'foo'})
+
+    assert limiter.reserve('gpt-4', 600) == 0
+
+
+def test_shared_limiter(tmp_path, clock):
+    path = str(tmp_path / 'limits.sqlite3')
+    first = SQLiteRateLimiter('test', path, rpm=60, tpm=0, clock=clock)
+    second = SQLiteRateLimiter('test', path, rpm=60, tpm=0, clock=clock)
+
+    for _ in range(30):
+        first.reserve('gpt-4', 1)
+    for _ in range(30):
+        second.reserve('gpt-4', 1)
+
+    assert first.reserve('gpt-4', 1) == pytest.approx(1)
+    assert second.reserve('gpt-4', 1) == pytest.approx(2)
+
+
+def test_trace_config_updates_the_requested_model(clock):
+    limiter = RateLimiter('test', rpm=60, tpm=0, clock=clock)
+    on_request_end = limiter.trace_config().on_request_end[0]
+    params = SimpleNamespace(response=SimpleNamespace(headers={
+        'x-ratelimit-limit-requests': '60',
+        'x-ratelimit-remaining-requests': '0',
+    }))
+
+    async def send():
+        requested_model.set('gpt-4')
+        await on_request_end(None, None, params)
+
+    asyncio.run(send())
+
+    assert limiter.reserve('gpt-4', 1) == pytest.approx(1)
+
+
+def test_shared_limiter_is_updated_off_the_event_loop(tmp_path, clock):
+    limiter = SQLiteRateLimiter('test', str(tmp_path / 'limits.sqlite3'),
+                                rpm=60, tpm=0, clock=clock)
+    threads = []
+    reserve = limiter.reserve
+
+    def spy(*args):
+        threads.append(threading.current_thread())
+        return reserve(*args)
+
+    limiter.reserve = spy
+
+    async def send():
+        await limiter.aacquire('gpt-4', 1)
+        return threading.current_thread()
+
+    loop_thread = asyncio.run(send())
+
+    assert threads and threads[0] is not loop_thread
@@ -0,0 +1,138 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+import time
+
+import openai
+import pytest
+
+from promptly.api import openai_eval
+from promptly.api.openai_eval import completion, RETRYABLE_ERRORS
+from promptly.api.retry import RetryBudget, RetryPolicy
+
+MESSAGES = [{'role': 'user', 'content': 'Hello'}]
+
+
+@pytest.fixture
+def policy(monkeypatch):
+    def factory(**kwargs):
+        kwargs.setdefault('base_delay', 0.01)
+        policy = RetryPolicy('test_retry', retryable=RETRYABLE_ERRORS,
+                             **kwargs)
+        monkeypatch.setattr(openai_eval, 'retry_policy', policy)
+        return policy
+    return factory
+
+
+def test_retry_budget():
+    budget = RetryBudget(ratio=0.5, max_tokens=1)
+
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+
+
+def test_backoff_is_fully_jittered():
+    policy = RetryPolicy('test_retry', retryable=(), base_delay=1,
+                         max_delay=5)
+
+    delays = [policy.backoff(retry) for retry in (1, 2, 3, 4, 5)] * 100
+
+    assert all(0 <= delay <= 5 for delay in delays)
+    assert len(set(delays)) > 1
+    assert max(policy.backoff(1) for _ in range(100)) <= 1
+
+
+def test_transient_errors_are_retried(fake_openai, policy):
+    policy()
+    fake_openai.fail(503, 500, 429)
+
+    response = completion(model='gpt-4', messages=MESSAGES)
+
+    assert response['choices'][0]['message']['content'] == 'Hello'
+    assert fake_openai.requests == 4
+
+
+def test_attempts_are_bounded(fake_openai, policy):
+    policy(max_attempts=3)
+    fake_openai.fail(500, 500, 500, 500)
+
+    with pytest.raises(openai.error.APIError):
+        completion(model='gpt-4', messages=MESSAGES)
+
+    assert fake_openai.requests == 3
+
+
+def test_invalid_requests_are_not_retried(fake_openai, policy):
+    policy()
+    fake_openai.fail(400)
+
+    with pytest.raises(openai.error.InvalidRequestError):
+        completion(model='gpt-4', messages=MESSAGES)
+
+    assert fake_openai.requests == 1
+
+
+def test_retry_budget_caps_retries(fake_openai, policy):
+    policy(budget=RetryBudget(ratio=0, max_tokens=1))
+    fake_openai.fail(503)
+    completion(model='gpt-4', messages=MESSAGES)
+
+    fake_openai.fail(503)
+    with pytest.raises(openai.error.ServiceUnavailableError):
+        completion(model='gpt-4', messages=MESSAGES)
+
+    assert fake_openai.requests == 3
+
+
+def test_deadline_bounds_the_call(fake_openai, policy):
+    policy()
+    fake_openai.latency = 10
+    start = time.monotonic()
+
+    with pytest.raises(openai.error.Timeout):
+        completion(model='gpt-4', messages=MESSAGES, timeout=0.3)
+
+    assert time.monotonic() - start < 2
+
+
+def test_deadline_bounds_the_retries(fake_openai, policy):
+    policy(base_delay=10, max_delay=10)
+    fake_openai.fail(*[503] * 100)
+
+    start = time.monotonic()
+    with pytest.raises(openai.error.ServiceUnavailableError):
+        completion(model='gpt-4', messages=MESSAGES, timeout=0.5)
+
+    assert time.monotonic() - start < 2
+
+
+def test_slow_requests_are_hedged(fake_openai, policy):
+    hedging = policy(hedge=True)
+    for _ in range(20):
+        hedging.latencies.add(0.05)
+    fake_openai.latency = iter([5, 0.01]).__next__
+
+    start = time.monotonic()
+    response = completion(model='gpt-4', messages=MESSAGES)
+
+    assert response['choices'][0]['message']['content'] == 'Hello'
+    assert time.monotonic() - start < 2
+    assert fake_openai.requests == 2
+
+
+def test_hedging_waits_for_latency_samples(fake_openai, policy):
+    policy(hedge=True)
+    fake_openai.latency = 0.2
+
+    completion(model='gpt-4', messages=MESSAGES)
+
+    assert fake_openai.requests == 1
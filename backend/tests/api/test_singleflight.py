@@ -0,0 +1,121 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+import threading
+import time
+
+import pytest
+
+from promptly.api.singleflight import SingleFlight
+
+
+def run_concurrently(flight, fn, count):
+    """Call ``fn`` through ``flight`` from ``count`` threads at once."""
+    outcomes = [None] * count
+
+    def target(i):
+        try:
+            outcomes[i] = flight.do('key', fn)
+        except Exception as exc:  # noqa: B902
+            outcomes[i] = exc
+
+    threads = [
+        threading.Thread(target=target, args=(i,)) for i in range(count)
+    ]
+    for thread in threads:
+        thread.start()
+    return threads, outcomes
+
+
+def test_followers_share_the_result():
+    flight = SingleFlight('test_share')
+    release, calls = threading.Event(), []
+
+    def fn():
+        calls.append(1)
+        release.wait()
+        return 'result'
+
+    threads, outcomes = run_concurrently(flight, fn, 4)
+    while flight._requests_counter.get(role='follower') < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert outcomes == ['result'] * 4
+    assert len(calls) == 1
+    assert flight.in_flight == 0
+
+
+def test_followers_share_the_error():
+    flight = SingleFlight('test_error')
+    release = threading.Event()
+
+    def fn():
+        release.wait()
+        raise ValueError('boom')
+
+    threads, outcomes = run_concurrently(flight, fn, 3)
+    while flight._requests_counter.get(role='follower') < 2:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert all(isinstance(o, ValueError) for o in outcomes)
+    assert flight.in_flight == 0
+
+
+def test_follower_timeout():
+    flight = SingleFlight('test_timeout')
+    release, results = threading.Event(), []
+
+    def lead():
+        results.append(flight.do('key', lambda: release.wait() and 'late'))
+
+    thread = threading.Thread(target=lead)
+    thread.start()
+    while not flight.in_flight:
+        time.sleep(0.001)
+
+    with pytest.raises(TimeoutError):
+        flight.do('key', lambda: 'follower', timeout=0.05)
+
+    release.set()
+    thread.join()
+    assert results == ['late']
+
+
+def test_sequential_calls_are_not_coalesced():
+    flight = SingleFlight('test_sequential')
+    results = iter(['first', 'second'])
+
+    assert flight.do('key', lambda: next(results)) == 'first'
+    assert flight.do('key', lambda: next(results)) == 'second'
+
+
+def test_lock_file_serializes_groups(tmp_path):
+    # Two groups sharing a lock directory behave like two processes.
+    first = SingleFlight('test_lock_a', lock_dir=str(tmp_path))
+    second = SingleFlight('test_lock_b', lock_dir=str(tmp_path))
+    release, entered = threading.Event(), threading.Event()
+
+    def hold():
+        entered.set()
+        release.wait()
+
+    thread = threading.Thread(target=first.do, args=('key', hold))
+    thread.start()
+    entered.wait()
+
+    with pytest.raises(TimeoutError):
+        second.do('key', lambda: None, timeout=0.05)
+
+    release.set()
+    thread.join()
+    assert second.do('key', lambda: 'done', timeout=1) == 'done'
@@ -5,12 +5,33 @@
 # For the full copyright and license information, please view
 # the LICENSE file that was distributed with this source code.
 
-from promptly.models import Chat
+import pytest
+
+from promptly.chat import fragments
+from promptly.models import Chat, ChatEntry
 
 
 def test_chat_index_without_cookie(client):
     response = client.get('/')
+    assert response.status_code == 302
+    assert response.location == '/new'
+
+    response = client.get('/', follow_redirects=True)
     assert response.status_code == 200
+    assert Chat.query.count() == 1
+
+
+def test_missing_chat(client):
+    response = client.get('/12345')
+    assert response.status_code == 302
+    assert response.location == '/new'
+    assert Chat.query.count() == 0
+
+
+def test_new_chat(client):
+    response = client.get('/new')
+    assert response.status_code == 302
+    assert response.location == f'/{Chat.query.one().id}'
 
 
 def test_chat_index_with_cookie(client):
@@ -31,6 +52,209 @@ def test_chat(client):
     assert response.status_code == 200
 
 
+def test_chat_conditional_get(client):
+    chat = Chat.create_new_chat()
+    ChatEntry.create(content='Hello', chat=chat, role='user')
+
+    response = client.get(f'/{chat.id}')
+    etag, _ = response.get_etag()
+    assert response.status_code == 200
+    assert response.headers['Last-Modified'] == chat.last_modified()
+    assert response.cache_control.no_cache
+
+    response = client.get(f'/{chat.id}', headers={
+        'If-None-Match': f'"{etag}"',
+    })
+    assert response.status_code == 304
+    assert response.get_data() == b''
+
+    response = client.get(f'/{chat.id}', headers={
+        'If-Modified-Since': chat.last_modified(),
+    })
+    assert response.status_code == 304
+
+    # A new entry changes the version of the chat, even within a second.
+    ChatEntry.create(content='Hello again', chat=chat, role='user')
+    response = client.get(f'/{chat.id}', headers={
+        'If-None-Match': f'"{etag}"',
+    })
+    assert response.status_code == 200
+    assert response.get_etag()[0] != etag
+    assert 'Hello again' in response.get_data(as_text=True)
+
+
+def test_chat_etag_covers_the_templates(client, app, monkeypatch):
+    chat = Chat.create_new_chat()
+    etag, _ = client.get(f'/{chat.id}').get_etag()
+    with app.test_request_context():
+        assert etag.endswith(f'.{fragments.templates_version()}')
+
+    # A deployment changing the templates changes the ETag of the pages.
+    monkeypatch.setattr('promptly.chat.views.templates_version',
+                        lambda: 'deployed')
+    response = client.get(f'/{chat.id}', headers={
+        'If-None-Match': f'"{etag}"',
+    })
+    assert response.status_code == 200
+    assert response.get_etag()[0].endswith('.deployed')
+
+
+def test_templates_version(app, monkeypatch):
+    with app.test_request_context():
+        version = fragments.templates_version()
+        assert len(version) == 12
+        assert fragments.templates_version() == version
+
+        monkeypatch.setattr(fragments, '__version__', '99.0.0')
+        fragments._templates_digest.cache_clear()
+        assert fragments.templates_version() != version
+    fragments._templates_digest.cache_clear()
+
+
+@pytest.fixture()
+def fragment_cache(monkeypatch):
+    cache = fragments.FragmentCache(max_bytes=1024 * 1024, ttl=60)
+    monkeypatch.setattr(fragments, 'fragment_cache', cache)
+    return cache
+
+
+def test_chat_messages_are_cached(client, fragment_cache, monkeypatch):
+    chat = Chat.create_new_chat()
+    ChatEntry.create(content='<b>Hello</b>', chat=chat, role='user')
+
+    requests_total = fragments._requests_total
+    hits = requests_total.get(result='hit')
+
+    body = client.get(f'/{chat.id}').get_data(as_text=True)
+    assert '&lt;b&gt;Hello&lt;/b&gt;' in body
+    assert len(fragment_cache._entries) == 1
+
+    def render(*args):
+        raise AssertionError('The message should not be rendered again')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(fragments, 'get_template_attribute', render)
+        assert client.get(f'/{chat.id}').get_data(as_text=True) == body
+    assert requests_total.get(result='hit') == hits + 1
+
+    # Only the message of a new entry is rendered.
+    ChatEntry.create(content='Hello again', chat=chat, role='user')
+    body = client.get(f'/{chat.id}').get_data(as_text=True)
+    assert body.index('&lt;b&gt;Hello') < body.index('Hello again')
+    assert len(fragment_cache._entries) == 2
+    assert requests_total.get(result='hit') == hits + 2
+
+
 def test_history(client):
     response = client.get('/history')
     assert response.status_code == 200
+
+
+def test_history_issues_a_single_query(client, queries):
+    for _ in range(5):
+        chat = Chat.create_new_chat()
+        ChatEntry.create(content='Hello, world!', chat=chat, role='user')
+
+    queries.clear()
+    response = client.get('/history')
+
+    assert response.status_code == 200
+    assert response.get_data(as_text=True).count('Hello, world!') == 5
+    assert len(queries) == 1
+
+
+def test_history_json_paginates_with_cursor(app, client):
+    app.config['CHATS_PER_PAGE'] = 2
+    chat_ids = [Chat.create_new_chat().id for _ in range(5)]
+
+    seen, cursor = [], None
+    while True:
+        query = {'cursor': cursor} if cursor else {}
+        response = client.get('/history.json', query_string=query)
+        assert response.status_code == 200
+        assert len(response.json['chats']) <= 2
+
+        seen += [chat['id'] for chat in response.json['chats']]
+        cursor = response.json['next_cursor']
+        if cursor is None:
+            break
+
+    assert seen == sorted(chat_ids, reverse=True)
+
+
+def test_history_renders_first_page(app, client):
+    app.config['CHATS_PER_PAGE'] = 2
+    chat_ids = [Chat.create_new_chat().id for _ in range(3)]
+
+    response = client.get('/history')
+    body = response.get_data(as_text=True)
+
+    assert body.count('class="chat-history-item"') == 2
+    assert f'data-next-cursor="{chat_ids[1]}"' in body
+
+
+def test_chat_renders_most_recent_entries(app, client):
+    app.config['CHAT_ENTRIES_PER_PAGE'] = 2
+    chat = Chat.create_new_chat()
+    entries = [
+        ChatEntry.create(content=f'Message {i}', chat=chat, role='user')
+        for i in range(3)
+    ]
+
+    response = client.get(f'/{chat.id}')
+    body = response.get_data(as_text=True)
+
+    assert 'Message 0' not in body
+    assert body.index('Message 1') < body.index('Message 2')
+    assert f'data-next-cursor="{entries[1].id}"' in body
+
+
+def test_entries_json_paginates_with_cursor(app, client):
+    app.config['CHAT_ENTRIES_PER_PAGE'] = 2
+    chat = Chat.create_new_chat()
+    other = Chat.create_new_chat()
+    for i in range(5):
+        ChatEntry.create(content=f'Message {i}', chat=chat, role='user')
+        ChatEntry.create(content='Other', chat=other, role='user')
+
+    windows, cursor = [], None
+    while True:
+        query = {'cursor': cursor} if cursor else {}
+        response = client.get(f'/{chat.id}/entries.json', query_string=query)
+        assert response.status_code == 200
+
+        windows.insert(0, [e['content'] for e in response.json['entries']])
+        cursor = response.json['next_cursor']
+        if cursor is None:
+            break
+
+    assert windows == [
+        ['Message 0'],
+        ['Message 1', 'Message 2'],
+        ['Message 3', 'Message 4'],
+    ]
+
+
+def test_history_search(app, client):
+    app.config['SEARCH_RESULTS_PER_PAGE'] = 2
+    chat = Chat.create_new_chat(title='Search')
+    for i in range(3):
+        ChatEntry.create(content=f'<i>needle</i> {i}', chat=chat, role='user')
+
+    response = client.get('/history', query_string={'q': 'needle'})
+    body = response.get_data(as_text=True)
+
+    assert body.count('class="chat-history-item"') == 2
+    assert '&lt;i&gt;<mark>needle</mark>&lt;/i&gt;' in body
+    assert 'value="needle"' in body
+
+    cursor = body.split('data-next-cursor="')[1].split('"')[0]
+    response = client.get(
+        '/history/search.json',
+        query_string={'q': 'needle', 'cursor': cursor},
+    )
+
+    assert len(response.json['chats']) == 1
+    assert response.json['chats'][0]['id'] == chat.id
+    assert '<mark>needle</mark>' in response.json['chats'][0]['snippet']
+    assert response.json['next_cursor'] is None
@@ -9,8 +9,11 @@ import os
 
 import pytest
 from flask_migrate import upgrade
+from sqlalchemy import event
 
 from promptly.app import create_app
+from promptly.chat import fragments
+from promptly.models import db
 
 
 @pytest.fixture()
@@ -22,12 +25,15 @@ def project_root() -> str:
 
 
 @pytest.fixture()
-def app(project_root: str):
+def app(project_root: str, monkeypatch):
     """An application for the tests."""
     app_instance = create_app('testing')
     app_instance.config.update({
         'TESTING': True,
     })
+    # The rendered messages are keyed by the IDs of their entries, which
+    # start over with every database.
+    monkeypatch.setattr(fragments, 'fragment_cache', fragments.FragmentCache())
     with app_instance.app_context():
         upgrade(os.path.join(project_root, 'migrations'))
         yield app_instance
@@ -43,3 +49,42 @@ def client(app):
 @pytest.fixture()
 def runner(app):
     return app.test_cli_runner()
+
+
+@pytest.fixture()
+def queries(app):
+    """Collect the SQL statements executed during a test."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    yield statements
+    event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+@pytest.fixture()
+def commits(app):
+    """Collect the transactions committed during a test."""
+    connections = []
+
+    def on_commit(conn):
+        connections.append(conn)
+
+    event.listen(db.engine, 'commit', on_commit)
+    yield connections
+    event.remove(db.engine, 'commit', on_commit)
+
+
+@pytest.fixture()
+def fake_openai(monkeypatch):
+    """A fake OpenAI API server, which the OpenAI client is pointed to."""
+    import openai
+
+    from tests.fake_openai import FakeOpenAI
+
+    with FakeOpenAI() as server:
+        monkeypatch.setattr(openai, 'api_base', server.url)
+        monkeypatch.setattr(openai, 'api_key', 'sk-test')
+        yield server
@@ -0,0 +1,317 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""A fake OpenAI API server for the tests and the load tests.
+
+The server answers the chat completion requests, streamed or not, with an
+echo of the last message or with generated words, after an injected latency,
+and fails the requests on demand or at random with the status codes of the
+real API. It runs on a background event loop, so that the code under test
+sends it real HTTP requests.
+
+It can also be run on its own, e.g. to load test a Promptly server without
+calling the real API::
+
+    $ python -m tests.fake_openai --port 8081 --latency lognormal:0.8,0.5 \\
+        --error-rate 0.01 --tokens-per-second 50 --completion-tokens 120
+    $ OPENAI_API_BASE=http://127.0.0.1:8081/v1 flask --app runner:app run
+
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import deque
+from typing import Callable, Dict, Optional, Sequence, Union
+
+from aiohttp import web
+
+from promptly.utils import EventLoopThread
+
+ERROR_TYPES = {
+    400: 'invalid_request_error',
+    429: 'requests',
+    500: 'server_error',
+    503: 'server_error',
+}
+
+WORDS = (
+    'the quick brown fox jumps over the lazy dog while a prompt engineer '
+    'writes yet another prompt about prompts'
+).split()
+
+
+def latency_distribution(spec: str,
+                         rng: Optional[random.Random] = None
+                         ) -> Callable[[], float]:
+    """Parse the specification of a latency distribution.
+
+    The specification is the name of the distribution, followed by its
+    parameters, in seconds:
+
+    - ``fixed:S``, or just ``S``;
+    - ``uniform:LOW,HIGH``;
+    - ``normal:MEAN,STDDEV``, truncated at zero;
+    - ``lognormal:MEDIAN,SIGMA``, with a long tail as real APIs have;
+    - ``exponential:MEAN``.
+
+    :param str spec: The specification.
+    :param rng: The random number generator.
+    :type rng: random.Random, optional
+    :return: A function drawing a latency.
+    :raises ValueError: If the specification is invalid.
+    """
+    rng = rng or random.Random()
+    name, _, params = spec.partition(':')
+    if not params:
+        name, params = 'fixed', name
+
+    try:
+        args = [float(param) for param in params.split(',')]
+        if name == 'fixed':
+            (value,) = args
+            return lambda: value
+        if name == 'uniform':
+            low, high = args
+            return lambda: rng.uniform(low, high)
+        if name == 'normal':
+            mean, stddev = args
+            return lambda: max(0.0, rng.gauss(mean, stddev))
+        if name == 'lognormal':
+            median, sigma = args
+            return lambda: median * rng.lognormvariate(0, sigma)
+        if name == 'exponential':
+            (mean,) = args
+            return lambda: rng.expovariate(1 / mean)
+    except ValueError as exc:
+        raise ValueError(f'Invalid latency distribution: {spec}') from exc
+
+    raise ValueError(f'Unknown latency distribution: {name}')
+
+
+class FakeOpenAI:
+    """A fake OpenAI API server.
+
+    Usage::
+
+        with FakeOpenAI(latency=0.1) as server:
+            openai.api_base = server.url
+            server.fail(503)
+            ...
+
+    """
+
+    def __init__(self, latency: Union[float, Callable[[], float]] = 0.0,
+                 error_rate: float = 0.0,
+                 error_statuses: Sequence[int] = (429, 500, 503),
+                 tokens_per_second: Optional[float] = None,
+                 completion_tokens: Optional[int] = None,
+                 host: str = '127.0.0.1', port: int = 0,
+                 seed: Optional[int] = None):
+        """Initialize the server.
+
+        :param latency: The time, in seconds, until the first token, or a
+            function returning it for every request.
+        :param float error_rate: The probability of a request to fail.
+        :param error_statuses: The statuses of the failed requests, drawn
+            at random.
+        :param tokens_per_second: The speed at which the tokens of the
+            completion are generated, or ``None`` to generate them at once.
+        :param completion_tokens: The number of generated words, or ``None``
+            to echo the last message.
+        :param str host: The address to listen on.
+        :param int port: The port to listen on, a free one if 0.
+        :param seed: The seed of the random draws.
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.host = host
+        self.port = port
+        self.headers: Dict[str, str] = {}
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        self._rng = random.Random(seed)
+        self._failures: deque = deque()
+        self._ids = itertools.count(1)
+        self._loop_thread = EventLoopThread(name='fake-openai')
+        self._runner = None
+
+    @property
+    def url(self) -> str:
+        """The base URL of the API."""
+        return f'http://{self.host}:{self.port}/v1'
+
+    def fail(self, *statuses: int):
+        """Fail the next requests with the given status codes."""
+        self._failures.extend(statuses)
+
+    def start(self):
+        """Start the server."""
+        self._loop_thread.run(self._start(), timeout=5)
+
+    def stop(self):
+        """Stop the server."""
+        self._loop_thread.run(self._runner.cleanup(), timeout=5)
+        self._loop_thread.stop()
+
+    def __enter__(self) -> 'FakeOpenAI':
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self._completions)
+        # Do not wait for the requests still sleeping on shutdown.
+        self._runner = web.AppRunner(app, shutdown_timeout=0.1)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def _status(self) -> int:
+        if self._failures:
+            return self._failures.popleft()
+        if self.error_rate and self._rng.random() < self.error_rate:
+            return self._rng.choice(self.error_statuses)
+        return 200
+
+    def _tokens(self, params) -> list:
+        if self.completion_tokens is None:
+            return params['messages'][-1]['content'].split(' ')
+        return [self._rng.choice(WORDS)
+                for _ in range(self.completion_tokens)]
+
+    async def _completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            params = await request.json()
+            status = self._status()
+
+            latency = self.latency() if callable(self.latency) \
+                else self.latency
+            await asyncio.sleep(latency)
+
+            if status != 200:
+                return web.json_response({'error': {
+                    'message': f'Injected failure {status}',
+                    'type': ERROR_TYPES.get(status, 'server_error'),
+                    'param': None,
+                    'code': None,
+                }}, status=status, headers=self.headers)
+
+            tokens = self._tokens(params)
+            if params.get('stream'):
+                return await self._stream(request, params, tokens)
+
+            if self.tokens_per_second:
+                await asyncio.sleep(len(tokens) / self.tokens_per_second)
+
+            prompt_tokens = sum(len(message['content'].split())
+                                for message in params['messages'])
+            return web.json_response({
+                'id': f'chatcmpl-{next(self._ids)}',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': params['model'],
+                'choices': [{
+                    'index': 0,
+                    'message': {
+                        'role': 'assistant',
+                        'content': ' '.join(tokens),
+                    },
+                    'finish_reason': 'stop',
+                }],
+                'usage': {
+                    'prompt_tokens': prompt_tokens,
+                    'completion_tokens': len(tokens),
+                    'total_tokens': prompt_tokens + len(tokens),
+                },
+            }, headers=self.headers)
+        finally:
+            self.in_flight -= 1
+
+    async def _stream(self, request: web.Request, params,
+                      tokens: list) -> web.StreamResponse:
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            **self.headers,
+        })
+        await response.prepare(request)
+
+        chunk_id = f'chatcmpl-{next(self._ids)}'
+
+        async def send(delta, finish_reason=None):
+            chunk = {
+                'id': chunk_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': params['model'],
+                'choices': [{
+                    'index': 0,
+                    'delta': delta,
+                    'finish_reason': finish_reason,
+                }],
+            }
+            await response.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+
+        await send({'role': 'assistant'})
+        for i, token in enumerate(tokens):
+            if self.tokens_per_second:
+                await asyncio.sleep(1 / self.tokens_per_second)
+            await send({'content': token if i == 0 else f' {token}'})
+        await send({}, finish_reason='stop')
+        await response.write(b'data: [DONE]\n\n')
+        await response.write_eof()
+        return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a fake OpenAI API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', default='0',
+                        help='the latency distribution, e.g. '
+                             'lognormal:0.8,0.5 (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--tokens-per-second', type=float)
+    parser.add_argument('--completion-tokens', type=int)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    server = FakeOpenAI(
+        latency=latency_distribution(args.latency, random.Random(args.seed)),
+        error_rate=args.error_rate,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        host=args.host,
+        port=args.port,
+        seed=args.seed,
+    )
+    server.start()
+    print(f'Fake OpenAI API listening on {server.url}', flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+from promptly.metrics import registry
+
+
+def test_metrics(client):
+    registry.counter('test_metrics_total', 'Test.').inc()
+
+    response = client.get('/metrics')
+
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    assert 'test_metrics_total 1.0' in response.get_data(as_text=True)
@@ -0,0 +1,50 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+import pytest
+
+from promptly.models import Chat, ChatEntry, db, in_transaction, transaction
+
+
+def test_create_commits_by_default(commits):
+    Chat.create_new_chat()
+    assert len(commits) == 1
+
+
+def test_create_without_commit(commits):
+    chat = Chat.create(title='Draft', commit=False)
+    chat.flush()
+
+    assert chat.id is not None
+    assert not commits
+
+    db.session.rollback()
+    assert Chat.get(chat.id) is None
+
+
+def test_transaction_commits_once(commits):
+    with transaction():
+        assert in_transaction()
+        chat = Chat.create_new_chat()
+        ChatEntry.create(content='Hello', chat=chat, role='user')
+        with transaction():
+            ChatEntry.create(content='Hi!', chat=chat, role='assistant')
+
+    assert not in_transaction()
+    assert len(commits) == 1
+    assert len(Chat.get(chat.id).entry) == 2
+
+
+def test_transaction_rolls_back_on_error(commits):
+    with pytest.raises(RuntimeError):
+        with transaction():
+            Chat.create(title='Doomed')
+            raise RuntimeError()
+
+    assert not commits
+    assert not in_transaction()
+    assert Chat.query.filter_by(title='Doomed').count() == 0
@@ -0,0 +1,150 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from promptly import tokenizer
+from promptly.models import Chat, ChatEntry, db
+
+
+def test_teaser_without_entries(app):
+    chat = Chat.create_new_chat()
+    assert chat.teaser() == ''
+
+
+def test_teaser_uses_first_entry(app):
+    chat = Chat.create_new_chat()
+    ChatEntry.create(content='First', chat=chat, role='user')
+    ChatEntry.create(content='Second', chat=chat, role='assistant')
+
+    assert chat.teaser() == 'First'
+
+
+def test_teaser_is_truncated(app):
+    chat = Chat.create_new_chat()
+    ChatEntry.create(content='x' * 20, chat=chat, role='user')
+
+    assert chat.teaser(length=10) == 'x' * 7 + '...'
+    assert chat.teaser(length=20) == 'x' * 20
+
+
+def test_summaries(app, queries):
+    empty = Chat.create_new_chat(title='Empty')
+    chat = Chat.create_new_chat(title='Full')
+    ChatEntry.create(content='Hello, world!', chat=chat, role='user')
+    ChatEntry.create(content='Hi!', chat=chat, role='assistant')
+
+    queries.clear()
+    summaries = Chat.summaries(length=8)
+
+    assert len(queries) == 1
+    assert [(s.id, s.title, s.teaser) for s in summaries] == [
+        (chat.id, 'Full', 'Hello...'),
+        (empty.id, 'Empty', ''),
+    ]
+
+
+def test_summaries_keyset_pagination(app):
+    chat_ids = [Chat.create_new_chat().id for _ in range(4)]
+
+    first_page = Chat.summaries(limit=2)
+    second_page = Chat.summaries(limit=2, before=first_page[-1].id)
+
+    assert [s.id for s in first_page] == chat_ids[:1:-1]
+    assert [s.id for s in second_page] == chat_ids[1::-1]
+    assert Chat.summaries(limit=2, before=chat_ids[0]) == []
+
+
+def test_summaries_after_a_deleted_anchor(app):
+    chat_ids = [Chat.create_new_chat().id for _ in range(4)]
+    Chat.get(chat_ids[2]).delete()
+
+    # The page after the deleted chat goes on with the older ones.
+    summaries = Chat.summaries(limit=2, before=chat_ids[2])
+    assert [s.id for s in summaries] == [chat_ids[1], chat_ids[0]]
+
+
+def test_summaries_are_ordered_by_creation_time(app):
+    older, newer = Chat.create_new_chat(), Chat.create_new_chat()
+    older.created_at = datetime(2023, 10, 18, 12, 0, 0)
+    newer.created_at = datetime(2023, 10, 17, 12, 0, 0)
+    older.save()
+    newer.save()
+
+    assert [s.id for s in Chat.summaries()] == [older.id, newer.id]
+    assert [s.id for s in Chat.summaries(before=older.id)] == [newer.id]
+
+
+def test_token_count_is_set_on_insert(app, monkeypatch):
+    monkeypatch.setattr(tokenizer, '_get_encoding', lambda model: None)
+    chat = Chat.create_new_chat()
+    entry = ChatEntry.create(content='x' * 10, chat=chat, role='user')
+
+    assert entry.token_count == 4
+    assert entry.token_encoding == tokenizer.APPROXIMATE_ENCODING
+
+
+def test_backfill_token_counts(app, runner, monkeypatch):
+    monkeypatch.setattr(tokenizer, '_get_encoding', lambda model: None)
+    chat = Chat.create_new_chat()
+    for i in range(5):
+        ChatEntry.create(content='x' * 3 * (i + 1), chat=chat, role='user')
+    db.session.execute(sa.update(ChatEntry).values(
+        token_count=None,
+        token_encoding=None,
+    ))
+    db.session.commit()
+
+    assert ChatEntry.backfill_token_counts(batch_size=2) == 5
+    assert ChatEntry.backfill_token_counts(batch_size=2) == 0
+    assert [e.token_count for e in chat.entry] == [1, 2, 3, 4, 5]
+
+    result = runner.invoke(args=['count-tokens', '--batch-size', '2'])
+    assert 'Updated 0 chat entries.' in result.output
+
+
+def test_token_usage(app, queries):
+    chat = Chat.create_new_chat()
+    ChatEntry.create(content='Hi', chat=chat, role='user')
+    ChatEntry.create(content='Hello', chat=chat, role='assistant',
+                     prompt_tokens=10, completion_tokens=3)
+    ChatEntry.create(content='Bye', chat=chat, role='user')
+    ChatEntry.create(content='Goodbye', chat=chat, role='assistant',
+                     prompt_tokens=20, completion_tokens=4)
+    chat = Chat.get(chat.id)
+
+    queries.clear()
+    usage = chat.token_usage()
+
+    assert len(queries) == 1
+    assert usage == (30, 7)
+    assert usage.total_tokens == 37
+    assert Chat.create_new_chat().token_usage() == (0, 0)
+
+
+def test_new_entries_bump_the_chat(app):
+    chat = Chat.create_new_chat()
+    db.session.execute(
+        sa.update(Chat)
+        .where(Chat.id == chat.id)
+        .values(updated_at=datetime(2023, 1, 1))
+    )
+    db.session.commit()
+    etag = chat.etag()
+    assert chat.updated_at == datetime(2023, 1, 1)
+
+    entry = ChatEntry.create(content='Hello', chat=chat, role='user')
+
+    assert chat.updated_at > datetime(2023, 1, 1)
+    assert chat.last_modified() != 'Sun, 01 Jan 2023 00:00:00 GMT'
+    assert chat.etag() != etag
+
+    etag = chat.etag()
+    entry.delete()
+    assert chat.etag() != etag
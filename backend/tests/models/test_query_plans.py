@@ -0,0 +1,121 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""Query plan regression tests.
+
+These tests ask SQLite how it executes the hot queries and assert that they
+are served by an index rather than by a full table scan or a temporary
+sort.
+"""
+
+import re
+
+import pytest
+import sqlalchemy as sa
+
+from promptly.models import (
+    Chat,
+    ChatEntry,
+    Criterion,
+    db,
+    KeyInsight,
+    Prompt,
+    Reference,
+    Rule,
+)
+
+
+@pytest.fixture
+def explain(app):
+    if db.engine.dialect.name != 'sqlite':
+        pytest.skip('EXPLAIN QUERY PLAN is specific to SQLite')
+
+    def query_plan(statement) -> str:
+        compiled = statement.compile(
+            dialect=db.engine.dialect,
+            compile_kwargs={'literal_binds': True},
+        )
+        rows = db.session.execute(sa.text(f'EXPLAIN QUERY PLAN {compiled}'))
+        return '\n'.join(row[-1] for row in rows)
+
+    return query_plan
+
+
+def assert_uses_index(plan: str, index: str):
+    # A SCAN of the index would read all of it, not a range.
+    assert re.search(rf'^SEARCH \w+ USING (COVERING )?INDEX {index} ', plan,
+                     re.MULTILINE), plan
+    assert 'SCAN' not in plan, plan
+    assert 'USE TEMP B-TREE' not in plan, plan
+
+
+def test_chat_entries_load(explain):
+    relationship = Chat.entry.property
+    query = (
+        sa.select(ChatEntry)
+        .where(ChatEntry.chat_id == 1)
+        .order_by(*relationship.order_by)
+    )
+    assert_uses_index(explain(query), 'ix_chat_entries_chat_id_created_at')
+
+
+def test_chat_history_page(explain):
+    chats = [Chat.create_new_chat() for _ in range(3)]
+    query = (
+        sa.select(Chat.id)
+        .where(Chat.created_before(chats[1].id))
+        .order_by(Chat.created_at.desc(), Chat.id.desc())
+        .limit(50)
+    )
+    plan = explain(query)
+    assert_uses_index(plan, 'ix_chats_created_at')
+    assert '(created_at<?)' in plan, plan
+
+
+def test_chat_entries_window(explain):
+    chat = Chat.create_new_chat()
+    for _ in range(10):
+        ChatEntry.create(content='Hello', chat=chat, role='user')
+
+    query = (
+        sa.select(ChatEntry)
+        .where(ChatEntry.chat_id == 1)
+        .where(ChatEntry.created_before(10))
+        .order_by(ChatEntry.created_at.desc(), ChatEntry.id.desc())
+        .limit(50)
+    )
+    assert_uses_index(explain(query), 'ix_chat_entries_chat_id_created_at')
+
+
+def test_first_entry_lookup(explain):
+    # pylint: disable=protected-access
+    query = Chat._first_entry_content(150).where(ChatEntry.chat_id == 1)
+    assert_uses_index(explain(query), 'ix_chat_entries_chat_id_created_at')
+
+
+@pytest.mark.parametrize(
+    'model, column, index',
+    [
+        (Rule, Rule.prompt_id, 'ix_prompt_rules_prompt_id'),
+        (Reference, Reference.prompt_id, 'ix_prompt_references_prompt_id'),
+        (Criterion, Criterion.prompt_id, 'ix_prompt_criteria_prompt_id'),
+        (
+            KeyInsight,
+            KeyInsight.reference_id,
+            'ix_prompt_reference_key_insights_reference_id',
+        ),
+    ]
+)
+def test_prompt_children_load(explain, model, column, index):
+    query = sa.select(model).where(column == 1)
+    assert_uses_index(explain(query), index)
+
+
+def test_prompt_relationships_are_indexed():
+    for relationship in Prompt.__mapper__.relationships:
+        for column in relationship.remote_side:
+            assert column.index, f'{column} is not indexed'
@@ -0,0 +1,151 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+import os
+import shutil
+
+import pytest
+import sqlalchemy as sa
+from flask_migrate import upgrade
+
+from promptly.app import create_app
+from promptly.config import TestingConfig
+from promptly.models import (
+    Chat,
+    db,
+    primary,
+    read_only,
+    READ_PRIMARY_COOKIE,
+    reads_from_replica,
+    replica,
+)
+
+
+@pytest.fixture()
+def replicated(project_root, tmp_path):
+    """An application with a primary database and a replica, both files.
+
+    The replica is a copy of the primary, made by :func:`replicate`, which
+    lags behind it until the next copy.
+    """
+    class ReplicatedConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{tmp_path / "primary.sqlite3"}'
+        DATABASE_REPLICA_URLS = [f'sqlite:///{tmp_path / "replica.sqlite3"}']
+
+    app = create_app(ReplicatedConfig)
+    with app.app_context():
+        upgrade(os.path.join(project_root, 'migrations'))
+        replicate()
+        yield app
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+def replicate():
+    db.session.remove()
+    for engine in db.engines.values():
+        engine.dispose()
+    shutil.copyfile(db.engines[None].url.database,
+                    db.engines['replica_1'].url.database)
+
+
+def replica_titles():
+    return db.session.scalars(
+        sa.select(Chat.title).order_by(Chat.id),
+        bind_arguments={'bind': db.engines['replica_1']},
+    ).all()
+
+
+def test_reads_from_the_replica(replicated):
+    chat_id = Chat.create(title='Replicated').id
+    replicate()
+    Chat.get(chat_id).title = 'Not replicated yet'
+    db.session.commit()
+    db.session.remove()
+
+    with replica():
+        assert reads_from_replica()
+        assert Chat.get(chat_id).title == 'Replicated'
+        with primary():
+            assert not reads_from_replica()
+            assert Chat.query.one().title == 'Not replicated yet'
+        assert reads_from_replica()
+    assert not reads_from_replica()
+
+
+def test_read_only_views_use_the_replica(replicated):
+    Chat.create(title='Replicated')
+    replicate()
+    Chat.create(title='Not replicated yet')
+    db.session.remove()
+
+    response = replicated.test_client().get('/history.json')
+
+    titles = [chat['title'] for chat in response.json['chats']]
+    assert titles == ['Replicated']
+
+
+def test_writes_go_to_the_primary(replicated):
+    client = replicated.test_client()
+
+    with replica():
+        Chat.create(title='Written')
+        # The session reads its own changes back from the primary.
+        assert not reads_from_replica()
+        assert Chat.query.one().title == 'Written'
+    assert replica_titles() == []
+
+    # A client reads from the primary for a while after a write.
+    db.session.remove()
+    response = client.get('/new', follow_redirects=True)
+    assert response.status_code == 200
+    assert replica_titles() == []
+    assert client.get_cookie(READ_PRIMARY_COOKIE) is not None
+
+    response = client.get('/history.json')
+    assert len(response.json['chats']) == 2
+
+
+def test_writes_of_read_only_views_go_to_the_primary(replicated):
+    @replicated.route('/write')
+    @read_only
+    def write():
+        Chat.create(title='Written')
+        return Chat.query.one().title
+
+    client = replicated.test_client()
+    response = client.get('/write')
+
+    assert response.get_data(as_text=True) == 'Written'
+    assert replica_titles() == []
+    assert client.get_cookie(READ_PRIMARY_COOKIE) is not None
+
+
+def test_lagging_replica_falls_back_to_the_primary(replicated):
+    chat_id = Chat.create(title='Not replicated yet').id
+    db.session.remove()
+    client = replicated.test_client()
+
+    response = client.get(f'/{chat_id}')
+    assert response.status_code == 200
+    # The chat is not mistaken for a missing one, and recreated.
+    assert client.get_cookie('chat_id').value == str(chat_id)
+    assert client.get_cookie(READ_PRIMARY_COOKIE) is None
+
+    client.set_cookie('chat_id', str(chat_id))
+    response = client.get('/')
+    assert response.status_code == 302
+    assert Chat.query.count() == 1
+
+
+def test_without_replicas(app):
+    Chat.create(title='Hello')
+
+    with replica():
+        assert not reads_from_replica()
+        assert Chat.exists(1)
@@ -0,0 +1,82 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+import sqlalchemy as sa
+
+from promptly.models import Chat, ChatEntry, db, search_entries
+from promptly.models.search import fts5_query, highlight, parse_cursor
+
+
+def test_fts5_query_quotes_words():
+    assert fts5_query('what is "2+2" OR NOT') == \
+        '"what" "is" "2" "2" "OR" "NOT"*'
+    assert fts5_query('?!') == ''
+
+
+def test_highlight_escapes_content():
+    assert highlight('<b>\x02bold\x03</b>') == \
+        '&lt;b&gt;<mark>bold</mark>&lt;/b&gt;'
+    assert highlight(None) == ''
+
+
+def test_parse_cursor():
+    assert parse_cursor('-1.5:42') == (-1.5, 42)
+    assert parse_cursor('foo') is None
+    assert parse_cursor(None) is None
+
+
+def test_search_ranks_and_highlights(app):
+    chat = Chat.create_new_chat(title='Fruits')
+    ChatEntry.create(content='I like apples and pears', chat=chat,
+                     role='user')
+    ChatEntry.create(content='Apples, apples, apples!', chat=chat,
+                     role='assistant')
+    ChatEntry.create(content='Bananas', chat=chat, role='user')
+
+    results = search_entries('apple', limit=10)
+
+    assert [str(r.snippet) for r in results] == [
+        '<mark>Apples</mark>, <mark>apples</mark>, <mark>apples</mark>!',
+        'I like <mark>apples</mark> and pears',
+    ]
+    assert {r.title for r in results} == {'Fruits'}
+    assert search_entries('', limit=10) == []
+
+
+def test_search_index_follows_updates_and_deletes(app):
+    chat = Chat.create_new_chat()
+    entry = ChatEntry.create(content='Original text', chat=chat, role='user')
+
+    db.session.execute(
+        sa.update(ChatEntry)
+        .where(ChatEntry.id == entry.id)
+        .values(content='Edited text')
+    )
+    db.session.commit()
+    assert search_entries('original', limit=10) == []
+    assert len(search_entries('edited', limit=10)) == 1
+
+    entry = ChatEntry.get(entry.id)
+    entry.delete()
+    assert search_entries('edited', limit=10) == []
+
+
+def test_search_keyset_pagination(app):
+    chat = Chat.create_new_chat()
+    for i in range(5):
+        ChatEntry.create(content='needle ' * (i + 1), chat=chat, role='user')
+
+    seen, after = [], None
+    while True:
+        page = search_entries('needle', limit=2, after=after)
+        if not page:
+            break
+        seen += [r.entry_id for r in page]
+        after = parse_cursor(page[-1].cursor)
+
+    assert sorted(seen) == [e.id for e in chat.entry]
+    assert len(seen) == 5
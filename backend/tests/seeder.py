@@ -15,13 +15,16 @@ library, and is inserted into the database using the SQLAlchemy ORM.
 import random
 import sys
 from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 
+import sqlalchemy as sa
 from faker import Faker
 from faker.providers import company, lorem, python
 from sqlalchemy.exc import IntegrityError
 
 from promptly.models import db
-from promptly.models.chat import ChatEntry
+from promptly.models.chat import Chat, ChatEntry
+from promptly.tokenizer import count_tokens, default_model, encoding_name
 
 fake = Faker()
 
@@ -30,10 +33,17 @@ fake.add_provider(lorem)
 fake.add_provider(python)
 
 
-def seed():
-    """Init the seeding process by seeding chat and chat entry entities."""
-    chats = seed_entities(create_chats())
-    _ = seed_entities(create_chat_entries(chats))
+def seed(chats_count=None, entries_per_chat=None):
+    """Init the seeding process by seeding chat and chat entry entities.
+
+    :param chats_count: The number of chats, 15 by default.
+    :type chats_count: int or None
+    :param entries_per_chat: The average number of entries per chat, 10 by
+        default.
+    :type entries_per_chat: int or None
+    """
+    chats = seed_entities(create_chats(chats_count))
+    _ = seed_entities(create_chat_entries(chats, entries_per_chat))
 
     prompts = seed_entities(create_prompts())
     _ = seed_entities(create_prompt_rules(prompts))
@@ -59,14 +69,19 @@ def create_chats(entries_count=None):
     return seed_data
 
 
-def create_chat_entries(chats):
+def create_chat_entries(chats, entries_per_chat=None):
     """
     Seed the chat entries table with a specified chats.
 
     :param chats: A list of chats to which the chat entries will be associated.
     :type chats: list
+    :param entries_per_chat: The average number of entries per chat, 10 by
+        default.
+    :type entries_per_chat: int or None
     """
-    entries_count = len(chats) * 10
+    if entries_per_chat is None:
+        entries_per_chat = 10
+    entries_count = len(chats) * entries_per_chat
     seed_data = {
         'model': 'ChatEntry',
         'table': 'chat_entries',
@@ -88,6 +103,70 @@ def create_chat_entries(chats):
     return seed_data
 
 
+def generate_chats(chats_count, entries_per_chat=0, batch_size=1000):
+    """
+    Insert many chats and chat entries at once, e.g. for benchmarks.
+
+    Unlike :func:`seed`, the rows are inserted in bulk, bypassing the unit of
+    work of the ORM, so that tens of thousands of them are generated in a few
+    seconds. The contents are drawn from a small pool of fake paragraphs,
+    whose tokens are counted once. Chats are created one minute apart, the
+    last one now, and the entries of a chat one second apart, alternating
+    between the user and the assistant.
+
+    :param int chats_count: The number of chats.
+    :param int entries_per_chat: The number of entries of each chat.
+    :param int batch_size: The number of rows inserted per statement.
+    :return: The IDs of the chats, oldest first.
+    :rtype: list[int]
+    """
+    model = default_model()
+    encoding = encoding_name(model)
+    pool = [fake.paragraph(nb_sentences=4) for _ in range(100)]
+    token_counts = [count_tokens(content, model) for content in pool]
+
+    now = datetime.now(timezone.utc)
+    chats_start = now - timedelta(minutes=chats_count)
+    chat_ids = []
+    for offset in range(0, chats_count, batch_size):
+        rows = [
+            {
+                'title': fake.sentence(nb_words=3),
+                'created_at': chats_start + timedelta(minutes=i + 1),
+                'updated_at': chats_start + timedelta(minutes=i + 1),
+            }
+            for i in range(offset, min(offset + batch_size, chats_count))
+        ]
+        chat_ids.extend(db.session.scalars(
+            sa.insert(Chat).returning(Chat.id, sort_by_parameter_order=True),
+            rows,
+        ))
+
+    roles = (ChatEntry.Role.USER, ChatEntry.Role.ASSISTANT)
+    rows = []
+    for chat_id in chat_ids:
+        entries_start = now - timedelta(seconds=entries_per_chat)
+        for i in range(entries_per_chat):
+            content = random.randrange(len(pool))
+            rows.append({
+                'chat_id': chat_id,
+                'content': pool[content],
+                'role': roles[i % 2],
+                'token_count': token_counts[content],
+                'token_encoding': encoding,
+                'created_at': entries_start + timedelta(seconds=i),
+                'updated_at': entries_start + timedelta(seconds=i),
+            })
+            if len(rows) == batch_size:
+                db.session.execute(sa.insert(ChatEntry), rows)
+                rows = []
+    if rows:
+        db.session.execute(sa.insert(ChatEntry), rows)
+
+    db.session.commit()
+    return chat_ids
+
+
 def create_prompts():
     entries_count = 10
     seed_data = {
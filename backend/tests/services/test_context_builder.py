@@ -0,0 +1,96 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+import pytest
+
+from promptly import tokenizer
+from promptly.models import Chat, ChatEntry
+from promptly.services.context_builder import (
+    context_window,
+    ContextBuilder,
+    ContextTooLargeError,
+)
+
+
+def create_chat(count):
+    chat = Chat.create_new_chat()
+    for i in range(count):
+        role = 'user' if i % 2 == 0 else 'assistant'
+        ChatEntry.create(content=f'{i:08d}', chat=chat, role=role)
+    return chat
+
+
+def make_builder(monkeypatch, budget, batch_size=2):
+    # A user message costs 4 + 2 (role) + 3 (content) = 9 estimated tokens,
+    # an assistant message 4 + 3 + 3 = 10.
+    monkeypatch.setattr(tokenizer, '_get_encoding', lambda model: None)
+    monkeypatch.setenv('OPENAI_CONTEXT_WINDOW', str(budget + 100))
+    return ContextBuilder('gpt-4', max_tokens=100, batch_size=batch_size)
+
+
+def test_context_window(monkeypatch):
+    monkeypatch.delenv('OPENAI_CONTEXT_WINDOW', raising=False)
+    assert context_window('gpt-4') == 8192
+    assert context_window('gpt-4-0613') == 8192
+    assert context_window('gpt-4-32k-0613') == 32768
+    assert context_window('unknown') == 4096
+
+    monkeypatch.setenv('OPENAI_CONTEXT_WINDOW', '1000')
+    assert context_window('gpt-4') == 1000
+
+
+def test_build_whole_chat(app, monkeypatch):
+    chat = create_chat(3)
+    builder = make_builder(monkeypatch, budget=100)
+
+    assert builder.build(chat.id) == [
+        {'role': 'user', 'content': '00000000'},
+        {'role': 'assistant', 'content': '00000001'},
+        {'role': 'user', 'content': '00000002'},
+    ]
+
+
+def test_build_keeps_latest_entries_within_budget(app, monkeypatch, queries):
+    chat = create_chat(10)
+    builder = make_builder(monkeypatch, budget=10 + 9 + 10)
+
+    queries.clear()
+    messages = builder.build(chat.id)
+
+    assert [m['content'] for m in messages] == [
+        '00000007', '00000008', '00000009',
+    ]
+    # Two batches of two entries are enough to fill the budget, older
+    # entries are never loaded.
+    batches = [q for q in queries
+               if 'SELECT chat_entries.content' in q.replace('\n', ' ')]
+    assert len(batches) == 2
+
+
+def test_build_rejects_latest_entry_over_budget(app, monkeypatch):
+    chat = create_chat(2)
+    builder = make_builder(monkeypatch, budget=9)
+
+    with pytest.raises(ContextTooLargeError) as excinfo:
+        builder.build(chat.id)
+    assert (excinfo.value.tokens, excinfo.value.budget) == (10, 9)
+
+
+def test_check_rejects_message_over_budget(monkeypatch):
+    builder = make_builder(monkeypatch, budget=9)
+
+    builder.check({'role': 'user', 'content': '00000008'})
+    with pytest.raises(ContextTooLargeError) as excinfo:
+        builder.check({'role': 'assistant', 'content': '00000009'})
+    assert (excinfo.value.tokens, excinfo.value.budget) == (10, 9)
+
+
+def test_build_empty_chat(app, monkeypatch):
+    chat = create_chat(0)
+    builder = make_builder(monkeypatch, budget=100)
+
+    assert builder.build(chat.id) == []
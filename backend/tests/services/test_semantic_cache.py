@@ -0,0 +1,94 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from promptly.models import Chat, ChatEntry  # noqa: E402
+from promptly.services import openai_service  # noqa: E402
+from promptly.services.semantic_cache import (  # noqa: E402
+    HashingVectorizer,
+    SemanticCache,
+    VectorIndex,
+)
+
+
+def similarity(first, second):
+    vectorizer = HashingVectorizer()
+    return float(vectorizer.transform(first) @ vectorizer.transform(second))
+
+
+def test_vectorizer_similarity():
+    assert similarity('what is 2+2', "What's 2 + 2?") == pytest.approx(1.0)
+    assert similarity('What is the capital of France?',
+                      'what is the capital of france') > 0.92
+    assert similarity('What is the capital of France?',
+                      'How do I bake bread?') < 0.5
+    assert not HashingVectorizer().transform('?!').any()
+
+
+def test_vector_index_grows_and_sorts():
+    vectors = np.eye(4, dtype=np.float32)
+    index = VectorIndex(dim=4, capacity=1)
+
+    index.add(np.arange(10, 14), vectors)
+
+    assert len(index) == 4
+    query = np.array([0.1, 0.9, 0.3, 0], dtype=np.float32)
+    assert [i for i, _ in index.search(query, k=3)] == [11, 12, 10]
+    assert VectorIndex(dim=4).search(query) == []
+
+
+def create_turn(query, answer, **kwargs):
+    chat = Chat.create_new_chat()
+    ChatEntry.create(content=query, chat=chat, role='user')
+    return ChatEntry.create(content=answer, chat=chat, role='assistant',
+                            **kwargs)
+
+
+def test_lookup_builds_from_first_turns(app):
+    answer = create_turn('What is 2+2?', '4')
+    follow_up = ChatEntry.create(content='And 3+3?', chat=answer.chat,
+                                 role='user')
+    ChatEntry.create(content='6', chat=follow_up.chat, role='assistant')
+    create_turn('What is 5+5?', '10', model=SemanticCache.MODEL)
+
+    cache = SemanticCache()
+
+    assert cache.lookup("what's 2 + 2") == answer
+    assert cache.lookup('And 3+3?') is None
+    assert cache.lookup('What is 5+5?') is None
+    assert len(cache.index) == 1
+
+
+def test_remember_only_adds_first_answers(app):
+    cache = SemanticCache()
+    assert cache.lookup('Hello') is None
+
+    answer = create_turn('Hello', 'Hi!')
+    cache.remember('Hello', answer)
+    later = ChatEntry.create(content='Bye', chat=answer.chat, role='assistant')
+    cache.remember('Hello again', later)
+
+    assert cache.lookup('hello') == answer
+    assert cache.lookup('hello again') is None
+
+
+def test_complete_uses_semantic_cache(app, monkeypatch):
+    answer = create_turn('What is 2+2?', '4')
+
+    def fail(*args, **kwargs):
+        raise AssertionError('OpenAI must not be called')
+
+    monkeypatch.setattr(openai_service, 'completion', fail)
+    monkeypatch.setattr(openai_service, 'get_semantic_cache', SemanticCache)
+
+    completion = openai_service.OpenAIService().complete("What's 2 + 2")
+
+    assert completion.content == answer.content
+    assert completion.model == SemanticCache.MODEL
@@ -0,0 +1,103 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+import random
+import time
+
+import openai
+import pytest
+
+from promptly.api import openai_eval
+from promptly.api.openai_eval import _close_session, _loop_thread, \
+    stream_completion
+from promptly.api.ratelimit import RateLimiter
+from promptly.tokenizer import count_prompt_tokens, count_tokens
+from tests.fake_openai import FakeOpenAI, latency_distribution
+
+MESSAGES = [{'role': 'user', 'content': 'Hello fake world'}]
+
+
+@pytest.fixture
+def rate_limiter(monkeypatch):
+    """A rate limiter, fed by an HTTP session of its own."""
+    limiter = RateLimiter('test_fake_openai', clock=lambda: 1000.0)
+    _loop_thread.run(_close_session())
+    monkeypatch.setattr(openai_eval, 'rate_limiter', limiter)
+    yield limiter
+    _loop_thread.run(_close_session())
+
+
+@pytest.mark.parametrize('spec,low,high', [
+    ('0.25', 0.25, 0.25),
+    ('fixed:0.25', 0.25, 0.25),
+    ('uniform:0.1,0.2', 0.1, 0.2),
+    ('normal:0.1,0.5', 0.0, float('inf')),
+    ('lognormal:0.5,0.5', 0.0, float('inf')),
+    ('exponential:0.5', 0.0, float('inf')),
+])
+def test_latency_distribution(spec, low, high):
+    draw = latency_distribution(spec, random.Random(42))
+
+    assert all(low <= draw() <= high for _ in range(100))
+
+
+@pytest.mark.parametrize('spec', ['gamma:1,2', 'uniform:1', 'fixed:slow'])
+def test_invalid_latency_distribution(spec):
+    with pytest.raises(ValueError):
+        latency_distribution(spec)
+
+
+def test_completion_usage(fake_openai):
+    fake_openai.completion_tokens = 5
+
+    response = openai.ChatCompletion.create(model='gpt-4', messages=MESSAGES)
+
+    assert len(response['choices'][0]['message']['content'].split()) == 5
+    assert response['usage'] == {
+        'prompt_tokens': 3,
+        'completion_tokens': 5,
+        'total_tokens': 8,
+    }
+
+
+def test_streaming_at_token_throughput(fake_openai):
+    fake_openai.tokens_per_second = 50
+
+    start = time.monotonic()
+    stream = stream_completion(model='gpt-4', messages=MESSAGES)
+    deltas = list(stream)
+
+    assert ''.join(deltas) == 'Hello fake world'
+    assert time.monotonic() - start >= 3 / 50
+    assert stream.usage == {
+        'prompt_tokens': count_prompt_tokens(MESSAGES, 'gpt-4'),
+        'completion_tokens': count_tokens('Hello fake world', 'gpt-4'),
+        'total_tokens': count_prompt_tokens(MESSAGES, 'gpt-4')
+        + count_tokens('Hello fake world', 'gpt-4'),
+    }
+
+
+def test_random_failures():
+    with FakeOpenAI(error_rate=1.0, error_statuses=(503,)) as server:
+        with pytest.raises(openai.error.ServiceUnavailableError):
+            openai.ChatCompletion.create(
+                model='gpt-4', messages=MESSAGES,
+                api_base=server.url, api_key='sk-test',
+            )
+
+    assert server.requests == 1
+
+
+def test_streaming_updates_the_rate_limits(fake_openai, rate_limiter):
+    fake_openai.headers = {
+        'x-ratelimit-limit-requests': '60',
+        'x-ratelimit-remaining-requests': '0',
+    }
+
+    list(stream_completion(model='gpt-4', messages=MESSAGES))
+
+    assert rate_limiter.reserve('gpt-4', 1) == pytest.approx(1)
@@ -0,0 +1,109 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+import logging
+
+import openai
+import sqlalchemy as sa
+
+from promptly import instrumentation
+from promptly.api.openai_eval import completion
+from promptly.config import ProductionConfig
+from promptly.metrics import registry
+from promptly.models import Chat, db
+
+
+def _metric(name, **labels):
+    return registry.histogram(name).get(**labels)
+
+
+def test_request_metrics(client):
+    Chat.create(title='Hello')
+    labels = {'endpoint': 'chat.history'}
+    requests = _metric('promptly_request_duration_seconds',
+                       method='GET', status=200, **labels)
+    queries = registry.histogram('promptly_request_queries').sum(**labels)
+
+    assert client.get('/history').status_code == 200
+
+    assert _metric('promptly_request_duration_seconds',
+                   method='GET', status=200, **labels) == requests + 1
+    assert registry.histogram('promptly_request_queries').sum(
+        **labels) > queries
+
+    response = client.get('/metrics')
+    assert ('promptly_request_duration_seconds_count{endpoint="chat.history",'
+            'method="GET",status="200"}') in response.get_data(as_text=True)
+
+
+def test_unmatched_requests(client):
+    labels = {'endpoint': '<unmatched>', 'method': 'POST', 'status': 405}
+    requests = _metric('promptly_request_duration_seconds', **labels)
+
+    assert client.post('/history').status_code == 405
+
+    assert _metric('promptly_request_duration_seconds',
+                   **labels) == requests + 1
+
+
+def test_slow_queries_are_logged(app, monkeypatch, caplog):
+    monkeypatch.setattr(instrumentation, 'PROMPTLY_SLOW_QUERY_SECONDS', 0)
+    slow_queries = registry.counter('promptly_slow_queries_total').get()
+
+    with caplog.at_level(logging.WARNING, logger=instrumentation.__name__):
+        db.session.execute(sa.text('SELECT 42'))
+
+    assert registry.counter('promptly_slow_queries_total').get() > slow_queries
+    assert 'Slow query' in caplog.text
+    assert 'SELECT 42' in caplog.text
+
+
+def test_repeated_queries_are_logged(app, client, monkeypatch, caplog):
+    monkeypatch.setattr(instrumentation, 'PROMPTLY_N_PLUS_ONE_QUERIES', 3)
+    chat_ids = [Chat.create(title=f'Chat {i}').id for i in range(3)]
+
+    def titles():
+        # One query per chat, instead of one for all of them.
+        return ', '.join(Chat.get(chat_id).title for chat_id in chat_ids)
+
+    app.add_url_rule('/titles', 'titles', titles)
+    db.session.remove()
+    counter = registry.counter('promptly_n_plus_one_requests_total')
+    repeated = counter.get(endpoint='titles')
+
+    with caplog.at_level(logging.WARNING, logger=instrumentation.__name__):
+        assert client.get('/titles').status_code == 200
+
+    assert counter.get(endpoint='titles') == repeated + 1
+    assert 'titles ran the same query 3 times' in caplog.text
+    assert 'base.py' in caplog.text
+
+
+def test_production_does_not_record_queries():
+    assert ProductionConfig.SQLALCHEMY_RECORD_QUERIES is False
+
+
+def test_openai_metrics(fake_openai):
+    fake_openai.completion_tokens = 5
+    tokens = registry.counter('promptly_openai_tokens_total')
+    labels = {'model': 'gpt-4', 'stream': 'false', 'outcome': 'ok'}
+    completions = tokens.get(model='gpt-4', kind='completion')
+    requests = _metric('promptly_openai_request_duration_seconds', **labels)
+
+    completion(model='gpt-4', messages=[{'role': 'user', 'content': 'Hi'}])
+
+    assert tokens.get(model='gpt-4', kind='completion') == completions + 5
+    assert _metric('promptly_openai_request_duration_seconds',
+                   **labels) == requests + 1
+
+    fake_openai.fail(400)
+    try:
+        completion(model='gpt-4', messages=[{'role': 'user', 'content': 'Hi'}])
+    except openai.error.InvalidRequestError:
+        pass
+    assert _metric('promptly_openai_request_duration_seconds',
+                   **{**labels, 'outcome': 'error'}) >= 1
@@ -0,0 +1,62 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+"""Module for Metrics testing."""
+
+import pytest
+
+from promptly.metrics import Registry
+
+
+def test_render_counter_and_gauge():
+    registry = Registry()
+    counter = registry.counter('hits_total', 'Hits.', labelnames=('path',))
+    gauge = registry.gauge('in_flight', 'In flight.')
+
+    counter.inc(path='/')
+    counter.inc(2, path='/')
+    gauge.set(3)
+
+    assert registry.render() == (
+        '# HELP hits_total Hits.\n'
+        '# TYPE hits_total counter\n'
+        'hits_total{path="/"} 3.0\n'
+        '# HELP in_flight In flight.\n'
+        '# TYPE in_flight gauge\n'
+        'in_flight 3\n'
+    )
+
+
+def test_render_histogram():
+    registry = Registry()
+    histogram = registry.histogram('latency', 'Latency.', buckets=(0.1, 1))
+
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert registry.render().splitlines()[2:] == [
+        'latency_bucket{le="0.1"} 1.0',
+        'latency_bucket{le="1"} 2.0',
+        'latency_bucket{le="+Inf"} 3.0',
+        'latency_sum 5.55',
+        'latency_count 3.0',
+    ]
+
+
+def test_registry_returns_existing_metric():
+    registry = Registry()
+    assert registry.counter('a', 'A.') is registry.counter('a', 'A.')
+    with pytest.raises(ValueError):
+        registry.gauge('a', 'A.')
+
+
+def test_labels_are_validated():
+    registry = Registry()
+    counter = registry.counter('a', 'A.', labelnames=('path',))
+    with pytest.raises(ValueError):
+        counter.inc(method='GET')
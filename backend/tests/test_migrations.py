@@ -0,0 +1,27 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+import os
+
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from flask_migrate import check
+
+from promptly.models import db
+from promptly.models.search import include_object
+
+
+def test_models_match_the_migrations(app, project_root):
+    with db.engine.connect() as conn:
+        context = MigrationContext.configure(conn, opts={
+            'include_object': include_object,
+        })
+        assert compare_metadata(context, db.metadata) == []
+
+    # The autogenerate of the migrations environment finds nothing to do
+    # either, or exits.
+    check(os.path.join(project_root, 'migrations'))
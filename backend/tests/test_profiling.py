@@ -0,0 +1,140 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+import os
+import time
+
+import pytest
+import sqlalchemy as sa
+
+from promptly import profiling
+from promptly.app import create_app
+from promptly.models import db
+from promptly.profiling import Profile, ProfileStore, span
+
+
+def busy(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+def _profile(fn, *args):
+    profile = Profile(interval=0.001)
+    profile.start()
+    try:
+        fn(*args)
+    finally:
+        profile.stop()
+    return profile
+
+
+def test_profile_samples_the_stack():
+    profile = _profile(busy, 0.05)
+
+    assert profile.samples > 0
+    assert profile.duration >= 0.05
+    stack, count = profile.folded().splitlines()[0].rsplit(' ', 1)
+    assert stack.endswith('tests.test_profiling:_profile;'
+                          'tests.test_profiling:busy')
+    assert int(count) > 0
+
+
+def test_spans_annotate_the_samples():
+    def call_openai():
+        with span('[openai] gpt-4; the best'):
+            time.sleep(0.05)
+
+    folded = _profile(call_openai).folded()
+
+    assert '.<locals>.call_openai;' in folded
+    assert ';[openai] gpt-4, the best' in folded
+
+
+def test_spans_outside_of_profiles():
+    with span('[openai] gpt-4'):
+        pass
+
+    assert not profiling._spans
+
+
+def test_sql_queries_are_annotated(app, tmp_path):
+    profiling.init_app(app, ProfileStore(str(tmp_path)), sample_rate=0)
+    connection = db.session.connection().connection.driver_connection
+    connection.create_function('pause', 1, time.sleep)
+
+    def query():
+        db.session.execute(sa.text('SELECT pause(0.05)'))
+
+    folded = _profile(query).folded()
+
+    assert ';[sql] SELECT pause(0.05)' in folded
+
+
+def test_store_keeps_the_most_recent_profiles(tmp_path):
+    store = ProfileStore(str(tmp_path), max_profiles=2)
+    ids = [
+        store.save(_profile(busy, 0.02), path=f'/{i}')
+        for i in range(3)
+    ]
+
+    assert [meta['id'] for meta in store.list()] == ids[:0:-1]
+    assert store.list()[0]['path'] == '/2'
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        f'{profile_id}.{extension}'
+        for profile_id in ids[1:]
+        for extension in ('folded', 'json')
+    )
+    assert 'tests.test_profiling:busy' in store.load(ids[2])
+
+    with pytest.raises(KeyError):
+        store.load(ids[0])
+    with pytest.raises(KeyError):
+        store.load('../secret')
+
+
+@pytest.fixture()
+def profiled_app(monkeypatch, project_root, tmp_path):
+    monkeypatch.setattr(profiling, 'PROMPTLY_PROFILE', True)
+    monkeypatch.setattr(profiling, 'PROMPTLY_PROFILE_DIR', str(tmp_path))
+
+    app = create_app('testing')
+    app.wsgi_app.interval = 0.001
+    app.add_url_rule('/slow', 'slow', lambda: busy(0.05) or 'OK')
+    return app
+
+
+def test_middleware_profiles_requests(profiled_app, tmp_path):
+    client = profiled_app.test_client()
+    # The profile of a request is saved once its response is closed.
+    response = client.get('/slow')
+    assert not os.listdir(tmp_path)
+    response.close()
+
+    (meta,) = ProfileStore(str(tmp_path)).list()
+    assert meta['method'] == 'GET'
+    assert meta['path'] == '/slow'
+    assert meta['status'] == 200
+    assert meta['samples'] > 0
+
+
+def test_profiles_command(profiled_app):
+    profiled_app.test_client().get('/slow').close()
+    runner = profiled_app.test_cli_runner()
+
+    result = runner.invoke(args=['profiles', 'list'])
+    assert result.exit_code == 0
+    profile_id = result.output.split()[0]
+    assert 'GET /slow' in result.output
+
+    result = runner.invoke(args=['profiles', 'dump', profile_id])
+    assert result.exit_code == 0
+    assert 'tests.test_profiling:busy' in result.output
+
+    result = runner.invoke(args=['profiles', 'dump', 'nope'])
+    assert result.exit_code == 2
+    assert 'No such profile' in result.output
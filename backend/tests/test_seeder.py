@@ -0,0 +1,37 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+import sqlalchemy as sa
+
+from promptly.models import Chat, ChatEntry, db
+from tests.seeder import generate_chats, seed
+
+
+def _count(model):
+    return db.session.scalar(sa.select(sa.func.count(model.id)))
+
+
+def test_seed_at_scale(app):
+    seed(chats_count=3, entries_per_chat=4)
+
+    assert _count(Chat) == 3
+    assert _count(ChatEntry) == 12
+
+
+def test_generate_chats(app):
+    chat_ids = generate_chats(3, entries_per_chat=4, batch_size=5)
+
+    assert _count(Chat) == 3
+    assert _count(ChatEntry) == 12
+    # The most recent chat comes first in the history.
+    assert [chat.id for chat in Chat.summaries()] == chat_ids[::-1]
+
+    entries = ChatEntry.window(chat_ids[0], limit=10)
+    assert [str(entry.role) for entry in entries] == [
+        'user', 'assistant', 'user', 'assistant',
+    ]
+    assert all(entry.token_count for entry in entries)
@@ -0,0 +1,34 @@
+# This file is part of the Promptly.
+#
+# Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+#
+# For the full copyright and license information, please view
+# the LICENSE file that was distributed with this source code.
+
+from promptly import tokenizer
+
+
+def test_approximate_count(monkeypatch):
+    monkeypatch.setattr(tokenizer, '_get_encoding', lambda model: None)
+
+    assert tokenizer.encoding_name('gpt-4') == tokenizer.APPROXIMATE_ENCODING
+    assert tokenizer.count_tokens('', 'gpt-4') == 0
+    assert tokenizer.count_tokens('abc', 'gpt-4') == 1
+    assert tokenizer.count_tokens('abcd', 'gpt-4') == 2
+
+
+def test_message_count_includes_overhead(monkeypatch):
+    monkeypatch.setattr(tokenizer, '_get_encoding', lambda model: None)
+    message = {'role': 'user', 'content': 'x' * 9}
+
+    assert tokenizer.count_message_tokens(message, 'gpt-4') == (
+        tokenizer.TOKENS_PER_MESSAGE + 2 + 3
+    )
+
+
+def test_approximate_count_is_reported(monkeypatch, caplog):
+    monkeypatch.setattr(tokenizer, 'tiktoken', None)
+
+    tokenizer.warn_if_approximate()
+
+    assert 'tiktoken is not installed' in caplog.text
@@ -7,11 +7,12 @@
 
 """Module for Utils testing."""
 
-import time
+import asyncio
+import threading
 
 import pytest
 
-from promptly.utils import strtobool, threaded_execute, try_parse_int
+from promptly.utils import EventLoopThread, strtobool, try_parse_int
 
 
 @pytest.mark.parametrize(
@@ -33,38 +34,54 @@ def test_should_raise_value_error():
         strtobool('FOO_BAR')
 
 
-def test_threaded_execute_success():
-    def fast_func():
+@pytest.fixture
+def loop_thread(request):
+    """An event loop thread, stopped once the test is over."""
+    instance = EventLoopThread(name=f'test-{request.node.name}')
+    request.addfinalizer(instance.stop)
+    return instance
+
+
+def test_event_loop_thread_run_success(loop_thread):
+    async def fast_coro():
         return 'Success'
 
-    result = threaded_execute(fast_func)
-    assert result == 'Success'
+    assert loop_thread.run(fast_coro()) == 'Success'
 
 
-def test_threaded_execute_non_timeout_exception():
-    def failing_func():
+def test_event_loop_thread_run_exception(loop_thread):
+    async def failing_coro():
         raise ValueError('Something went wrong')
 
-    try:
-        threaded_execute(failing_func)
-    except ValueError as e:
-        assert str(e) == 'Something went wrong'
+    with pytest.raises(ValueError, match='Something went wrong'):
+        loop_thread.run(failing_coro())
+
+
+def test_event_loop_thread_run_timeout_cancels(loop_thread):
+    cancelled = threading.Event()
+
+    async def slow_coro():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    with pytest.raises(asyncio.TimeoutError):
+        loop_thread.run(slow_coro(), timeout=0.1)
+
+    assert cancelled.wait(1)
 
 
-def test_threaded_execute(caplog):
-    i = 0
+def test_event_loop_thread_reuses_loop(loop_thread):
+    async def running_loop():
+        return asyncio.get_running_loop()
 
-    def fun():
-        nonlocal i
-        i += 1
-        if i == 1:  # first time around, time out
-            time.sleep(1)
-        return f'OK {i}'
+    first = loop_thread.run(running_loop())
+    assert loop_thread.run(running_loop()) is first
 
-    assert threaded_execute(fun, timeout=0.5) == 'OK 2'
-    assert caplog.records[0].message == (
-        'The operation exceeded the given deadline'
-    )
+    loop_thread.stop()
+    assert loop_thread.run(running_loop()) is not first
 
 
 @pytest.mark.parametrize(
@@ -6,9 +6,13 @@
 // the LICENSE file that was distributed with this source code.
 
 import {
+    appendChatElementContent,
     autoResizePromptTextarea,
     calculateTextareaHeight,
     createChatElement,
+    initOlderEntries,
+    parseServerSentEvents,
+    readErrorMessage,
 } from '../../frontend/js/chat.js';
 
 describe('chat-elements', () => {
@@ -131,3 +135,84 @@ describe('chat-textarea', () => {
         expect(textarea.style.overflowY).toBe('hidden');
     });
 });
+
+describe('chat-streaming', () => {
+    test('should append chunks to an existing chat element', () => {
+        const element = createChatElement('', 'assistant');
+        appendChatElementContent(element, 'Hello');
+        appendChatElementContent(element, ', world!');
+        expect(element.getAttribute('data-entry-role')).toBe('assistant');
+        expect(element.textContent).toBe('Hello, world!');
+    });
+
+    test('should parse complete events and keep the remainder', () => {
+        const { events, rest } = parseServerSentEvents(
+            'event: start\ndata: {"chat_id": 1}\n\n' +
+            'data: {"delta": "Hello"}\n\n' +
+            'data: {"del'
+        );
+        expect(events).toEqual([
+            { event: 'start', data: { chat_id: 1 } },
+            { event: 'message', data: { delta: 'Hello' } },
+        ]);
+        expect(rest).toBe('data: {"del');
+    });
+
+    test('should read the message of a rejected request', async () => {
+        const response = {
+            status: 503,
+            statusText: 'Service Unavailable',
+            headers: new Map([['Retry-After', '7']]),
+            json: () => Promise.resolve({ error: 'Too many requests' }),
+        };
+        expect(await readErrorMessage(response)).toBe(
+            'Too many requests (retry in 7 s)'
+        );
+    });
+
+    test('should fall back to the status of a non-JSON error', async () => {
+        const response = {
+            status: 502,
+            statusText: 'Bad Gateway',
+            headers: new Map(),
+            json: () => Promise.reject(new SyntaxError('Unexpected token')),
+        };
+        expect(await readErrorMessage(response)).toBe('502 Bad Gateway');
+    });
+});
+
+describe('chat-older-entries', () => {
+    afterEach(() => {
+        delete global.fetch;
+    });
+
+    test('should insert older entries before the rendered ones', async () => {
+        const chatOutput = document.createElement('div');
+        const cursorElement = document.createElement('div');
+        cursorElement.dataset.pageUrl = '/1/entries.json';
+        cursorElement.dataset.nextCursor = '3';
+        chatOutput.appendChild(cursorElement);
+        chatOutput.appendChild(createChatElement('Third', 'user'));
+
+        global.fetch = jest.fn(() => Promise.resolve({
+            json: () => Promise.resolve({
+                entries: [
+                    {id: 1, role: 'user', content: 'First'},
+                    {id: 2, role: 'assistant', content: 'Second'},
+                ],
+                next_cursor: null,
+            }),
+        }));
+
+        const loadOlderEntries = initOlderEntries(
+            cursorElement,
+            document.createElement('div'),
+        );
+        await loadOlderEntries();
+
+        expect(global.fetch).toHaveBeenCalledWith('/1/entries.json?cursor=3');
+        const messages = Array.from(chatOutput.querySelectorAll('.chat-message'));
+        expect(messages.map(m => m.textContent)).toEqual(['First', 'Second', 'Third']);
+        expect(cursorElement.dataset.nextCursor).toBe('');
+    });
+});
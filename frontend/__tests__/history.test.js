@@ -0,0 +1,85 @@
+// This file is part of the Promptly.
+//
+// Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+//
+// For the full copyright and license information, please view
+// the LICENSE file that was distributed with this source code.
+
+import {
+    createHistoryRowElement,
+    initInfiniteHistory,
+} from '../../frontend/js/history.js';
+
+describe('history-rows', () => {
+    test('should create a history row from a chat summary', () => {
+        const row = createHistoryRowElement({
+            id: 42,
+            date: 'Today',
+            title: 'New chat',
+            teaser: 'Hello',
+        });
+        expect(row.getAttribute('data-chat-id')).toBe('42');
+        expect(row.textContent).toBe('TodayNew chatHello');
+    });
+
+    test('should show the highlighted snippet of a search result', () => {
+        const row = createHistoryRowElement({
+            id: 42,
+            date: 'Today',
+            title: 'New chat',
+            snippet: 'Say <mark>hello</mark>',
+        });
+        const teaser = row.querySelector('.chat-history-teaser');
+        expect(teaser.querySelector('mark').textContent).toBe('hello');
+        expect(teaser.textContent).toBe('Say hello');
+    });
+});
+
+describe('history-pagination', () => {
+    let historyBody;
+
+    beforeEach(() => {
+        historyBody = document.createElement('tbody');
+        historyBody.dataset.pageUrl = '/history.json';
+        historyBody.dataset.nextCursor = '10';
+
+        global.fetch = jest.fn(() => Promise.resolve({
+            json: () => Promise.resolve({
+                chats: [{id: 9, date: 'Today', title: 'Chat', teaser: ''}],
+                next_cursor: null,
+            }),
+        }));
+    });
+
+    afterEach(() => {
+        delete global.fetch;
+    });
+
+    test('should append the next page and update the cursor', async () => {
+        const loadNextPage = initInfiniteHistory(
+            historyBody,
+            document.createElement('div'),
+        );
+
+        await loadNextPage();
+        expect(global.fetch).toHaveBeenCalledWith('/history.json?cursor=10');
+        expect(historyBody.children.length).toBe(1);
+        expect(historyBody.dataset.nextCursor).toBe('');
+
+        await loadNextPage();
+        expect(global.fetch).toHaveBeenCalledTimes(1);
+    });
+
+    test('should keep the search query of the page URL', async () => {
+        historyBody.dataset.pageUrl = '/history/search.json?q=hello';
+        const loadNextPage = initInfiniteHistory(
+            historyBody,
+            document.createElement('div'),
+        );
+
+        await loadNextPage();
+        expect(global.fetch).toHaveBeenCalledWith(
+            '/history/search.json?q=hello&cursor=10',
+        );
+    });
+});
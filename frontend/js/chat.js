@@ -88,3 +88,138 @@ export function createChatElement(message, chatEntryRole) {
 
   return messageWrapper;
 }
+
+/**
+ * Append a chunk of text to an existing chat HTML node.
+ *
+ * This is the incremental counterpart of {@link createChatElement}, used to
+ * render a streamed response as its tokens arrive.
+ *
+ * @param {HTMLDivElement} chatElement - The chat element created by createChatElement.
+ * @param {string} chunk - The text to append to the chat element.
+ * @returns {HTMLDivElement}
+ */
+export function appendChatElementContent(chatElement, chunk) {
+  const messageBody = chatElement.querySelector('.card-body');
+  messageBody.textContent += chunk;
+
+  return chatElement;
+}
+
+/**
+ * Parse the complete Server-Sent Events from a text buffer.
+ *
+ * Events are separated by a blank line; a trailing incomplete event is
+ * returned as the remainder, so it can be prepended to the next chunk.
+ *
+ * @param {string} buffer - The received text, possibly ending in the middle of an event.
+ * @returns {{events: Array<{event: string, data: Object}>, rest: string}}
+ */
+export function parseServerSentEvents(buffer) {
+  const blocks = buffer.split('\n\n');
+  const rest = blocks.pop();
+  const events = [];
+
+  blocks.forEach(block => {
+    let event = 'message';
+    const data = [];
+
+    block.split('\n').forEach(line => {
+      if (line.startsWith('event: ')) {
+        event = line.substring('event: '.length);
+      } else if (line.startsWith('data: ')) {
+        data.push(line.substring('data: '.length));
+      }
+    });
+
+    if (data.length > 0) {
+      events.push({ event, data: JSON.parse(data.join('\n')) });
+    }
+  });
+
+  return { events, rest };
+}
+
+/**
+ * Get the message of a failed response.
+ *
+ * The API answers errors with a JSON body holding an `error` message, and
+ * overloads with a `Retry-After` header as well. Other bodies, such as the
+ * HTML error pages of a proxy, are replaced with the status text.
+ *
+ * @param {Response} response - The response with a non-2xx status.
+ * @returns {Promise<string>}
+ */
+export async function readErrorMessage(response) {
+  let message = `${response.status} ${response.statusText}`.trim();
+  try {
+    const data = await response.json();
+    if (data && data.error) {
+      message = data.error;
+    }
+  } catch (e) {
+    // Not a JSON body
+  }
+
+  const retryAfter = response.headers.get('Retry-After');
+  if (retryAfter) {
+    message += ` (retry in ${retryAfter} s)`;
+  }
+
+  return message;
+}
+
+/**
+ * Load the older entries of a chat as the user scrolls up.
+ *
+ * The cursor element, placed before the first rendered entry, holds the URL
+ * of the chat entries endpoint and the cursor of the preceding window in its
+ * data attributes. Each fetched window is inserted right after the cursor
+ * element, keeping the visible entries in place.
+ *
+ * @param {HTMLElement} cursorElement - The element holding the pagination state.
+ * @param {HTMLElement} scrollContainer - The element scrolled by the user.
+ * @returns {Function} The function loading the preceding window.
+ */
+export function initOlderEntries(cursorElement, scrollContainer) {
+  let loading = false;
+
+  const loadOlderEntries = () => {
+    const cursor = cursorElement.dataset.nextCursor;
+    if (loading || !cursor) {
+      return Promise.resolve();
+    }
+
+    loading = true;
+    const url = `${cursorElement.dataset.pageUrl}?cursor=${encodeURIComponent(cursor)}`;
+
+    return fetch(url)
+      .then(response => response.json())
+      .then(data => {
+        const previousHeight = scrollContainer.scrollHeight;
+        const fragment = document.createDocumentFragment();
+
+        data.entries.forEach(entry => {
+          fragment.appendChild(createChatElement(entry.content, entry.role));
+        });
+
+        cursorElement.after(fragment);
+        cursorElement.dataset.nextCursor = data.next_cursor || '';
+        scrollContainer.scrollTop += scrollContainer.scrollHeight - previousHeight;
+      })
+      .catch(() => {
+        // TODO: Log error
+      })
+      .finally(() => {
+        loading = false;
+      });
+  };
+
+  scrollContainer.addEventListener('scroll', () => {
+    if (scrollContainer.scrollTop <= 200) {
+      loadOlderEntries();
+    }
+  });
+
+  return loadOlderEntries;
+}
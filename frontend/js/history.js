@@ -0,0 +1,106 @@
+/**
+ * This file is part of the Promptly.
+ *
+ * Copyright (C) 2023 Serghei Iakovlev <egrep@protonmail.ch>
+ *
+ * For the full copyright and license information, please view
+ * the LICENSE file that was distributed with this source code.
+ */
+
+/**
+ * Create chat history row HTML node.
+ *
+ * Search results come with an HTML snippet, escaped by the server, where
+ * the matches are highlighted. It is shown in place of the teaser.
+ *
+ * @param {Object} chat - The chat summary, as returned by the history or the
+ *   search endpoint.
+ * @returns {HTMLTableRowElement}
+ */
+export function createHistoryRowElement(chat) {
+  const row = document.createElement('tr');
+  row.className = 'chat-history-item';
+  row.setAttribute('data-chat-id', chat.id);
+
+  const date = document.createElement('td');
+  date.textContent = chat.date;
+
+  const title = document.createElement('th');
+  title.setAttribute('scope', 'row');
+  title.textContent = chat.title;
+
+  const teaser = document.createElement('td');
+  teaser.className = 'chat-history-teaser';
+  if (chat.snippet) {
+    teaser.innerHTML = chat.snippet;
+  } else {
+    teaser.textContent = chat.teaser;
+  }
+
+  row.appendChild(date);
+  row.appendChild(title);
+  row.appendChild(teaser);
+
+  return row;
+}
+
+/**
+ * Check whether a scrollable element is scrolled close to its bottom.
+ *
+ * @param {HTMLElement} element - The scrollable element.
+ * @param {number} threshold - The distance to the bottom, in pixels.
+ * @returns {boolean}
+ */
+export function isNearBottom(element, threshold = 200) {
+  return element.scrollHeight - element.scrollTop - element.clientHeight <= threshold;
+}
+
+/**
+ * Load the next pages of the chat history as the user scrolls.
+ *
+ * The history table body holds the URL of the history endpoint and the
+ * cursor of the next page in its data attributes. Each fetched page is
+ * appended to the table, until there is no next page anymore.
+ *
+ * @param {HTMLElement} historyBody - The tbody element of the history table.
+ * @param {HTMLElement} scrollContainer - The element scrolled by the user.
+ * @returns {Function} The function loading the next page.
+ */
+export function initInfiniteHistory(historyBody, scrollContainer) {
+  let loading = false;
+
+  const loadNextPage = () => {
+    const cursor = historyBody.dataset.nextCursor;
+    if (loading || !cursor) {
+      return Promise.resolve();
+    }
+
+    loading = true;
+    const pageUrl = historyBody.dataset.pageUrl;
+    const separator = pageUrl.includes('?') ? '&' : '?';
+    const url = `${pageUrl}${separator}cursor=${encodeURIComponent(cursor)}`;
+
+    return fetch(url)
+      .then(response => response.json())
+      .then(data => {
+        data.chats.forEach(chat => {
+          historyBody.appendChild(createHistoryRowElement(chat));
+        });
+        historyBody.dataset.nextCursor = data.next_cursor || '';
+      })
+      .catch(() => {
+        // TODO: Log error
+      })
+      .finally(() => {
+        loading = false;
+      });
+  };
+
+  scrollContainer.addEventListener('scroll', () => {
+    if (isNearBottom(scrollContainer)) {
+      loadNextPage();
+    }
+  });
+
+  return loadNextPage;
+}
@@ -7,8 +7,28 @@
  * the LICENSE file that was distributed with this source code.
  */
 
-import { autoResizePromptTextarea, createChatElement } from './chat.js';
+import {
+  appendChatElementContent,
+  autoResizePromptTextarea,
+  createChatElement,
+  initOlderEntries,
+  parseServerSentEvents,
+  readErrorMessage,
+} from './chat.js';
 import { getCookie, setCookie } from './cookie.js';
+import { initInfiniteHistory } from './history.js';
+
+document.addEventListener('DOMContentLoaded', function() {
+  const historyBody = document.getElementById('chat-history');
+  if (historyBody) {
+    initInfiniteHistory(historyBody, document.querySelector('main.content'));
+  }
+
+  const entriesCursor = document.getElementById('chat-entries-cursor');
+  if (entriesCursor) {
+    initOlderEntries(entriesCursor, document.querySelector('main.content'));
+  }
+});
 
 document.addEventListener('DOMContentLoaded', function() {
   const textarea = document.getElementById('prompt-textarea');
@@ -50,19 +70,65 @@ document.addEventListener('DOMContentLoaded', function() {
       chatOutput.appendChild(loadingRow);
 
       let currentChatId = getCookie('chat_id');
-      fetch('/conversation', {
+      let responseRow = null;
+
+      const showError = message => {
+        loadingRow.remove();
+        chatOutput.appendChild(createChatElement(message, 'error'));
+        chatOutput.scrollTop = chatOutput.scrollHeight;
+      };
+
+      const handleEvent = ({ event, data }) => {
+        if (event === 'start' || event === 'done') {
+          currentChatId = data.chat_id;
+          setCookie('chat_id', currentChatId, 30);
+        } else if (event === 'message') {
+          if (responseRow === null) {
+            loadingRow.remove();
+            responseRow = createChatElement('', 'assistant');
+            chatOutput.appendChild(responseRow);
+          }
+          appendChatElementContent(responseRow, data.delta);
+          chatOutput.scrollTop = chatOutput.scrollHeight;
+        } else if (event === 'error') {
+          showError(data.error);
+        }
+      };
+
+      fetch('/conversation/stream', {
         method: 'POST',
         headers: {
+          'Accept': 'text/event-stream',
           'Content-Type': 'application/json'
         },
         body: JSON.stringify({ message: userInput, chat_id: currentChatId })
       })
-      .then(response => response.json())
-      .then(data => {
-        currentChatId = data.chat_id;
-        setCookie('chat_id', currentChatId, 30);
+      .then(async response => {
+        // A rejected request, e.g. an overloaded upstream, is answered with
+        // a JSON error instead of a stream.
+        if (!response.ok) {
+          showError(await readErrorMessage(response));
+          return;
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+          const { done, value } = await reader.read();
+          if (done) {
+            break;
+          }
+
+          const parsed = parseServerSentEvents(
+              buffer + decoder.decode(value, { stream: true })
+          );
+          buffer = parsed.rest;
+          parsed.events.forEach(handleEvent);
+        }
+
         loadingRow.remove();
-        chatOutput.appendChild(createChatElement(data.message, 'assistant'));
       })
       .catch(() => {
         // TODO: Log error